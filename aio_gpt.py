@@ -0,0 +1,682 @@
+import asyncio
+import contextvars
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+import config
+from gpt import build_conversation_request, process_wss_message, process_wss_result, put_upstream_error, \
+    process_sse_events, finish_sse_text, put_stream_exception, websocket_manager, get_error_code, report_account_error, \
+    release_connection_when_done, hide_conversation, ATTEMPT_END, hedge_attempt, mark_attempt_failed, is_attempt_output
+from init import logger
+from modules.hedge import hedge_policy
+from modules.pipeline import PrepareStages
+from modules.sse import decode_frame_body
+from modules.stream_control import StreamStopEvent
+from modules.stream_state import StreamState
+from modules.transport import transport_negotiator, TRANSPORT_SSE, TRANSPORT_WSS
+from modules.upstream import upstream_pool, FAILOVER_STATUS_CODES, IDEMPOTENT_METHODS, request_route, RequestRoute
+
+"""
+asyncio 执行模式下的上游数据获取
+
+与 gpt.py 中基于线程的 data_fetcher / process_wss / old_data_fetcher 一一对应，
+解析与处理逻辑（process_data_json 等）完全复用，仅将网络 I/O 换成协程，
+使单个 worker 的一个事件循环即可承载大量并发的 SSE 流。
+"""
+
+BASE_URL = config.BASE_URL
+PROXY_API_PREFIX = config.PROXY_API_PREFIX
+
+# 每个事件循环共用的 aiohttp 会话，key 为是否走代理
+_sessions = {}
+
+
+class AsyncDataQueue:
+    """
+    事件循环内使用的数据队列
+
+    put 为同步调用，以便 process_data_json 等同步处理逻辑直接在事件循环中向其写入数据；
+    单条上游消息产生的数据总能写入，上限通过数据获取协程在读取下一条上游消息前 await wait_writable() 实现
+    """
+
+    def __init__(self, maxsize=0):
+        self._queue = asyncio.Queue()
+        self.maxsize = maxsize
+        self._writable = asyncio.Event()
+        self._writable.set()
+        # 是否已经写入结束信号
+        self.completed = False
+
+    def full(self):
+        return 0 < self.maxsize <= self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def put(self, item, block=True, timeout=None):
+        self._queue.put_nowait(item)
+        if item == 'data: [DONE]\n\n':
+            self.completed = True
+        if self.full():
+            self._writable.clear()
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    async def get(self):
+        item = await self._queue.get()
+        if not self.full():
+            self._writable.set()
+        return item
+
+    def get_nowait(self):
+        item = self._queue.get_nowait()
+        if not self.full():
+            self._writable.set()
+        return item
+
+    async def wait_writable(self):
+        await self._writable.wait()
+
+
+class ThreadSafeDataQueue:
+    """
+    在 process_executor 中处理上游数据时代替数据队列写入，数据经 call_soon_threadsafe 按写入顺序转交到事件循环，
+    在处理完成、协程恢复执行之前全部写入，必须在事件循环中创建
+    """
+
+    def __init__(self, data_queue):
+        self.data_queue = data_queue
+        self._loop = asyncio.get_running_loop()
+
+    def put(self, item, block=True, timeout=None):
+        self._loop.call_soon_threadsafe(self.data_queue.put, item)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+
+# 处理上游数据的线程池：process_data_json 中的图片等待、沙箱文件下载、action 确认请求等阻塞调用不在事件循环中执行
+process_executor = ThreadPoolExecutor(max_workers=config.PROCESS_POOL_MAX_WORKERS, thread_name_prefix="aio-process")
+
+
+async def run_processing(fn, *args):
+    """
+    在 process_executor 中执行 gpt.py 中的同步处理函数，数据队列参数需传入 ThreadSafeDataQueue
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(process_executor, context.run, fn, *args)
+
+
+async def await_pending_images(context):
+    """
+    会话结束前在事件循环中等待尚未完成的图片，总时长不超过 image_pool.wait_timeout，
+    之后在线程池中输出图片时不再阻塞 process_executor 的线程
+    """
+    pending = [asyncio.wrap_future(image.future) for image in context.pending_images if not image.future.done()]
+    if not pending:
+        return
+    context.image_wait_deadline = time.time() + config.IMAGE_POOL_WAIT_TIMEOUT
+    for future in pending:
+        # 失败的结果由 gpt.wait_image 记录
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    await asyncio.wait(pending, timeout=config.IMAGE_POOL_WAIT_TIMEOUT)
+
+
+def is_final_frame(result_json):
+    """
+    :return websocket 消息中是否包含结束事件
+    """
+    body = result_json.get('body', '')
+    return bool(body) and '[DONE]' in decode_frame_body(body)
+
+
+def get_session(use_proxy=False):
+    """
+    获取共用的 aiohttp 会话，必须在事件循环中调用
+    """
+    session = _sessions.get(use_proxy)
+    if session is None or session.closed:
+        # 连接池参数与线程模式的 http_client 保持一致
+        connector_options = {
+            "limit": 0,
+            "limit_per_host": config.HTTP_CLIENT_POOL_MAXSIZE,
+            "ttl_dns_cache": config.HTTP_CLIENT_DNS_CACHE_TTL or None,
+            "use_dns_cache": config.HTTP_CLIENT_DNS_CACHE_TTL > 0,
+        }
+        connector = None
+        if use_proxy and config.PROXY_CONFIG_ENABLED and config.PROXY_CONFIG_PROTOCOL != 'http':
+            try:
+                from aiohttp_socks import ProxyConnector
+                connector = ProxyConnector.from_url(config.PROXY_URL,
+                                                    username=config.PROXY_CONFIG_USERNAME or None,
+                                                    password=config.PROXY_CONFIG_PASSWORD or None,
+                                                    **connector_options)
+            except ImportError:
+                logger.warning("未安装 aiohttp-socks，asyncio 模式下的 socks 代理将不会生效")
+        if connector is None:
+            connector = aiohttp.TCPConnector(**connector_options)
+        # 流式响应可能持续数分钟，这里只限制建立连接的时间与两次数据之间的间隔
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=config.HTTP_CLIENT_CONNECT_TIMEOUT,
+                                        sock_read=config.HTTP_CLIENT_STREAM_READ_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _sessions[use_proxy] = session
+    return session
+
+
+def get_proxy():
+    # aiohttp 原生只支持 http 代理，socks 代理由 get_session 中的 connector 处理
+    if config.PROXY_CONFIG_ENABLED and config.PROXY_CONFIG_PROTOCOL == 'http':
+        return config.PROXY_URL
+    return None
+
+
+async def close_sessions():
+    for session in list(_sessions.values()):
+        await session.close()
+    _sessions.clear()
+
+
+async def async_send_text_prompt_and_get_response(messages, api_key, stream, model, stages=None):
+    if stages is None:
+        stages = PrepareStages()
+    # 构建 payload 的过程中包含文件上传等阻塞操作，放到线程池中执行
+    conversation_request = await asyncio.to_thread(build_conversation_request, messages, api_key, model, stages)
+    if conversation_request is None:
+        return None
+    return await async_post_conversation_request(conversation_request, stages)
+
+
+async def async_post_conversation_request(conversation_request, stages):
+    """
+    所有准备阶段汇合后发送对话请求
+    """
+    stages.log_timings()
+    path, headers, payload = conversation_request
+    return await async_upstream_request('POST', path, headers=headers, json=payload)
+
+
+async def async_upstream_request(method, path, **kwargs):
+    """
+    与 upstream_pool.request 一致，依次向可用的上游实例发送请求，直到某个实例正常响应
+    """
+    candidates = upstream_pool.candidates()
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    last_error = None
+    for index, backend in enumerate(candidates):
+        if not upstream_pool.acquire(backend):
+            continue
+        route = request_route.get()
+        if route is not None:
+            route.backend = backend
+        start_time = time.time()
+        try:
+            response = await get_session().request(method, backend.base_url + path, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            upstream_pool.record(backend, False, time.time() - start_time)
+            logger.error(f"上游 {backend.base_url} 请求失败: {e}")
+            # 非幂等请求只在连接阶段失败（请求尚未发出）时换实例重试
+            if not idempotent and not isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)):
+                raise
+            last_error = e
+            continue
+        if response.status in FAILOVER_STATUS_CODES:
+            upstream_pool.record(backend, False, time.time() - start_time)
+            if idempotent and index < len(candidates) - 1:
+                logger.error(f"上游 {backend.base_url} 返回 {response.status}，切换到其他上游")
+                response.release()
+                continue
+            return response
+        upstream_pool.record(backend, True, time.time() - start_time)
+        return response
+    if last_error is not None:
+        raise last_error
+    raise aiohttp.ClientConnectionError("no available upstream")
+
+
+async def async_register_websocket(api_key):
+    path = f"{PROXY_API_PREFIX}/backend-api/register-websocket"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    async with await async_upstream_request('POST', path, headers=headers) as response:
+        response_text = await response.text()
+    try:
+        response_json = json.loads(response_text)
+        logger.debug("register_websocket response: %s", response_json)
+        wss_url = response_json.get("wss_url", None)
+        return wss_url
+    except json.JSONDecodeError:
+        raise Exception(f"Wss register fail: {response_text}")
+
+
+async def async_data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
+                             messages, stream=True):
+    try:
+        if transport_negotiator.get(BASE_URL, api_key) == TRANSPORT_SSE:
+            # 已知上游以 SSE 返回，直接发送对话请求，不再注册与建立 websocket
+            context = StreamState(messages, api_key, model, chat_message_id, response_format, stream)
+            upstream_response = await async_send_text_prompt_and_get_response(messages, api_key, True, model)
+            transport = await async_handle_conversation_response(context, upstream_response, data_queue, stop_event)
+            if transport == TRANSPORT_SSE:
+                await async_old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key,
+                                             chat_message_id, model, response_format, stream)
+            elif transport == TRANSPORT_WSS:
+                # 上游已改为 WSS 返回，补连 websocket 接收本次对话的后续消息
+                logger.warning("上游对话返回方式已变为 wss，补连 websocket")
+                transport_negotiator.remember(BASE_URL, api_key, TRANSPORT_WSS)
+                if config.WEBSOCKET_PERSISTENT:
+                    await async_process_shared_wss(data_queue, stop_event, last_data_time, api_key, chat_message_id,
+                                                   model, response_format, messages, stream, context)
+                else:
+                    wss_url = await async_register_websocket(api_key)
+                    await async_process_wss(wss_url, data_queue, stop_event, last_data_time, api_key,
+                                            chat_message_id, model, response_format, messages, stream, context)
+            return
+
+        if config.WEBSOCKET_PERSISTENT:
+            await async_process_shared_wss(data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                                           response_format, messages, stream)
+            return
+
+        # 注册 websocket 与构建对话请求同时进行，在 websocket 建立后发送
+        stages = PrepareStages()
+        register_task = asyncio.ensure_future(async_register_websocket(api_key))
+        try:
+            conversation_request = await asyncio.to_thread(build_conversation_request, messages, api_key, model,
+                                                           stages)
+            wss_url = await register_task
+        except BaseException:
+            register_task.cancel()
+            raise
+        await async_process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                                response_format, messages, stream, conversation_request=(conversation_request, stages))
+    except asyncio.CancelledError:
+        logger.info("接受到取消信号，停止数据处理协程")
+        raise
+    except Exception as e:
+        # 确保消费端总能收到结束信号
+        context = StreamState(messages, api_key, model, chat_message_id, response_format)
+        put_stream_exception(context, data_queue, last_data_time, e)
+    finally:
+        # 与线程模式 start_data_fetcher 的回调一致，websocket 被关闭、SSE 没有结束事件等情况下同样写入结束信号，
+        # 线程池中写入的数据在协程恢复执行前已经全部转交到队列
+        if not data_queue.completed:
+            # 对冲请求中没有正常结束的一路不会因此胜出
+            mark_attempt_failed()
+            data_queue.put('data: [DONE]\n\n')
+
+
+class AsyncHedgeAttempt:
+    """
+    与 gpt.HedgeAttempt 一致，一路对冲请求
+    """
+
+    def __init__(self, arrivals, avoid):
+        self.arrivals = arrivals
+        self.stop_event = StreamStopEvent()
+        self.queue = AsyncHedgeAttemptQueue(self)
+        self.last_data_time = [time.time()]
+        self.route = RequestRoute(avoid)
+        self.start_time = time.time()
+        # 产生第一条输出的时间，出错的一路始终为 None
+        self.first_event_time = None
+        self.failed = False
+        self.ended = False
+        # 这一路创建的会话，落选时隐藏
+        self.conversation_ids = set()
+        self.task = None
+
+
+class AsyncHedgeAttemptQueue(AsyncDataQueue):
+    """
+    与 gpt.HedgeAttemptQueue 一致，没有出错的一路写入第一条实际输出时通知 arrivals
+    """
+
+    def __init__(self, attempt):
+        super().__init__(config.STREAM_QUEUE_MAX_SIZE)
+        self.attempt = attempt
+
+    def put(self, item, block=True, timeout=None):
+        attempt = self.attempt
+        if isinstance(item, tuple) and item[0] == 'conversation_id':
+            attempt.conversation_ids.add(item[1])
+        super().put(item, block, timeout)
+        if attempt.first_event_time is None and not attempt.failed and is_attempt_output(item):
+            attempt.first_event_time = time.time()
+            attempt.arrivals.put_nowait(attempt)
+
+
+async def async_run_hedge_attempt(attempt, api_key, chat_message_id, model, response_format, messages, stream):
+    # 在任务内设置，只影响这一路请求
+    request_route.set(attempt.route)
+    hedge_attempt.set(attempt)
+    try:
+        await async_data_fetcher(attempt.queue, attempt.stop_event, attempt.last_data_time, api_key, chat_message_id,
+                                 model, response_format, messages, stream)
+    finally:
+        attempt.ended = True
+        attempt.queue.put(ATTEMPT_END)
+        # 没有产生输出就结束的一路同样通知 arrivals
+        if attempt.first_event_time is None:
+            attempt.arrivals.put_nowait(attempt)
+
+
+async def async_hedged_data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                                    response_format, messages, stream=True):
+    """
+    与 gpt.hedged_data_fetcher 一致，开启对冲请求时代替 async_data_fetcher，只配置了一个上游实例时不使用对冲；
+    所有请求结束后才返回，无论以何种方式结束都会向队列写入结束信号
+    """
+    if len(upstream_pool.backends) < 2:
+        await async_data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                                 response_format, messages, stream)
+        return
+    hedge_policy.on_request()
+    arrivals = asyncio.Queue()
+    attempts = []
+
+    def start_attempt(avoid):
+        attempt = AsyncHedgeAttempt(arrivals, avoid)
+        attempt.task = asyncio.ensure_future(async_run_hedge_attempt(
+            attempt, api_key, chat_message_id, model, response_format, messages, stream))
+        attempts.append(attempt)
+        return attempt
+
+    primary = start_attempt(None)
+    winner = None
+    try:
+        hedge_delay = hedge_policy.delay()
+        while winner is None:
+            try:
+                if hedge_delay is None:
+                    attempt = await arrivals.get()
+                else:
+                    attempt = await asyncio.wait_for(arrivals.get(), hedge_delay)
+            except asyncio.TimeoutError:
+                # 主请求尚未发往上游或没有其他可用实例时不发起对冲
+                backend = primary.route.backend
+                if backend is not None and upstream_pool.has_alternative(backend) and hedge_policy.try_spend():
+                    logger.info(f"主请求 {time.time() - primary.start_time:.2f} 秒内没有产生数据，发起对冲请求")
+                    start_attempt(primary.route.backend)
+                hedge_delay = None
+                continue
+            # 出错或没有产生输出就结束的一路，在还有其他请求时继续等待
+            if attempt.first_event_time is None and any(not other.ended for other in attempts if other is not attempt):
+                continue
+            winner = attempt
+
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.stop_event.set()
+                attempt.task.cancel()
+        if winner is not primary:
+            logger.info("对冲请求胜出")
+            hedge_policy.record_hedge_won()
+        # 从头转发，包括胜出之前写入的记录信息
+        item = await winner.queue.get()
+        while item is not ATTEMPT_END:
+            data_queue.put(item)
+            last_data_time[0] = time.time()
+            await data_queue.wait_writable()
+            item = await winner.queue.get()
+    finally:
+        for attempt in attempts:
+            attempt.stop_event.set()
+            attempt.task.cancel()
+        await asyncio.gather(*[attempt.task for attempt in attempts], return_exceptions=True)
+        for attempt in attempts:
+            # 各路按自己的发起时间计算，对冲请求胜出时不把对冲延迟计入样本
+            if attempt.first_event_time is not None:
+                hedge_policy.record_first_event(attempt.first_event_time - attempt.start_time)
+            if attempt is not winner:
+                for conversation_id in attempt.conversation_ids:
+                    asyncio.ensure_future(asyncio.to_thread(hide_conversation, conversation_id, api_key))
+        data_queue.put('data: [DONE]\n\n')
+
+
+async def async_handle_conversation_response(context, upstream_response, data_queue, stop_event):
+    """
+    与 gpt.handle_conversation_response 一致
+    :return TRANSPORT_SSE / TRANSPORT_WSS，上游出错时写入错误信息并返回 None
+    """
+    # 检查 Content-Type 是否为 SSE 响应
+    content_type = upstream_response.headers.get('Content-Type')
+    logger.debug(f"Content-Type: {content_type}")
+    if content_type and 'text/event-stream' in content_type:
+        logger.debug("上游响应为 SSE 响应")
+        context.is_sse = True
+        context.upstream_response = upstream_response
+        return TRANSPORT_SSE
+    upstream_response_text = await upstream_response.text()
+    upstream_response.release()
+    if upstream_response.status != 200:
+        logger.error(f"upstream_response status code: {upstream_response.status}, upstream_response: {upstream_response_text}")
+        report_account_error(context.api_key, get_error_code(upstream_response_text))
+        put_upstream_error(context, data_queue)
+        stop_event.set()
+        return None
+    try:
+        upstream_response_json = json.loads(upstream_response_text)
+        logger.debug("upstream_response_json: %s", upstream_response_json)
+        context.response_id = upstream_response_json.get("response_id", None)
+    except json.JSONDecodeError:
+        pass
+    return TRANSPORT_WSS
+
+
+async def async_process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                            response_format, messages, stream=True, context=None, conversation_request=None):
+    """
+    :param context: 对话请求已经发出时传入其处理上下文，此时 websocket 只用于接收该对话的后续消息
+    :param conversation_request: 已经构建好的 (对话请求, 准备阶段)，websocket 建立后直接发送
+    """
+    attach_only = context is not None
+    if context is None:
+        context = StreamState(messages, api_key, model, chat_message_id, response_format, stream)
+
+    logger.debug("start wss...")
+    async with get_session(use_proxy=True).ws_connect(wss_url, proxy=get_proxy()) as ws:
+        logger.debug("on_open: wss")
+        transport = TRANSPORT_WSS
+        if not attach_only:
+            if conversation_request is not None:
+                request, stages = conversation_request
+                upstream_response = None
+                if request is not None:
+                    upstream_response = await async_post_conversation_request(request, stages)
+            else:
+                upstream_response = await async_send_text_prompt_and_get_response(messages, api_key, True, model)
+            transport = await async_handle_conversation_response(context, upstream_response, data_queue, stop_event)
+            if transport is not None:
+                transport_negotiator.remember(BASE_URL, api_key, transport)
+
+        attach_deadline = asyncio.get_running_loop().time() + config.TRANSPORT_ATTACH_TIMEOUT
+        queue_proxy = ThreadSafeDataQueue(data_queue)
+        while transport == TRANSPORT_WSS and not stop_event.is_set():
+            if attach_only and not context.conversation_id:
+                # 补连之前上游已经推送完的对话无法再收到消息，超时后按上游错误结束
+                try:
+                    message = await asyncio.wait_for(ws.receive(),
+                                                     attach_deadline - asyncio.get_running_loop().time())
+                except asyncio.TimeoutError:
+                    logger.error("补连 websocket 后未收到对话消息")
+                    put_upstream_error(context, data_queue)
+                    stop_event.set()
+                    break
+            else:
+                message = await ws.receive()
+            if stop_event.is_set():
+                logger.info("接受到停止信号，停止 Websocket 处理协程")
+                break
+            if message.type == aiohttp.WSMsgType.TEXT:
+                if context.pending_images and is_final_frame(json.loads(message.data)):
+                    await await_pending_images(context)
+                if await run_processing(process_wss_message, context, message.data, queue_proxy, stop_event,
+                                        last_data_time):
+                    break
+                # 客户端读取过慢时暂停读取上游
+                await data_queue.wait_writable()
+            elif message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED,
+                                  aiohttp.WSMsgType.ERROR):
+                logger.error(f"wss closed: {ws.exception()}")
+                break
+    logger.debug("end wss...")
+
+    if context.is_sse:
+        logger.debug("process sse...")
+        await async_old_data_fetcher(context.upstream_response, data_queue, stop_event, last_data_time, api_key,
+                                     chat_message_id, model, response_format, stream)
+
+
+async def async_acquire_connection(api_key):
+    """
+    在线程池中等待长连接就绪，等待期间被取消时仍会在取得连接后将其释放
+    """
+    acquire_task = asyncio.ensure_future(asyncio.to_thread(websocket_manager.acquire, api_key))
+    try:
+        return await asyncio.shield(acquire_task)
+    except asyncio.CancelledError:
+        def release(task):
+            if not task.cancelled() and task.exception() is None:
+                task.result().release()
+
+        acquire_task.add_done_callback(release)
+        raise
+
+
+async def async_process_shared_wss(data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                                   response_format, messages, stream=True, context=None):
+    """
+    通过该账号共用的长连接 websocket 获取数据，长连接由 gpt.websocket_manager 的线程维护，
+    消息经 call_soon_threadsafe 转交到事件循环中处理
+    """
+    attach_only = context is not None
+    if context is None:
+        context = StreamState(messages, api_key, model, chat_message_id, response_format, stream)
+    if attach_only:
+        connection = await async_acquire_connection(api_key)
+    else:
+        # 建立 websocket 连接与构建对话请求（附件上传、arkose token）同时进行
+        stages = PrepareStages()
+        connection_future = stages.submit("websocket", websocket_manager.acquire, api_key)
+        try:
+            conversation_request = await asyncio.to_thread(build_conversation_request, messages, api_key, model,
+                                                           stages)
+            connection = await asyncio.wrap_future(connection_future)
+        except BaseException:
+            # 包括被取消的情况
+            release_connection_when_done(connection_future)
+            raise
+    generation = connection.generation
+    try:
+        if not attach_only:
+            upstream_response = None
+            if conversation_request is not None:
+                upstream_response = await async_post_conversation_request(conversation_request, stages)
+            transport = await async_handle_conversation_response(context, upstream_response, data_queue, stop_event)
+            if transport is not None:
+                transport_negotiator.remember(BASE_URL, api_key, transport)
+            if transport == TRANSPORT_SSE:
+                connection.release()
+                connection = None
+                logger.debug("process sse...")
+                await async_old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key,
+                                             chat_message_id, model, response_format, stream)
+                return
+            if transport is None:
+                return
+
+        loop = asyncio.get_running_loop()
+        # 与 process_shared_wss 一致，消息积压达到上限时放弃该对话
+        results = asyncio.Queue(config.STREAM_QUEUE_MAX_SIZE)
+        overflow = False
+
+        def put_result(result_json):
+            nonlocal overflow
+            if overflow:
+                return
+            try:
+                results.put_nowait(result_json)
+            except asyncio.QueueFull:
+                overflow = True
+
+        def sink(result_json):
+            loop.call_soon_threadsafe(put_result, result_json)
+
+        queue_proxy = ThreadSafeDataQueue(data_queue)
+        connection.subscribe(context.response_id, sink, generation)
+        try:
+            # 补连之前上游已经推送完的对话无法再收到消息，超时后按上游错误结束
+            timeout = config.TRANSPORT_ATTACH_TIMEOUT if attach_only else None
+            while not stop_event.is_set():
+                if overflow:
+                    logger.error("客户端读取过慢，websocket 消息积压超过 %d 条，停止接收", config.STREAM_QUEUE_MAX_SIZE)
+                    put_upstream_error(context, data_queue)
+                    stop_event.set()
+                    break
+                try:
+                    result_json = await asyncio.wait_for(results.get(), timeout)
+                except asyncio.TimeoutError:
+                    logger.error("补连 websocket 后未收到对话消息")
+                    put_upstream_error(context, data_queue)
+                    stop_event.set()
+                    break
+                if result_json is None:
+                    logger.error("wss 连接已断开")
+                    put_upstream_error(context, data_queue)
+                    stop_event.set()
+                    break
+                timeout = None
+                if context.pending_images and is_final_frame(result_json):
+                    await await_pending_images(context)
+                if await run_processing(process_wss_result, context, result_json, queue_proxy, stop_event,
+                                        last_data_time):
+                    break
+                # 客户端读取过慢时暂停读取
+                await data_queue.wait_writable()
+        finally:
+            connection.unsubscribe(context.response_id)
+    finally:
+        if connection is not None:
+            connection.release()
+
+
+async def async_old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id,
+                                 model, response_format, stream=True):
+    context = StreamState(None, api_key, model, chat_message_id, response_format, stream)
+    queue_proxy = ThreadSafeDataQueue(data_queue)
+    try:
+        # 每次取出已经到达的全部数据，多个事件一起交给线程池处理
+        async for chunk in upstream_response.content.iter_any():
+            if stop_event.is_set():
+                logger.info("接受到停止信号，停止数据处理协程")
+                break
+            if chunk:
+                # 在事件循环中切分事件，有完整的事件时才交给线程池处理
+                events = context.sse_decoder.feed(chunk)
+                if '[DONE]' in events:
+                    # 结束事件之前的事件可能提交了新的图片，先处理这些事件，再在事件循环中等待图片
+                    done_index = events.index('[DONE]')
+                    if done_index:
+                        await run_processing(process_sse_events, context, events[:done_index], queue_proxy,
+                                             stop_event, last_data_time)
+                    await await_pending_images(context)
+                    events = events[done_index:]
+                if events:
+                    await run_processing(process_sse_events, context, events, queue_proxy, stop_event, last_data_time)
+                await data_queue.wait_writable()
+        await await_pending_images(context)
+        await run_processing(finish_sse_text, context, queue_proxy, stop_event, last_data_time)
+    except asyncio.CancelledError:
+        # 客户端断开，直接关闭连接而不是读完剩余数据后放回连接池
+        upstream_response.close()
+        raise
+    except Exception as e:
+        put_stream_exception(context, data_queue, last_data_time, e)
+    finally:
+        upstream_response.release()
+
@@ -5,7 +5,6 @@ import os
 import re
 import threading
 import time
-from queue import Queue
 
 import requests
 import websocket
@@ -15,13 +14,19 @@ from flask_cors import cross_origin
 import config
 import gpt
 import init
-from auth import get_access_key, get_access_key_default
-from gpt import send_text_prompt_and_get_response, data_fetcher, keep_alive, count_tokens, count_total_input_words, \
-    save_image, replace_complete_citation, register_websocket
+from auth import get_access_key, get_access_key_default, acquire_access_key, token_refresher
+from gpt import send_text_prompt_and_get_response, data_fetcher, hedged_data_fetcher, get_keep_alive_frame, count_tokens, \
+    count_total_input_words, save_image, register_websocket, delete_conversation
 from init import app, logger
-from modules import models
+from modules import models, http_client
+from modules.arkose import arkose_pool
+from modules.account_pool import account_pool, NoAvailableAccountError
+from modules.coalescer import coalesce
+from modules.keep_alive import keep_alive_scheduler
 from modules.models import get_accessible_model_list, find_model_config
-from modules.utils import generate_unique_id, is_valid_citation_format, is_complete_citation_format
+from modules.executor import fetcher_executor, ExecutorRejectedError
+from modules.stream_control import StreamStopEvent, StreamQueue
+from modules.utils import generate_unique_id
 
 VERSION = '0.7.0'
 # VERSION = 'test'
@@ -51,6 +56,8 @@ with app.app_context():
         raise Exception('upstream_base_url is not set')
     else:
         logger.info(f"upstream_base_url: {config.BASE_URL}")
+    if len(config.UPSTREAM_BASE_URLS) > 1:
+        logger.info(f"upstream_base_urls: {config.UPSTREAM_BASE_URLS}")
     if not config.PROXY_API_PREFIX:
         logger.warning('upstream_api_prefix is not set')
     else:
@@ -117,6 +124,17 @@ with app.app_context():
     logger.info(f"The colo is: {ip_info['colo']}")
     logger.info(f"Is this ip a Warp ip: {ip_info['warp']}")
 
+    # 预先建立到上游的连接
+    http_client.warm_up(config.UPSTREAM_BASE_URLS)
+
+    # 后台预取 arkose token
+    if config.CUSTOM_ARKOSE:
+        arkose_pool.start()
+
+    # 后台提前刷新各账号的 access token
+    if config.TOKEN_REFRESH_ENABLED:
+        token_refresher.start()
+
     # 处理 websocket 连接
     # data_queue = Queue()
     # stop_event = threading.Event()
@@ -167,6 +185,144 @@ with app.app_context():
     # print(f"gpt-4-classic: {generate_gpts_payload('gpt-4-classic', [])}")
 
 
+def resolve_access_key(auth_header):
+    """
+    从 Authorization 请求头中解析 api_key，并从账号池中取得账号的 access_key
+    :return (access_key, account)，无法获取时返回 ("", None)，请求结束后需要调用 account_pool.release(account)；
+            没有可用账号时抛出 NoAvailableAccountError
+    """
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return "", None
+    api_key = auth_header.split(' ')[1]
+    logger.info(f"api_key: {api_key}")
+    # 将api_key转换为access_key
+    access_key, account = acquire_access_key(key=api_key)
+    if not access_key:
+        logger.info(f"api_key: {api_key} -> 无法获取到access key")
+        return "", None
+    return access_key, account
+
+
+def build_stop_chunk(chat_message_id, model):
+    timestamp = int(time.time())
+
+    new_data = {
+        "id": chat_message_id,
+        "object": "chat.completion.chunk",
+        "created": timestamp,
+        "model": model,
+        "choices": [
+            {
+                "delta": {},
+                "index": 0,
+                "finish_reason": "stop"
+            }
+        ]
+    }
+    return 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
+
+
+def build_chat_completion_response(model, messages, all_new_text):
+    # 构造响应的 JSON 结构
+    ori_model_name = ''
+    model_config = find_model_config(model)
+    if model_config:
+        ori_model_name = model_config.get('ori_name', model)
+    input_tokens = count_total_input_words(messages, ori_model_name)
+    comp_tokens = count_tokens(all_new_text, ori_model_name)
+    return {
+        "id": generate_unique_id("chatcmpl"),
+        "object": "chat.completion",
+        "created": int(time.time()),  # 使用当前时间戳
+        "model": model,  # 使用请求中指定的模型
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": all_new_text  # 使用累积的文本
+                },
+                "finish_reason": "stop"
+            }
+        ],
+        "usage": {
+            # 这里的 token 计数需要根据实际情况计算
+            "prompt_tokens": input_tokens,
+            "completion_tokens": comp_tokens,
+            "total_tokens": input_tokens + comp_tokens
+        },
+        "system_fingerprint": None
+    }
+
+
+def build_images_response(image_urls, all_new_text, response_format):
+    # 构造响应的 JSON 结构
+    response_json = {}
+    # 检查 image_urls 是否为空
+    if not image_urls:
+        response_json = {
+            "error": {
+                "message": all_new_text,  # 使用累积的文本作为错误信息
+                "type": "invalid_request_error",
+                "param": "",
+                "code": "image_generate_fail"
+            }
+        }
+    else:
+        if response_format == "url":
+            response_json = {
+                "created": int(time.time()),  # 使用当前时间戳
+                # "reply": all_new_text,  # 使用累积的文本
+                "data": [
+                    {
+                        "revised_prompt": all_new_text,  # 将描述文本加入每个字典
+                        "url": url
+                    } for url in image_urls
+                ]  # 将图片链接列表转换为所需格式
+            }
+        else:
+            response_json = {
+                "created": int(time.time()),  # 使用当前时间戳
+                # "reply": all_new_text,  # 使用累积的文本
+                "data": [
+                    {
+                        "revised_prompt": all_new_text,  # 将描述文本加入每个字典
+                        "b64_json": base64
+                    } for base64 in image_urls
+                ]  # 将图片链接列表转换为所需格式
+            }
+    return response_json
+
+
+def cancel_conversation(conversation_id, api_key):
+    """
+    客户端在收到完整响应前断开时调用，上游连接已由停止信号关闭，这里按配置在后台隐藏未完成的会话
+    """
+    logger.info(f"客户端已断开，停止上游会话: {conversation_id}")
+    if conversation_id:
+        threading.Thread(target=delete_conversation, args=(conversation_id, api_key), daemon=True).start()
+
+
+def start_data_fetcher(data_queue, stop_event, last_data_time, api_key, account, chat_message_id, model,
+                       response_format, messages, stream, hedge=False):
+    """
+    将数据处理任务提交到线程池，任务无论以何种方式结束都会向队列写入结束信号，消费端不会因上游异常而一直等待，
+    并在结束时将账号归还账号池
+    :param hedge: 是否使用对冲请求
+    :return Future，线程池已满时归还账号并抛出 ExecutorRejectedError
+    """
+    fetcher = hedged_data_fetcher if hedge else data_fetcher
+    try:
+        future = fetcher_executor.submit(fetcher, data_queue, stop_event, last_data_time, api_key,
+                                         chat_message_id, model, response_format, messages, stream)
+    except ExecutorRejectedError:
+        account_pool.release(account)
+        raise
+    future.add_done_callback(lambda f: account_pool.release(account))
+    future.add_done_callback(lambda f: data_queue.put('data: [DONE]\n\n'))
+    return future
+
+
 # 定义 Flask 路由
 @app.route(f'/{config.API_PREFIX}/v1/chat/completions' if config.API_PREFIX else '/v1/chat/completions', methods=['POST'])
 def chat_completions():
@@ -180,15 +336,11 @@ def chat_completions():
 
     stream = data.get('stream', False)
 
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Authorization header is missing or invalid"}), 401
-    api_key = auth_header.split(' ')[1]
-    logger.info(f"api_key: {api_key}")
-    # 将api_key转换为access_key
-    api_key = get_access_key(key=api_key)
+    try:
+        api_key, account = resolve_access_key(request.headers.get('Authorization'))
+    except NoAvailableAccountError:
+        return jsonify({"error": "No available upstream account, please try again later"}), 503
     if not api_key:
-        logger.info(f"api_key: {api_key} -> 无法获取到access key")
         return jsonify({"error": "Authorization header is missing or invalid"}), 401
 
     # upstream_response = send_text_prompt_and_get_response(messages, api_key, stream, model)
@@ -196,31 +348,36 @@ def chat_completions():
     # 在非流式响应的情况下，我们需要一个变量来累积所有的 new_text
     all_new_text = ""
 
+    stop_event = StreamStopEvent()
+    data_queue = StreamQueue(config.STREAM_QUEUE_MAX_SIZE, stop_event)
+    last_data_time = [time.time()]
+    chat_message_id = generate_unique_id("chatcmpl")
+
+    # 启动数据处理任务，在返回响应之前提交，以便线程池已满时直接返回错误
+    try:
+        start_data_fetcher(data_queue, stop_event, last_data_time, api_key, account, chat_message_id, model, "url",
+                           messages, stream, hedge=config.HEDGE_ENABLED)
+    except ExecutorRejectedError:
+        return jsonify({"error": "Server is busy, please try again later"}), 503
+
     # 处理流式响应
     def generate():
         nonlocal all_new_text  # 引用外部变量
-        data_queue = Queue()
-        stop_event = threading.Event()
-        last_data_time = [time.time()]
-        chat_message_id = generate_unique_id("chatcmpl")
 
         conversation_id_print_tag = False
 
         conversation_id = ''
+        completed = False
 
-        # 启动数据处理线程
-        fetcher_thread = threading.Thread(target=data_fetcher, args=(
-        data_queue, stop_event, last_data_time, api_key, chat_message_id, model, "url", messages))
-        fetcher_thread.start()
-
-        # 启动保活线程
-        keep_alive_thread = threading.Thread(target=keep_alive,
-                                             args=(last_data_time, stop_event, data_queue, model, chat_message_id))
-        keep_alive_thread.start()
+        # 注册到共用的保活调度器，非流式响应不需要保活
+        keep_alive_handle = None
+        if stream:
+            keep_alive_handle = keep_alive_scheduler.register(last_data_time, stop_event, data_queue,
+                                                              get_keep_alive_frame(model, chat_message_id))
 
         try:
-            while True:
-                data = data_queue.get()
+            # content 增量由 coalesce 合并编码为 chunk，其余数据原样产出
+            for data in coalesce(data_queue):
                 if isinstance(data, tuple) and data[0] == 'all_new_text':
                     # 更新 all_new_text
                     logger.info(f"完整消息: {data[1]}")
@@ -234,23 +391,8 @@ def chat_completions():
                     # print(f"收到会话id: {conversation_id}")
                 elif data == 'data: [DONE]\n\n':
                     # 接收到结束信号，退出循环
-                    timestamp = int(time.time())
-
-                    new_data = {
-                        "id": chat_message_id,
-                        "object": "chat.completion.chunk",
-                        "created": timestamp,
-                        "model": model,
-                        "choices": [
-                            {
-                                "delta": {},
-                                "index": 0,
-                                "finish_reason": "stop"
-                            }
-                        ]
-                    }
-                    q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                    yield q_data
+                    completed = True
+                    yield build_stop_chunk(chat_message_id, model)
 
                     logger.debug(f"会话结束-外层")
                     yield data
@@ -260,8 +402,10 @@ def chat_completions():
 
         finally:
             stop_event.set()
-            fetcher_thread.join()
-            keep_alive_thread.join()
+            if keep_alive_handle:
+                keep_alive_scheduler.unregister(keep_alive_handle)
+            if not completed:
+                cancel_conversation(conversation_id, api_key)
 
             # if conversation_id:
             #     # print(f"准备删除的会话id： {conversation_id}")
@@ -272,41 +416,13 @@ def chat_completions():
         # 迭代生成器对象以执行其内部逻辑
         for _ in generate():
             pass
-        # 构造响应的 JSON 结构
-        ori_model_name = ''
-        model_config = find_model_config(model)
-        if model_config:
-            ori_model_name = model_config.get('ori_name', model)
-        input_tokens = count_total_input_words(messages, ori_model_name)
-        comp_tokens = count_tokens(all_new_text, ori_model_name)
-        response_json = {
-            "id": generate_unique_id("chatcmpl"),
-            "object": "chat.completion",
-            "created": int(time.time()),  # 使用当前时间戳
-            "model": model,  # 使用请求中指定的模型
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": all_new_text  # 使用累积的文本
-                    },
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                # 这里的 token 计数需要根据实际情况计算
-                "prompt_tokens": input_tokens,
-                "completion_tokens": comp_tokens,
-                "total_tokens": input_tokens + comp_tokens
-            },
-            "system_fingerprint": None
-        }
-
         # 返回 JSON 响应
-        return jsonify(response_json)
+        return jsonify(build_chat_completion_response(model, messages, all_new_text))
     else:
-        return Response(generate(), mimetype='text/event-stream')
+        response = Response(generate(), mimetype='text/event-stream')
+        # 客户端在生成器开始迭代前断开时，generate 中的 finally 不会执行，需要在这里停止数据处理任务
+        response.call_on_close(stop_event.set)
+        return response
 
 
 @app.route(f'/{config.API_PREFIX}/v1/images/generations' if config.API_PREFIX else '/v1/images/generations', methods=['POST'])
@@ -329,15 +445,11 @@ def images_generations():
 
     # stream = data.get('stream', False)
 
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Authorization header is missing or invalid"}), 401
-    api_key = auth_header.split(' ')[1]
-    logger.info(f"api_key: {api_key}")
-    # 将api_key转换为access_key
-    api_key = get_access_key(key=api_key)
+    try:
+        api_key, account = resolve_access_key(request.headers.get('Authorization'))
+    except NoAvailableAccountError:
+        return jsonify({"error": "No available upstream account, please try again later"}), 503
     if not api_key:
-        logger.info(f"api_key: {api_key} -> 无法获取到access key")
         return jsonify({"error": "Authorization header is missing or invalid"}), 401
 
     image_urls = []
@@ -355,27 +467,27 @@ def images_generations():
     # 在非流式响应的情况下，我们需要一个变量来累积所有的 new_text
     all_new_text = ""
 
+    stop_event = StreamStopEvent()
+    data_queue = StreamQueue(config.STREAM_QUEUE_MAX_SIZE, stop_event)
+    last_data_time = [time.time()]
+    chat_message_id = generate_unique_id("chatcmpl")
+
+    # 启动数据处理任务
+    # 绘图接口只返回最终结果，按非流式模式处理且不需要保活
+    try:
+        start_data_fetcher(data_queue, stop_event, last_data_time, api_key, account, chat_message_id, model,
+                           response_format, messages, False)
+    except ExecutorRejectedError:
+        return jsonify({"error": "Server is busy, please try again later"}), 503
+
     # 处理流式响应
     def generate():
         nonlocal all_new_text  # 引用外部变量
-        data_queue = Queue()
-        stop_event = threading.Event()
-        last_data_time = [time.time()]
-        chat_message_id = generate_unique_id("chatcmpl")
 
         conversation_id_print_tag = False
 
         conversation_id = ''
-
-        # 启动数据处理线程
-        fetcher_thread = threading.Thread(target=data_fetcher, args=(
-        data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, messages))
-        fetcher_thread.start()
-
-        # 启动保活线程
-        keep_alive_thread = threading.Thread(target=keep_alive,
-                                             args=(last_data_time, stop_event, data_queue, model, chat_message_id))
-        keep_alive_thread.start()
+        completed = False
 
         try:
             while True:
@@ -397,6 +509,7 @@ def images_generations():
                     logger.debug(f"收到图片链接: {data[1]}")
                 elif data == 'data: [DONE]\n\n':
                     # 接收到结束信号，退出循环
+                    completed = True
                     logger.debug(f"会话结束-外层")
                     yield data
                     break
@@ -404,10 +517,10 @@ def images_generations():
                     yield data
 
         finally:
-            logger.critical(f"准备结束会话")
+            logger.debug(f"准备结束会话")
             stop_event.set()
-            fetcher_thread.join()
-            keep_alive_thread.join()
+            if not completed:
+                cancel_conversation(conversation_id, api_key)
 
             # if conversation_id:
             #     # print(f"准备删除的会话id： {conversation_id}")
@@ -417,45 +530,10 @@ def images_generations():
     # 迭代生成器对象以执行其内部逻辑
     for _ in generate():
         pass
-    # 构造响应的 JSON 结构
-    response_json = {}
-    # 检查 image_urls 是否为空
-    if not image_urls:
-        response_json = {
-            "error": {
-                "message": all_new_text,  # 使用累积的文本作为错误信息
-                "type": "invalid_request_error",
-                "param": "",
-                "code": "image_generate_fail"
-            }
-        }
-    else:
-        if response_format == "url":
-            response_json = {
-                "created": int(time.time()),  # 使用当前时间戳
-                # "reply": all_new_text,  # 使用累积的文本
-                "data": [
-                    {
-                        "revised_prompt": all_new_text,  # 将描述文本加入每个字典
-                        "url": url
-                    } for url in image_urls
-                ]  # 将图片链接列表转换为所需格式
-            }
-        else:
-            response_json = {
-                "created": int(time.time()),  # 使用当前时间戳
-                # "reply": all_new_text,  # 使用累积的文本
-                "data": [
-                    {
-                        "revised_prompt": all_new_text,  # 将描述文本加入每个字典
-                        "b64_json": base64
-                    } for base64 in image_urls
-                ]  # 将图片链接列表转换为所需格式
-            }
     # logger.critical(f"response_json: {response_json}")
 
     # 返回 JSON 响应
-    return jsonify(response_json)
+    return jsonify(build_images_response(image_urls, all_new_text, response_format))
 
 
 @app.after_request
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+
+import config
+from aio_gpt import AsyncDataQueue, async_data_fetcher, async_hedged_data_fetcher, close_sessions
+from gpt import get_keep_alive_frame, delete_conversation
+from app import app as flask_app, resolve_access_key, build_stop_chunk, build_chat_completion_response, \
+    build_images_response
+from init import logger
+from modules.account_pool import account_pool, NoAvailableAccountError
+from modules.coalescer import async_coalesce
+from modules.keep_alive import async_keep_alive_scheduler
+from modules.models import get_accessible_model_list
+from modules.stream_control import StreamStopEvent
+from modules.utils import generate_unique_id
+
+"""
+asyncio (ASGI) 执行模式入口
+
+对话与绘图接口在事件循环中以协程的方式处理上游数据，其余路由仍交给 Flask 应用处理。
+启动方式：uvicorn asgi:app
+"""
+
+CHAT_COMPLETIONS_PATH = f'/{config.API_PREFIX}/v1/chat/completions' if config.API_PREFIX else '/v1/chat/completions'
+IMAGES_GENERATIONS_PATH = f'/{config.API_PREFIX}/v1/images/generations' if config.API_PREFIX else '/v1/images/generations'
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,X-Requested-With'),
+    (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,OPTIONS'),
+]
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        if scope['path'] == CHAT_COMPLETIONS_PATH:
+            await chat_completions(scope, receive, send)
+            return
+        if scope['path'] == IMAGES_GENERATIONS_PATH:
+            await images_generations(scope, receive, send)
+            return
+    await wsgi_app(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_sessions()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def read_json_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body)
+
+
+def get_header(scope, name):
+    name = name.lower().encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode()
+    return None
+
+
+async def send_json(send, response_json, status=200):
+    body = json.dumps(response_json, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + CORS_HEADERS
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def prepare_request(scope, receive, send):
+    """
+    解析请求体并完成模型与鉴权校验
+    :return (data, access_key, account)，校验失败时已经写回错误响应并返回 (None, None, None)；
+            account 需要在请求结束后归还账号池
+    """
+    try:
+        data = await read_json_body(receive)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        await send_json(send, {"error": "invalid json body"}, 400)
+        return None, None, None
+    model = data.get('model')
+    accessible_model_list = get_accessible_model_list()
+    if model not in accessible_model_list:
+        await send_json(send, {"error": "model is not accessible"}, 401)
+        return None, None, None
+
+    # Redis 查询与登录均为阻塞操作，放到线程池中执行
+    try:
+        api_key, account = await asyncio.to_thread(resolve_access_key, get_header(scope, 'Authorization'))
+    except NoAvailableAccountError:
+        await send_json(send, {"error": "No available upstream account, please try again later"}, 503)
+        return None, None, None
+    if not api_key:
+        await send_json(send, {"error": "Authorization header is missing or invalid"}, 401)
+        return None, None, None
+    return data, api_key, account
+
+
+# 客户端断开时写入数据队列，通知消费端退出
+DISCONNECTED = object()
+
+
+async def watch_disconnect(receive, data_queue, stop_event, fetcher_task):
+    """
+    请求体读取完毕后，receive 只会在客户端断开时返回 http.disconnect
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            logger.info("客户端已断开，停止数据处理协程")
+            stop_event.set()
+            fetcher_task.cancel()
+            data_queue.put(DISCONNECTED)
+            return
+
+
+async def stream_upstream(receive, api_key, chat_message_id, model, response_format, messages, stream, hedge=False):
+    """
+    启动数据获取协程并注册保活，逐条产出队列中的数据，结束时负责清理
+    :param hedge: 是否使用对冲请求
+    """
+    stop_event = StreamStopEvent()
+    data_queue = AsyncDataQueue(config.STREAM_QUEUE_MAX_SIZE)
+    last_data_time = [time.time()]
+    conversation_id = ''
+    completed = False
+
+    fetcher = async_hedged_data_fetcher if hedge else async_data_fetcher
+    fetcher_task = asyncio.ensure_future(fetcher(
+        data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, messages, stream))
+    disconnect_task = asyncio.ensure_future(watch_disconnect(receive, data_queue, stop_event, fetcher_task))
+    # 非流式响应不需要保活
+    keep_alive_handle = None
+    if stream:
+        keep_alive_handle = async_keep_alive_scheduler.register(last_data_time, stop_event, data_queue,
+                                                                get_keep_alive_frame(model, chat_message_id))
+
+    try:
+        # content 增量由 async_coalesce 合并编码为 chunk，其余数据原样产出
+        async for data in async_coalesce(data_queue):
+            if data is DISCONNECTED:
+                break
+            if isinstance(data, tuple) and data[0] == 'conversation_id':
+                conversation_id = data[1]
+            yield data
+            if data == 'data: [DONE]\n\n':
+                completed = True
+                break
+    finally:
+        stop_event.set()
+        if keep_alive_handle:
+            async_keep_alive_scheduler.unregister(keep_alive_handle)
+        for task in (fetcher_task, disconnect_task):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(fetcher_task, disconnect_task, return_exceptions=True)
+        if not completed:
+            logger.info(f"客户端已断开，停止上游会话: {conversation_id}")
+            if conversation_id:
+                asyncio.ensure_future(asyncio.to_thread(delete_conversation, conversation_id, api_key))
+
+
+async def chat_completions(scope, receive, send):
+    logger.info("New Request")
+    data, api_key, account = await prepare_request(scope, receive, send)
+    if data is None:
+        return
+    try:
+        await handle_chat_completions(receive, send, data, api_key)
+    finally:
+        account_pool.release(account)
+
+
+async def handle_chat_completions(receive, send, data, api_key):
+    messages = data.get('messages')
+    model = data.get('model')
+    stream = data.get('stream', False)
+
+    all_new_text = ""
+    conversation_id_print_tag = False
+    chat_message_id = generate_unique_id("chatcmpl")
+
+    if stream:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + CORS_HEADERS
+        })
+
+    async for data in stream_upstream(receive, api_key, chat_message_id, model, "url", messages, stream,
+                                     hedge=config.HEDGE_ENABLED):
+        if isinstance(data, tuple) and data[0] == 'all_new_text':
+            logger.info(f"完整消息: {data[1]}")
+            all_new_text += data[1]
+        elif isinstance(data, tuple) and data[0] == 'conversation_id':
+            if conversation_id_print_tag == False:
+                logger.info(f"当前会话id: {data[1]}")
+                conversation_id_print_tag = True
+        elif data == 'data: [DONE]\n\n':
+            logger.debug("会话结束-外层")
+            if stream:
+                body = build_stop_chunk(chat_message_id, model) + data
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+        elif stream and isinstance(data, bytes):
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        elif stream and isinstance(data, str):
+            await send({'type': 'http.response.body', 'body': data.encode('utf-8'), 'more_body': True})
+
+    if stream:
+        await send({'type': 'http.response.body', 'body': b''})
+    else:
+        response_json = await asyncio.to_thread(build_chat_completion_response, model, messages, all_new_text)
+        await send_json(send, response_json)
+
+
+async def images_generations(scope, receive, send):
+    logger.info("New Img Request")
+    data, api_key, account = await prepare_request(scope, receive, send)
+    if data is None:
+        return
+    try:
+        await handle_images_generations(receive, send, data, api_key)
+    finally:
+        account_pool.release(account)
+
+
+async def handle_images_generations(receive, send, data, api_key):
+    logger.debug(f"data: {data}")
+    model = data.get('model')
+    prompt = config.DALLE_PROMPT_PREFIX + data.get('prompt', '')
+    # 获取请求中的response_format参数，默认为"url"
+    response_format = data.get('response_format', 'url')
+
+    messages = [
+        {
+            "role": "user",
+            "content": prompt,
+            "hasName": False
+        }
+    ]
+
+    all_new_text = ""
+    image_urls = []
+    chat_message_id = generate_unique_id("chatcmpl")
+
+    async for data in stream_upstream(receive, api_key, chat_message_id, model, response_format, messages, False):
+        if isinstance(data, tuple) and data[0] == 'all_new_text':
+            logger.info(f"完整消息: {data[1]}")
+            all_new_text += data[1]
+        elif isinstance(data, tuple) and data[0] == 'image_url':
+            image_urls.append(data[1])
+            logger.debug(f"收到图片链接: {data[1]}")
+
+    await send_json(send, build_images_response(image_urls, all_new_text, response_format))
@@ -1,45 +1,96 @@
-import requests
 import config
-from init import redis_client, logger
+from init import logger
+from modules import http_client
+from modules.cache import redis_cache
+from modules.account_pool import account_pool, NoAvailableAccountError
+from modules.token_refresher import TokenRefresher
+from modules.upstream import upstream_pool
 from urllib.parse import urlencode
 
 cache_key = "gpt_access_key:"
-ACCOUNT_CONFIG_USERNAME = config.ACCOUNT_CONFIG_USERNAME
-ACCOUNT_CONFIG_PASSWORD = config.ACCOUNT_CONFIG_PASSWORD
+
+# 账号登录失败后的隔离时间（秒）
+LOGIN_FAIL_QUARANTINE_SECONDS = 60
 
 
 def get_access_key(key):
     """
-    获取 access_key
+    获取 access_key，由账号池选择账号，不计入进行中的请求
     :return access_key
     """
 
     if key != config.KEY_FOR_GPTS_INFO:
         return ""
 
-    if not redis_client.exists(get_cache_name(key)):
-        url = config.BASE_URL + "/auth/token"
-
-        # option values: web, apple, platform, default: web
-        payload = urlencode({
-            "username": ACCOUNT_CONFIG_USERNAME,
-            "password": ACCOUNT_CONFIG_PASSWORD,
-            "option": "web"
-        })
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-
-        response = requests.request("POST", url, headers=headers, data=payload)
-        print(response.text)
-        if response.status_code == 200:
-            accessToken = response.json()['accessToken']
-            redis_client.set(get_cache_name(key), accessToken, exat=get_exat_unix(response.json()['expires']))
-            return accessToken
-        else:
-            logger.error(f"accessToken获取失败: {response.json()['msg']}，程序结束")
+    try:
+        return get_account_access_key(account_pool.pick())
+    except NoAvailableAccountError:
+        logger.error("没有可用的账号")
+        return ""
+
+
+def acquire_access_key(key):
+    """
+    为一次对话请求从账号池中取得账号与其 access_key，请求结束后需要调用 account_pool.release(account)
+    :return (access_key, account)，key 无效时返回 ("", None)，没有可用账号时抛出 NoAvailableAccountError
+    """
+
+    if key != config.KEY_FOR_GPTS_INFO:
+        return "", None
+
+    for _ in range(len(account_pool.accounts)):
+        account = account_pool.acquire()
+        access_key = get_account_access_key(account)
+        if access_key:
+            return access_key, account
+        account_pool.release(account)
+        account_pool.quarantine(account, LOGIN_FAIL_QUARANTINE_SECONDS, "login_failed")
+    raise NoAvailableAccountError("no available upstream account")
+
+
+def get_account_access_key(account):
+    """
+    获取指定账号的 access_key，缓存在 Redis 中，由 token_refresher 在过期前刷新
+    :return access_key，登录失败时返回 None
+    """
+    access_key = redis_cache.get(get_cache_name(account.username))
+    if access_key:
+        account.access_token = access_key.decode()
+        return account.access_token
+
+    # Redis 中没有可用的 access_key（首次启动或后台刷新失败），多个进程中只有一个去登录
+    access_key = token_refresher.wait_for_token(account)
+    if access_key:
+        account.access_token = access_key
+    return access_key
+
+
+def login_account(account):
+    """
+    登录账号并将 access_key 写入 Redis，直到过期
+    :return access_key，登录失败时返回 None
+    """
+
+    # option values: web, apple, platform, default: web
+    payload = urlencode({
+        "username": account.username,
+        "password": account.password,
+        "option": "web"
+    })
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+
+    response = upstream_pool.request(http_client.upstream, 'POST', "/auth/token", headers=headers, data=payload)
+    logger.debug(f"auth token response: {response.text}")
+    if response.status_code == 200:
+        accessToken = response.json()['accessToken']
+        redis_cache.set(get_cache_name(account.username), accessToken, exat=get_exat_unix(response.json()['expires']))
+        account.access_token = accessToken
+        return accessToken
     else:
-        return redis_client.get(get_cache_name(key)).decode()
+        logger.error(f"账号 {account.username} accessToken获取失败: {response.text}")
+        return None
 
 
 def get_access_key_default():
@@ -49,12 +100,15 @@ def get_access_key_default():
 def get_exat_unix(date_str):
     from datetime import datetime
     import time
-    return int(time.mktime(datetime.strptime(date_str[:-6], "%Y-%m-%dT%H:%M:%S").timetuple()))
+    return int(time.mktime(datetime.strptime(date_str[:19], "%Y-%m-%dT%H:%M:%S").timetuple()))
 
 
 def get_cache_name(key):
     return cache_key + key
 
 
+token_refresher = TokenRefresher(login_account, get_cache_name, account_pool.accounts, config.TOKEN_REFRESH_MARGIN,
+                                 config.TOKEN_REFRESH_CHECK_INTERVAL, config.TOKEN_REFRESH_LOCK_TIMEOUT)
+
 if __name__ == '__main__':
     print(get_exat_unix("2024-04-30T13:34:40.547Z"))
\ No newline at end of file
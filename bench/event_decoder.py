@@ -0,0 +1,202 @@
+"""
+上游消息解析耗时：完整解析与按需（延迟）解析 metadata 的对比
+
+分别构造普通文本、代码执行（metadata 中包含 aggregate_result）与联网搜索（metadata 中包含大量引用）三种消息流，
+比较以下几种解析方式解析一条消息并读取 process_data_json 处理普通增量时用到的字段的耗时：
+- json：标准库完整解析（默认）
+- orjson：orjson 完整解析（json_decoder 设置为 orjson，需要安装 orjson）
+- lazy：先跳过 message.metadata 解析其余部分，读取 metadata 时再解析。
+  纯 Python 实现需要逐个扫描 JSON 中的字符串与括号才能找到 metadata 的结尾，扫描本身比完整解析还慢；
+  process_data_json 每条消息都会读取 metadata 中的 citations、jit_plugin_data、model_slug，metadata 总会被解析
+- 下限：预先删除 metadata 后的完整解析，即完全不读取 metadata 时的耗时，任何延迟解析方式都不会低于该值
+
+用法：python bench/event_decoder.py
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.event_decoder import decode_event_orjson, orjson  # noqa: E402
+
+EVENTS = 400
+REPEAT = 5
+WORDS = "你好 世界 hello world data stream token 测试 中文".split()
+
+# JSON 中的字符串与括号
+TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+
+class LazyEvent(dict):
+    """
+    message.metadata 在第一次读取时才解析的上游消息
+    """
+
+    def __init__(self, data, metadata_span):
+        start, end = metadata_span
+        super().__init__(json.loads(data[:start] + "{}" + data[end:]))
+        self["message"]["metadata"] = LazyMetadata(data[start:end])
+
+
+class LazyMetadata(dict):
+
+    def __init__(self, raw):
+        super().__init__()
+        self._raw = raw
+
+    def get(self, key, default=None):
+        if self._raw is not None:
+            self.update(json.loads(self._raw))
+            self._raw = None
+        return super().get(key, default)
+
+
+def find_metadata(data):
+    """
+    :return message.metadata 的值在 data 中的起止位置
+    """
+    depth = 0
+    previous = None
+    start = None
+    for match in TOKEN_PATTERN.finditer(data):
+        token = match.group()
+        if token == "{" or token == "[":
+            depth += 1
+            if previous == '"metadata"' and depth == 3 and start is None:
+                start = match.start()
+        elif token == "}" or token == "]":
+            depth -= 1
+            if start is not None and depth == 2:
+                return start, match.end()
+        previous = token
+    return None
+
+
+def decode_lazy(data):
+    span = find_metadata(data)
+    return LazyEvent(data, span) if span else json.loads(data)
+
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def message(metadata, parts=None, role="assistant", name=None, content_type="text", text=None):
+    content = {"content_type": content_type}
+    if parts is not None:
+        content["parts"] = parts
+    if text is not None:
+        content["text"] = text
+    return json.dumps({
+        "message": {"id": "m1", "author": {"role": role, "name": name, "metadata": {}}, "create_time": 1.0,
+                    "update_time": None, "content": content, "status": "in_progress", "end_turn": None,
+                    "weight": 1.0, "metadata": metadata, "recipient": "all"},
+        "conversation_id": "c1", "error": None,
+    }, ensure_ascii=False)
+
+
+BASE_METADATA = {"citations": [], "gizmo_id": None, "message_type": "next", "model_slug": "gpt-4",
+                 "default_model_slug": "gpt-4", "pad": "AAAAAAAA", "parent_id": "p1"}
+
+
+def text_stream(rng):
+    text = ""
+    events = []
+    for _ in range(EVENTS):
+        text += words(rng, 2) + " "
+        events.append(message(BASE_METADATA, parts=[text]))
+    return events
+
+
+def code_stream(rng):
+    events = []
+    code = ""
+    jupyter_messages = []
+    for i in range(EVENTS):
+        code += "x = %d\n" % i
+        if i % 5 == 0:
+            jupyter_messages.append({"msg_type": "stream", "parent_header": {"msg_id": "id%d" % i, "version": "5.3"},
+                                     "content": {"name": "stdout", "text": words(rng, 8)}})
+        metadata = dict(BASE_METADATA, is_complete=True, aggregate_result={
+            "status": "running", "run_id": "r", "start_time": 1.0, "update_time": 2.0, "code": code,
+            "end_time": None, "final_expression_output": None, "in_kernel_exception": None,
+            "system_exception": None, "timeout_triggered": None, "jupyter_messages": jupyter_messages,
+            "messages": [{"message_type": "stream", "time": 1.0, "sender": "server", "stream_name": "stdout",
+                          "text": m["content"]["text"]} for m in jupyter_messages],
+        })
+        events.append(message(metadata, role="tool", name="python", content_type="execution_output",
+                              text=words(rng, 4 + i)))
+    return events
+
+
+def browsing_stream(rng):
+    citations = [{"start_ix": i * 10, "end_ix": i * 10 + 5, "citation_format_type": "tether_og", "metadata": {
+        "type": "webpage", "title": words(rng, 6), "url": "https://example.com/%d" % i, "text": words(rng, 60),
+        "pub_date": None, "extra": {"cited_message_idx": i, "search_result_idx": None, "evidence_text": "source"},
+    }} for i in range(12)]
+    metadata = dict(BASE_METADATA, citations=citations, command="search", args=["q"], status="finished",
+                    is_complete=True, _cite_metadata={"citation_format": {"name": "tether_og"},
+                                                      "metadata_list": [c["metadata"] for c in citations]})
+    text = ""
+    events = []
+    for _ in range(EVENTS):
+        text += words(rng, 2) + " "
+        events.append(message(metadata, parts=[text]))
+    return events
+
+
+def read_fields(data_json):
+    # process_data_json 处理普通增量时读取的字段，metadata 只读取 citations
+    message = data_json.get("message", {})
+    message.get("id")
+    message.get("status")
+    author = message.get("author", {})
+    author.get("role")
+    author.get("name")
+    content = message.get("content", {})
+    content.get("content_type")
+    content.get("parts", [])
+    content.get("text", "")
+    message.get("metadata", {}).get("citations", [])
+    data_json.get("conversation_id")
+
+
+def without_metadata(data):
+    data_json = json.loads(data)
+    data_json["message"]["metadata"] = {}
+    return json.dumps(data_json, ensure_ascii=False)
+
+
+def bench(events, decode):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for data in events:
+            read_fields(decode(data))
+        best = min(best, time.perf_counter() - start)
+    return best / len(events)
+
+
+def main():
+    rng = random.Random(1)
+    decoders = [("json", json.loads)]
+    if orjson is not None:
+        decoders.append(("orjson", decode_event_orjson))
+    decoders.append(("lazy", decode_lazy))
+    for name, events in (("text", text_stream(rng)), ("code", code_stream(rng)), ("browsing", browsing_stream(rng))):
+        for data in events[:20]:
+            expected = json.loads(data)["message"]["metadata"]["citations"]
+            assert decode_lazy(data)["message"]["metadata"].get("citations") == expected
+        size = sum(map(len, events)) / len(events)
+        results = [f"{label}={bench(events, decode) * 1e6:6.1f}us" for label, decode in decoders]
+        stripped = [without_metadata(data) for data in events]
+        results.append(f"下限={bench(stripped, json.loads) * 1e6:6.1f}us")
+        print(f"{name:8} {size:7.0f} 字符/条 " + " ".join(results))
+
+
+if __name__ == "__main__":
+    main()
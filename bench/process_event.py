@@ -0,0 +1,70 @@
+"""
+process_data_json 单条上游消息的处理耗时
+
+将 bench/fixtures 中录制的上游 SSE 响应解析为消息，逐条交给 process_data_json 处理并更新同一个 StreamState，
+分别测试流式（逐条构造 chunk）与非流式（只累积完整文本）两种模式。
+需要在仓库根目录运行，gpt 模块启动时读取 data/config.json。
+
+用法：python bench/process_event.py [录制文件 ...]
+"""
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gpt  # noqa: E402
+from modules.sse import SSEDecoder  # noqa: E402
+from modules.stream_state import StreamState  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+REPEAT = 15
+
+
+class ListQueue(list):
+    def put(self, item):
+        self.append(item)
+
+
+class NeverSet:
+    def is_set(self):
+        return False
+
+
+def load_events(path):
+    with open(path, "rb") as f:
+        data = SSEDecoder().feed(f.read())
+    return [json.loads(item) for item in data if item != "[DONE]"]
+
+
+def bench(events, stream):
+    """
+    :return 最快一次的平均每条消息耗时（秒）
+    """
+    stop_event = NeverSet()
+    best = float("inf")
+    for _ in range(REPEAT):
+        context = StreamState(None, "sk-bench", "gpt-4", "chatcmpl-bench", "url", stream)
+        data_queue = ListQueue()
+        last_data_time = [0]
+        start = time.perf_counter()
+        for data_json in events:
+            gpt.process_data_json(context, data_json, data_queue, stop_event, last_data_time)
+        best = min(best, time.perf_counter() - start)
+    return best / len(events)
+
+
+def main(paths):
+    logging.getLogger().setLevel(logging.WARNING)
+    for path in paths:
+        events = load_events(path)
+        print(f"{os.path.basename(path)} ({len(events)} 条消息)")
+        for stream in (True, False):
+            print(f"  stream={str(stream):5} {bench(events, stream) * 1e6:6.2f} us/event")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.sse"))))
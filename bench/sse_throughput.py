@@ -0,0 +1,58 @@
+"""
+SSEDecoder 吞吐量测试
+
+使用 bench/fixtures 中录制的上游 SSE 响应，按不同的数据块大小逐段交给 SSEDecoder 解析，
+分别测试 \\n 换行与 \\r\\n 换行（由 \\n 换行的录制数据转换得到）的吞吐量。
+
+用法：python bench/sse_throughput.py [录制文件 ...]
+"""
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.sse import SSEDecoder  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CHUNK_SIZES = (64, 1024, 8192)
+REPEAT = 5
+
+
+def decode_all(stream, chunk_size):
+    decoder = SSEDecoder()
+    events = 0
+    for i in range(0, len(stream), chunk_size):
+        events += len(decoder.feed(stream[i:i + chunk_size]))
+    return events
+
+
+def bench(stream, chunk_size):
+    """
+    :return (事件数, 最快一次的耗时)
+    """
+    best = float("inf")
+    events = 0
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        events = decode_all(stream, chunk_size)
+        best = min(best, time.perf_counter() - start)
+    return events, best
+
+
+def main(paths):
+    for path in paths:
+        with open(path, "rb") as f:
+            recorded = f.read()
+        streams = (("LF", recorded), ("CRLF", recorded.replace(b"\n", b"\r\n")))
+        print(f"{os.path.basename(path)} ({len(recorded)} 字节)")
+        for newline, stream in streams:
+            for chunk_size in CHUNK_SIZES:
+                events, seconds = bench(stream, chunk_size)
+                print(f"  {newline:4} chunk={chunk_size:5} events={events} "
+                      f"{len(stream) / seconds / 1e6:7.1f} MB/s {seconds / events * 1e6:6.2f} us/event")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.sse"))))
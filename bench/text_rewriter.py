@@ -0,0 +1,78 @@
+"""
+TextRewriter 性能测试
+
+模拟上游逐段返回的回复文本，测试每段增量的处理耗时：
+普通回答、含引用标记与沙箱链接的回答（3 个字符一段），以及长时间未闭合的沙箱链接（暂存文本持续增长）。
+
+用法：python bench/text_rewriter.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.text_rewriter import TextRewriter  # noqa: E402
+
+REPEAT = 5
+
+
+def replace_citation(number):
+    return f"[[{number}](https://example.com/{number})]"
+
+
+def replace_sandbox(path):
+    return f"(https://example.com/files{path})"
+
+
+def answer(rng, words, mark_ratio):
+    pieces = []
+    for _ in range(words):
+        r = rng.random()
+        if r < mark_ratio:
+            pieces.append(f"【{rng.randint(0, 9)}†source】")
+        elif r < mark_ratio * 3:
+            pieces.append("(see note)")
+        elif r < mark_ratio * 3.1:
+            pieces.append("(sandbox:/mnt/data/out.csv)")
+        else:
+            pieces.append(rng.choice(("word", "你好", "stream", "测试")))
+    return " ".join(pieces)
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def scenarios():
+    rng = random.Random(7)
+    plain = answer(rng, 4000, 0)
+    marked = answer(rng, 4000, 0.01)
+    return [
+        ("普通回答", split(plain, 3)),
+        ("引用与沙箱链接", split(marked, 3)),
+        ("引用与沙箱链接 (1 字符)", split(marked, 1)),
+        ("未闭合的沙箱链接", ["(sandbox:/mnt/data/"] + ["x"] * 3000 + [")"]),
+    ]
+
+
+def run(deltas):
+    rewriter = TextRewriter()
+    for delta in deltas:
+        rewriter.feed(delta, replace_citation, replace_sandbox)
+    rewriter.flush()
+
+
+def main():
+    for name, deltas in scenarios():
+        best = float("inf")
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            run(deltas)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:20} deltas={len(deltas):6} {best * 1e3:7.2f} ms {best / len(deltas) * 1e6:6.3f} us/delta")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,36 @@ CONFIG = load_config('./data/config.json')
 
 LOG_LEVEL = CONFIG.get('log_level', 'DEBUG').upper()
 NEED_LOG_TO_FILE = CONFIG.get('need_log_to_file', 'true').lower() == 'true'
+# 日志由后台线程写入文件与控制台
+LOG_ASYNC = CONFIG.get('log_async', 'true').lower() == 'true'
+# 输出逐条流式数据日志（上游原始数据、每段发送的文本）的会话比例
+LOG_STREAM_TRACE_SAMPLE_RATE = float(CONFIG.get('log_stream_trace_sample_rate', 0.1))
 
 # 使用 get 方法获取配置项，同时提供默认值
 BASE_URL = CONFIG.get('upstream_base_url', '')
 PROXY_API_PREFIX = CONFIG.get('upstream_api_prefix', '')
 if PROXY_API_PREFIX != '':
     PROXY_API_PREFIX = "/" + PROXY_API_PREFIX
+# 多个上游实例，逗号分隔，为空时只使用 upstream_base_url
+UPSTREAM_BASE_URLS = [url.strip() for url in CONFIG.get('upstream_base_urls', '').split(',') if url.strip()]
+if BASE_URL and BASE_URL not in UPSTREAM_BASE_URLS:
+    UPSTREAM_BASE_URLS.insert(0, BASE_URL)
+if not BASE_URL and UPSTREAM_BASE_URLS:
+    BASE_URL = UPSTREAM_BASE_URLS[0]
+UPSTREAM_CIRCUIT_BREAKER_CONFIG = CONFIG.get('upstream_circuit_breaker', {})
+UPSTREAM_CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(UPSTREAM_CIRCUIT_BREAKER_CONFIG.get('failure_threshold', 3))
+UPSTREAM_CIRCUIT_BREAKER_OPEN_SECONDS = float(UPSTREAM_CIRCUIT_BREAKER_CONFIG.get('open_seconds', 30))
+UPSTREAM_CIRCUIT_BREAKER_WINDOW = int(UPSTREAM_CIRCUIT_BREAKER_CONFIG.get('window', 50))
+# 对冲请求：主请求迟迟没有数据时再向其他上游实例发起一次相同的请求
+HEDGE_CONFIG = CONFIG.get('hedge', {})
+HEDGE_ENABLED = HEDGE_CONFIG.get('enabled', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(HEDGE_CONFIG.get('percentile', 95))
+HEDGE_MIN_DELAY = float(HEDGE_CONFIG.get('min_delay', 1))
+HEDGE_MAX_DELAY = float(HEDGE_CONFIG.get('max_delay', 5))
+HEDGE_WINDOW = int(HEDGE_CONFIG.get('window', 200))
+HEDGE_BUDGET_RATIO = float(HEDGE_CONFIG.get('budget_ratio', 0.1))
+HEDGE_BUDGET_BURST = float(HEDGE_CONFIG.get('budget_burst', 10))
+HEDGE_MAX_WORKERS = int(HEDGE_CONFIG.get('max_workers', 128))
 UPLOAD_BASE_URL = CONFIG.get('backend_container_url', '')
 KEY_FOR_GPTS_INFO = CONFIG.get('key_for_gpts_info', '')
 API_PREFIX = CONFIG.get('backend_container_api_prefix', '')
@@ -40,8 +64,79 @@ CUSTOM_ARKOSE = CONFIG.get('custom_arkose_url', 'false').lower() == 'true'
 
 ARKOSE_URLS = CONFIG.get('arkose_urls', "")
 
+# Arkose Token 预取池配置
+ARKOSE_POOL_CONFIG = CONFIG.get('arkose_pool', {})
+ARKOSE_POOL_SIZE = int(ARKOSE_POOL_CONFIG.get('size', 2))
+ARKOSE_POOL_TOKEN_TTL = float(ARKOSE_POOL_CONFIG.get('token_ttl', 90))
+ARKOSE_POOL_REQUEST_TIMEOUT = float(ARKOSE_POOL_CONFIG.get('request_timeout', 10))
+ARKOSE_POOL_HEDGE_DELAY = float(ARKOSE_POOL_CONFIG.get('hedge_delay', 1.5))
+
 DALLE_PROMPT_PREFIX = CONFIG.get('dalle_prompt_prefix', '')
 
+# 单个请求的数据队列上限，客户端读取过慢时上游读取会暂停
+STREAM_QUEUE_MAX_SIZE = int(CONFIG.get('stream_queue_max_size', 256))
+# 流式响应 chunk 的 JSON 序列化实现，可选 json、orjson
+JSON_ENCODER = CONFIG.get('json_encoder', 'json').lower()
+# 上游消息的 JSON 解析实现，可选 json、orjson
+JSON_DECODER = CONFIG.get('json_decoder', 'json').lower()
+
+# 流式响应增量合并配置
+STREAM_COALESCE_CONFIG = CONFIG.get('stream_coalesce', {})
+STREAM_COALESCE_ENABLED = STREAM_COALESCE_CONFIG.get('enabled', 'true').lower() == 'true'
+STREAM_COALESCE_MAX_DELAY = float(STREAM_COALESCE_CONFIG.get('max_delay', 0.03))
+STREAM_COALESCE_MAX_CHARS = int(STREAM_COALESCE_CONFIG.get('max_chars', 2048))
+
+# HTTP 连接池配置
+HTTP_CLIENT_CONFIG = CONFIG.get('http_client', {})
+HTTP_CLIENT_POOL_CONNECTIONS = int(HTTP_CLIENT_CONFIG.get('pool_connections', 10))
+HTTP_CLIENT_POOL_MAXSIZE = int(HTTP_CLIENT_CONFIG.get('pool_maxsize', 64))
+HTTP_CLIENT_CONNECT_TIMEOUT = float(HTTP_CLIENT_CONFIG.get('connect_timeout', 10))
+HTTP_CLIENT_READ_TIMEOUT = float(HTTP_CLIENT_CONFIG.get('read_timeout', 60))
+HTTP_CLIENT_STREAM_READ_TIMEOUT = float(HTTP_CLIENT_CONFIG.get('stream_read_timeout', 600))
+HTTP_CLIENT_DNS_CACHE_TTL = float(HTTP_CLIENT_CONFIG.get('dns_cache_ttl', 300))
+HTTP_CLIENT_DNS_CACHE_MAX_SIZE = int(HTTP_CLIENT_CONFIG.get('dns_cache_max_size', 256))
+HTTP_CLIENT_WARM_UP = HTTP_CLIENT_CONFIG.get('warm_up', 'true').lower() == 'true'
+
+# 上游数据处理线程池配置
+FETCHER_POOL_CONFIG = CONFIG.get('fetcher_pool', {})
+FETCHER_POOL_MAX_WORKERS = int(FETCHER_POOL_CONFIG.get('max_workers', 64))
+FETCHER_POOL_QUEUE_SIZE = int(FETCHER_POOL_CONFIG.get('queue_size', 64))
+FETCHER_POOL_REJECTION_POLICY = FETCHER_POOL_CONFIG.get('rejection_policy', 'reject')
+FETCHER_POOL_BLOCK_TIMEOUT = float(FETCHER_POOL_CONFIG.get('block_timeout', 30))
+
+# 回复中图片的获取与下载线程池配置
+IMAGE_POOL_CONFIG = CONFIG.get('image_pool', {})
+IMAGE_POOL_MAX_WORKERS = int(IMAGE_POOL_CONFIG.get('max_workers', 8))
+IMAGE_POOL_QUEUE_SIZE = int(IMAGE_POOL_CONFIG.get('queue_size', 32))
+IMAGE_POOL_WAIT_TIMEOUT = float(IMAGE_POOL_CONFIG.get('wait_timeout', 60))
+
+# 对话请求准备阶段（websocket 连接、附件上传、arkose token）的线程池配置
+PREPARE_POOL_CONFIG = CONFIG.get('prepare_pool', {})
+PREPARE_POOL_MAX_WORKERS = int(PREPARE_POOL_CONFIG.get('max_workers', 32))
+
+# asgi 模式下处理上游数据的线程池配置
+PROCESS_POOL_CONFIG = CONFIG.get('process_pool', {})
+PROCESS_POOL_MAX_WORKERS = int(PROCESS_POOL_CONFIG.get('max_workers', 32))
+
+# 上游返回方式探测配置
+TRANSPORT_CONFIG = CONFIG.get('transport', {})
+TRANSPORT_PROBE_INTERVAL = float(TRANSPORT_CONFIG.get('probe_interval', 600))
+TRANSPORT_ATTACH_TIMEOUT = float(TRANSPORT_CONFIG.get('attach_timeout', 10))
+
+# websocket 长连接配置
+WEBSOCKET_CONFIG = CONFIG.get('websocket', {})
+WEBSOCKET_PERSISTENT = WEBSOCKET_CONFIG.get('persistent', 'true').lower() == 'true'
+WEBSOCKET_PING_INTERVAL = float(WEBSOCKET_CONFIG.get('ping_interval', 20))
+WEBSOCKET_PING_TIMEOUT = float(WEBSOCKET_CONFIG.get('ping_timeout', 10))
+WEBSOCKET_IDLE_TIMEOUT = float(WEBSOCKET_CONFIG.get('idle_timeout', 300))
+WEBSOCKET_CONNECT_TIMEOUT = float(WEBSOCKET_CONFIG.get('connect_timeout', 30))
+WEBSOCKET_RECONNECT_ATTEMPTS = int(WEBSOCKET_CONFIG.get('reconnect_attempts', 3))
+
+# 保活配置
+KEEP_ALIVE_CONFIG = CONFIG.get('keep_alive', {})
+KEEP_ALIVE_INTERVAL = float(KEEP_ALIVE_CONFIG.get('interval', 1))
+KEEP_ALIVE_USE_COMMENT_FRAME = KEEP_ALIVE_CONFIG.get('use_comment_frame', 'false').lower() == 'true'
+
 # redis配置读取
 REDIS_CONFIG = CONFIG.get('redis', {})
 REDIS_CONFIG_HOST = REDIS_CONFIG.get('host', 'redis')
@@ -51,11 +146,31 @@ REDIS_CONFIG_DB = REDIS_CONFIG.get('db', 0)
 REDIS_CONFIG_POOL_SIZE = REDIS_CONFIG.get('pool_size', 10)
 REDIS_CONFIG_POOL_TIMEOUT = REDIS_CONFIG.get('pool_timeout', 30)
 
+# Redis 前的进程内缓存配置
+L1_CACHE_CONFIG = CONFIG.get('l1_cache', {})
+L1_CACHE_MAX_TTL = float(L1_CACHE_CONFIG.get('max_ttl', 30))
+L1_CACHE_MAX_ENTRIES = int(L1_CACHE_CONFIG.get('max_entries', 1024))
+L1_CACHE_KEYSPACE_NOTIFICATIONS = L1_CACHE_CONFIG.get('keyspace_notifications', 'false').lower() == 'true'
+
 # 账号配置
 ACCOUNT_CONFIG = CONFIG.get('account', {})
 ACCOUNT_CONFIG_USERNAME = ACCOUNT_CONFIG.get('username', '')
 ACCOUNT_CONFIG_PASSWORD = ACCOUNT_CONFIG.get('password', '')
 
+# 账号池配置，accounts 为空时使用上面的 account
+ACCOUNTS_CONFIG = CONFIG.get('accounts', [])
+ACCOUNT_POOL_CONFIG = CONFIG.get('account_pool', {})
+ACCOUNT_POOL_STRATEGY = ACCOUNT_POOL_CONFIG.get('strategy', 'least_in_flight')
+ACCOUNT_POOL_MODEL_CAP_QUARANTINE_SECONDS = float(ACCOUNT_POOL_CONFIG.get('model_cap_quarantine_seconds', 3600))
+ACCOUNT_POOL_DEACTIVATED_QUARANTINE_SECONDS = float(ACCOUNT_POOL_CONFIG.get('deactivated_quarantine_seconds', 86400))
+
+# access token 后台刷新配置
+TOKEN_REFRESH_CONFIG = CONFIG.get('token_refresh', {})
+TOKEN_REFRESH_ENABLED = TOKEN_REFRESH_CONFIG.get('enabled', 'true').lower() == 'true'
+TOKEN_REFRESH_MARGIN = float(TOKEN_REFRESH_CONFIG.get('margin_seconds', 3600))
+TOKEN_REFRESH_CHECK_INTERVAL = float(TOKEN_REFRESH_CONFIG.get('check_interval', 60))
+TOKEN_REFRESH_LOCK_TIMEOUT = float(TOKEN_REFRESH_CONFIG.get('lock_timeout', 30))
+
 # proxy配置（主要是代理wss）
 PROXY_CONFIG = CONFIG.get('proxy', {})
 PROXY_CONFIG_ENABLED = PROXY_CONFIG.get('enabled', 'false') == 'true'
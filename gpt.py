@@ -1,12 +1,15 @@
 import base64
+import contextvars
 import io
 import json
 import os
-import re
+import threading
 import time
 import urllib.parse
 import uuid
+from concurrent.futures import wait
 from datetime import datetime
+from queue import Queue, Empty, Full
 from urllib.parse import unquote
 
 import requests
@@ -17,11 +20,23 @@ from PIL import Image
 import config
 import init
 from init import logger
-from modules import ua
+from modules import ua, http_client
+from modules.account_pool import account_pool
+from modules.arkose import arkose_pool
+from modules.pipeline import PrepareStages
+from modules.upstream import upstream_pool, RequestRoute, request_route
+from modules.hedge import hedge_policy
+from modules.executor import hedge_executor, ExecutorRejectedError
+from modules.image_pool import PendingImage, submit_image_task
+from modules.stream_control import StreamStopEvent, StreamQueue
+from modules.stream_state import StreamState, parts_delta
+from modules.coalescer import DELTA
+from modules.event_decoder import decode_event
+from modules.sse import decode_frame_body
 from modules.files import get_file_metadata, my_files_types
 from modules.models import find_model_config, generate_gpts_payload
-from modules.utils import is_valid_citation_format, is_complete_citation_format, \
-    is_valid_sandbox_combined_corrected_final_v2, is_complete_sandbox_format
+from modules.transport import transport_negotiator, TRANSPORT_SSE, TRANSPORT_WSS
+from modules.wss_manager import WebSocketManager
 
 BASE_URL = config.BASE_URL
 PROXY_API_PREFIX = config.PROXY_API_PREFIX
@@ -31,7 +46,7 @@ PROXIES = config.PROXIES
 # 解析响应中的信息
 def parse_oai_ip_info():
     tmp_ua = ua.random
-    res = requests.get("https://auth0.openai.com/cdn-cgi/trace", headers={"User-Agent":tmp_ua}, proxies=PROXIES)
+    res = http_client.external.get("https://auth0.openai.com/cdn-cgi/trace", headers={"User-Agent":tmp_ua})
     lines = res.text.strip().split("\n")
     info_dict = {line.split('=')[0]: line.split('=')[1] for line in lines if '=' in line}
     return {key: info_dict[key] for key in ["ip", "loc", "colo", "warp"] if key in info_dict}
@@ -39,38 +54,76 @@ def parse_oai_ip_info():
 
 # 定义获取 token 的函数
 def get_token():
-    # 从环境变量获取 URL 列表，并去除每个 URL 周围的空白字符
-    api_urls = [url.strip() for url in config.ARKOSE_URLS.split(",")]
+    """
+    从预取池中获取 arkose token，池为空时对 arkose_urls 发起对冲请求
+    """
+    return arkose_pool.get()
 
-    for url in api_urls:
-        if not url:
-            continue
 
-        full_url = f"{url}/api/arkose/token"
-        payload = {'type': 'gpt-4'}
+# 定义发送请求的函数
+def send_text_prompt_and_get_response(messages, api_key, stream, model, stages=None):
+    if stages is None:
+        stages = PrepareStages()
+    conversation_request = build_conversation_request(messages, api_key, model, stages)
+    if conversation_request is None:
+        return None
+    return post_conversation_request(conversation_request, stages)
+
 
+def post_conversation_request(conversation_request, stages):
+    """
+    所有准备阶段汇合后发送对话请求
+    """
+    stages.log_timings()
+    path, headers, payload = conversation_request
+    response = upstream_pool.request(http_client.upstream, 'POST', path, headers=headers, json=payload, stream=True,
+                                     timeout=http_client.STREAM_TIMEOUT)
+    # print(response)
+    return response
+
+
+def load_attachment(file_url, api_key):
+    """
+    下载（或解码）并上传一个 image_url 附件
+    :return file_metadata，文件获取失败时返回 None
+    """
+    if file_url.startswith('data:'):
+        # 处理 base64 编码的文件数据
+        mime_type, base64_data = file_url.split(';')[0], file_url.split(',')[1]
+        mime_type = mime_type.split(':')[1]
         try:
-            response = requests.post(full_url, data=payload)
-            if response.status_code == 200:
-                token = response.json().get('token')
-                # 确保 token 字段存在且不是 None 或空字符串
-                if token:
-                    logger.debug(f"成功从 {url} 获取 arkose token")
-                    return token
-                else:
-                    logger.error(f"获取的 token 响应无效: {token}")
-            else:
-                logger.error(f"获取 arkose token 失败: {response.status_code}, {response.text}")
-        except requests.RequestException as e:
-            logger.error(f"请求异常: {e}")
+            file_content = base64.b64decode(base64_data)
+        except Exception as e:
+            logger.error(f"类型为 {mime_type} 的 base64 编码数据解码失败: {e}")
+            return None
+    else:
+        # 处理普通的文件URL
+        try:
+            tmp_user_agent = ua.random
+            logger.debug(f"随机 User-Agent: {tmp_user_agent}")
+            tmp_headers = {
+                'User-Agent': tmp_user_agent
+            }
+            file_response = http_client.external.get(url=file_url, headers=tmp_headers)
+            file_content = file_response.content
+            mime_type = file_response.headers.get('Content-Type', '').split(';')[0].strip()
+        except Exception as e:
+            logger.error(f"获取文件 {file_url} 失败: {e}")
+            return None
 
-    raise Exception("获取 arkose token 失败")
-    return None
+    logger.debug(f"mime_type: {mime_type}")
+    return get_file_metadata(file_content, mime_type, api_key, upstream_pool.base_url(), PROXY_API_PREFIX)
 
 
-# 定义发送请求的函数
-def send_text_prompt_and_get_response(messages, api_key, stream, model):
-    url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/conversation"
+# 构建对话请求的 path、headers 与 payload，同步与异步执行模式共用
+def build_conversation_request(messages, api_key, model, stages=None):
+    """
+    :param stages: 本次请求的准备阶段，附件与 arkose token 在其中并行获取
+    """
+    if stages is None:
+        stages = PrepareStages()
+    # 路径不含上游实例地址，发送时再选择实例
+    path = f"{PROXY_API_PREFIX}/backend-api/conversation"
 
     headers = {
         "Authorization": f"Bearer {api_key}"
@@ -82,9 +135,22 @@ def send_text_prompt_and_get_response(messages, api_key, stream, model):
         # 检查是否有 ori_name
         ori_model_name = model_config.get('ori_name', model)
 
+    if model_config and ori_model_name != 'gpt-3.5-turbo' and config.CUSTOM_ARKOSE:
+        stages.submit("arkose", get_token)
+
+    # 先提交所有附件，并行下载与上传
+    attachment_futures = {}
+    for message_index, message in enumerate(messages):
+        content = message.get("content")
+        if isinstance(content, list) and ori_model_name != 'gpt-3.5-turbo':
+            for part_index, part in enumerate(content):
+                if isinstance(part, dict) and part.get("type") == "image_url":
+                    attachment_futures[(message_index, part_index)] = stages.submit(
+                        f"attachment_{len(attachment_futures)}", load_attachment, part["image_url"]["url"], api_key)
+
     formatted_messages = []
     # logger.debug(f"原始 messages: {messages}")
-    for message in messages:
+    for message_index, message in enumerate(messages):
         message_id = str(uuid.uuid4())
         content = message.get("content")
 
@@ -94,39 +160,15 @@ def send_text_prompt_and_get_response(messages, api_key, stream, model):
             attachments = []
             contains_image = False  # 标记是否包含图片
 
-            for part in content:
+            for part_index, part in enumerate(content):
                 if isinstance(part, dict) and "type" in part:
                     if part["type"] == "text":
                         new_parts.append(part["text"])
                     elif part["type"] == "image_url":
                         # logger.debug(f"image_url: {part['image_url']}")
-                        file_url = part["image_url"]["url"]
-                        if file_url.startswith('data:'):
-                            # 处理 base64 编码的文件数据
-                            mime_type, base64_data = file_url.split(';')[0], file_url.split(',')[1]
-                            mime_type = mime_type.split(':')[1]
-                            try:
-                                file_content = base64.b64decode(base64_data)
-                            except Exception as e:
-                                logger.error(f"类型为 {mime_type} 的 base64 编码数据解码失败: {e}")
-                                continue
-                        else:
-                            # 处理普通的文件URL
-                            try:
-                                tmp_user_agent = ua.random
-                                logger.debug(f"随机 User-Agent: {tmp_user_agent}")
-                                tmp_headers = {
-                                    'User-Agent': tmp_user_agent
-                                }
-                                file_response = requests.get(url=file_url, headers=tmp_headers, proxies=config.PROXIES)
-                                file_content = file_response.content
-                                mime_type = file_response.headers.get('Content-Type', '').split(';')[0].strip()
-                            except Exception as e:
-                                logger.error(f"获取文件 {file_url} 失败: {e}")
-                                continue
-
-                        logger.debug(f"mime_type: {mime_type}")
-                        file_metadata = get_file_metadata(file_content, mime_type, api_key, BASE_URL, PROXY_API_PREFIX)
+                        file_metadata = attachment_futures[(message_index, part_index)].result()
+                        if file_metadata is None:
+                            continue
 
                         mime_type = file_metadata["mimeType"]
                         logger.debug(f"处理后 mime_type: {mime_type}")
@@ -170,7 +212,7 @@ def send_text_prompt_and_get_response(messages, api_key, stream, model):
                 "metadata": {"attachments": attachments}
             }
             formatted_messages.append(formatted_message)
-            logger.critical(f"formatted_message: {formatted_message}")
+            logger.debug("formatted_message: %s", formatted_message)
 
         else:
             # 处理单个文本消息的情况
@@ -256,15 +298,13 @@ def send_text_prompt_and_get_response(messages, api_key, stream, model):
             payload['history_and_training_disabled'] = True
         if ori_model_name != 'gpt-3.5-turbo':
             if config.CUSTOM_ARKOSE:
-                token = get_token()
+                token = stages.result("arkose")
                 payload["arkose_token"] = token
                 # 在headers中添加新字段
                 headers["Openai-Sentinel-Arkose-Token"] = token
         logger.debug(f"headers: {headers}")
         logger.debug(f"payload: {payload}")
-        response = requests.post(url, headers=headers, json=payload, stream=True)
-        # print(response)
-        return response
+        return path, headers, payload
 
 
 def delete_conversation(conversation_id, api_key):
@@ -273,18 +313,23 @@ def delete_conversation(conversation_id, api_key):
         logger.info(f"自动删除会话功能已禁用")
         return
     if conversation_id and config.NEED_DELETE_CONVERSATION_AFTER_RESPONSE:
-        patch_url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/conversation/{conversation_id}"
+        hide_conversation(conversation_id, api_key)
 
-        patch_headers = {
-            "Authorization": f"Bearer {api_key}"
-        }
-        patch_data = {"is_visible": False}
-        response = requests.patch(patch_url, headers=patch_headers, json=patch_data)
 
-        if response.status_code == 200:
-            logger.info(f"删除会话 {conversation_id} 成功")
-        else:
-            logger.error(f"PATCH 请求失败: {response.text}")
+def hide_conversation(conversation_id, api_key):
+    patch_path = f"{PROXY_API_PREFIX}/backend-api/conversation/{conversation_id}"
+
+    patch_headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    patch_data = {"is_visible": False}
+    response = upstream_pool.request(http_client.upstream, 'PATCH', patch_path, headers=patch_headers,
+                                     json=patch_data)
+
+    if response.status_code == 200:
+        logger.info(f"删除会话 {conversation_id} 成功")
+    else:
+        logger.error(f"PATCH 请求失败: {response.text}")
 
 
 def save_image(image_data, path='images'):
@@ -293,7 +338,8 @@ def save_image(image_data, path='images'):
         if not os.path.exists(path):
             os.makedirs(path)
         current_time = datetime.now().strftime('%Y%m%d%H%M%S')
-        filename = f'image_{current_time}.png'
+        # 图片线程池中可能同时保存多张图片，加上随机后缀避免同一秒内的文件名冲突
+        filename = f'image_{current_time}_{uuid.uuid4().hex[:8]}.png'
         full_path = os.path.join(path, filename)
         logger.debug(f"完整的文件路径: {full_path}")  # 打印完整路径
         # print(f"filename: {filename}")
@@ -309,55 +355,165 @@ def save_image(image_data, path='images'):
         logger.error(f"保存图片时出现异常: {e}")
 
 
-# 替换完整的引用格式
-def replace_complete_citation(text, citations, bot_mode_enabled, bot_mode_enabled_bing_reference_output):
-    def replace_match(match):
-        citation_number = match.group(1)
-        for citation in citations:
-            cited_message_idx = citation.get('metadata', {}).get('extra', {}).get('cited_message_idx')
-            logger.debug(f"cited_message_idx: {cited_message_idx}")
-            logger.debug(f"citation_number: {citation_number}")
-            logger.debug(f"is citation_number == cited_message_idx: {cited_message_idx == int(citation_number)}")
-            logger.debug(f"citation: {citation}")
-            if cited_message_idx == int(citation_number):
-                url = citation.get("metadata", {}).get("url", "")
-                if ((bot_mode_enabled == False) or (
-                        bot_mode_enabled == True and bot_mode_enabled_bing_reference_output == True)):
-                    return f"[[{citation_number}]({url})]"
-                else:
-                    return ""
-        # return match.group(0)  # 如果没有找到对应的引用，返回原文本
-        logger.critical(f"没有找到对应的引用，舍弃{match.group(0)}引用")
-        return ""
-
-    # 使用 finditer 找到第一个匹配项
-    match_iter = re.finditer(r'\u3010(\d+)\u2020(source|\u6765\u6e90)\u3011', text)
-    first_match = next(match_iter, None)
-
-    if first_match:
-        start, end = first_match.span()
-        replaced_text = text[:start] + replace_match(first_match) + text[end:]
-        remaining_text = text[end:]
-    else:
-        replaced_text = text
-        remaining_text = ""
+def get_image_download_url(file_id, api_key):
+    """
+    :return 上游文件的下载链接，失败时返回 None
+    """
+    image_path = f"{PROXY_API_PREFIX}/backend-api/files/{file_id}/download"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    image_response = upstream_pool.request(http_client.upstream, 'GET', image_path, headers=headers)
+    if image_response.status_code != 200:
+        logger.error(f"获取图片下载链接失败: {image_response.text}")
+        return None
+    download_url = image_response.json().get('download_url')
+    logger.debug(f"download_url: {download_url}")
+    return download_url
+
+
+def resolve_image_asset(asset_pointer, api_key, response_format):
+    """
+    在图片线程池中获取绘图结果：取得下载链接，按配置下载并保存图片
+    :return (回复中展示的图片链接, 交给绘图接口的 ('image_url', ...))，失败的部分为 None
+    """
+    download_url = get_image_download_url(asset_pointer, api_key)
+    if download_url is None:
+        return None, None
+    if config.USE_OAIUSERCONTENT_URL == True:
+        if response_format == "url":
+            return download_url, ('image_url', f"{download_url}")
+        image_download_response = http_client.external.get(download_url)
+        if image_download_response.status_code != 200:
+            return download_url, None
+        logger.debug(f"下载图片成功")
+        # 使用base64编码图片
+        image_base64 = base64.b64encode(image_download_response.content).decode('utf-8')
+        return download_url, ('image_url', image_base64)
+
+    # 从URL下载图片
+    image_download_response = http_client.external.get(download_url)
+    if image_download_response.status_code != 200:
+        logger.error(f"下载图片失败: {image_download_response.text}")
+        return None, None
+    logger.debug(f"下载图片成功")
+    image_data = image_download_response.content
+    today_image_url = save_image(image_data)  # 保存图片，并获取文件名
+    image_url = f"{config.UPLOAD_BASE_URL}/{today_image_url}"
+    if response_format == "url":
+        return image_url, ('image_url', image_url)
+    # 使用base64编码图片
+    return image_url, ('image_url', base64.b64encode(image_data).decode('utf-8'))
+
+
+def resolve_execution_output_image(image_file_id, api_key):
+    """
+    在图片线程池中获取代码执行结果中的图片
+    :return 回复中展示的图片链接，失败时返回 None
+    """
+    download_url = get_image_download_url(image_file_id, api_key)
+    if download_url is None or config.USE_OAIUSERCONTENT_URL == True:
+        return download_url
+    # 从URL下载图片
+    image_download_response = http_client.external.get(download_url)
+    if image_download_response.status_code != 200:
+        logger.error(f"下载图片失败: {image_download_response.text}")
+        return None
+    logger.debug(f"下载图片成功")
+    today_image_url = save_image(image_download_response.content)  # 保存图片，并获取文件名
+    return f"{config.UPLOAD_BASE_URL}/{today_image_url}"
 
-    is_potential_citation = is_valid_citation_format(remaining_text)
 
-    # 替换掉replaced_text末尾的remaining_text
+def format_image_text(image_url, has_text):
+    """
+    :param has_text: 图片之前是否已经输出过文本
+    :return 回复中展示绘图结果的文本
+    """
+    new_text = ""
+    if not image_url:
+        return new_text
+    if ((config.BOT_MODE_ENABLED == False) or (
+            config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
+        new_text = f"\n![image]({image_url})\n[下载链接]({image_url})\n"
+    if config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
+        if has_text:
+            new_text = f"\n图片链接：{image_url}\n"
+        else:
+            new_text = f"图片链接：{image_url}\n"
+    return new_text
 
-    logger.debug(f"replaced_text: {replaced_text}")
-    logger.debug(f"remaining_text: {remaining_text}")
-    logger.debug(f"is_potential_citation: {is_potential_citation}")
-    if is_potential_citation:
-        replaced_text = replaced_text[:-len(remaining_text)]
 
-    return replaced_text, remaining_text, is_potential_citation
+def wait_image(future, timeout=None):
+    """
+    :return 图片任务的结果，失败或超时返回 None
+    """
+    try:
+        return future.result(timeout=config.IMAGE_POOL_WAIT_TIMEOUT if timeout is None else timeout)
+    except Exception as e:
+        logger.error(f"获取图片失败: {e!r}")
+        return None
 
 
-def replace_sandbox(text, conversation_id, message_id, api_key):
-    def replace_match(match):
-        sandbox_path = match.group(1)
+def defer_image(context, future, model_slug):
+    """
+    在完整文本中为图片预留位置，图片完成后由 put_ready_images 按提交顺序填入并输出
+    """
+    context.pending_images.append(
+        PendingImage(future, len(context.all_new_text), any(context.all_new_text), model_slug))
+    context.all_new_text.append("")
+
+
+def put_ready_images(context, data_queue, last_data_time, wait=False):
+    """
+    按提交顺序输出已完成的图片，之前的图片未完成时后面的图片也不输出
+    :param wait: 会话结束时等待所有图片完成，总时长不超过 image_pool.wait_timeout
+    """
+    pending_images = context.pending_images
+    if wait and context.image_wait_deadline is None:
+        context.image_wait_deadline = time.time() + config.IMAGE_POOL_WAIT_TIMEOUT
+    deadline = context.image_wait_deadline
+    while pending_images:
+        pending = pending_images[0]
+        if not wait and not pending.future.done():
+            return
+        pending_images.popleft()
+        timeout = max(deadline - time.time(), 0) if wait else None
+        image_url, image_item = wait_image(pending.future, timeout) or (None, None)
+        if image_item is not None:
+            data_queue.put(image_item)
+        new_text = format_image_text(image_url, pending.has_text)
+        if not new_text:
+            continue
+        context.all_new_text[pending.slot] = new_text
+        if context.stream:
+            data_queue.put((DELTA, context.encoder, new_text, pending.model_slug))
+        last_data_time[0] = time.time()
+
+
+def replace_citation(citation_number, citations):
+    """
+    :return 引用标记替换后的文本
+    """
+    for citation in citations:
+        cited_message_idx = citation.get('metadata', {}).get('extra', {}).get('cited_message_idx')
+        if cited_message_idx == int(citation_number):
+            url = citation.get("metadata", {}).get("url", "")
+            if ((config.BOT_MODE_ENABLED == False) or (
+                    config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_BING_REFERENCE_OUTPUT == True)):
+                return f"[[{citation_number}]({url})]"
+            else:
+                return ""
+    logger.critical(f"没有找到对应的引用，舍弃第 {citation_number} 条引用")
+    return ""
+
+
+def replace_sandbox(sandbox_path, conversation_id, message_id, api_key):
+    """
+    :return 沙箱文件链接替换后的文本
+    """
+
+    def replace_path():
+        logger.info(f"替换沙箱文件链接: {sandbox_path}")
         download_url = get_download_url(conversation_id, message_id, sandbox_path)
         if download_url is None:
             return "\n```\nError: 沙箱文件下载失败，这可能是因为您启用了隐私模式\n```"
@@ -371,13 +527,13 @@ def replace_sandbox(text, conversation_id, message_id, api_key):
 
     def get_download_url(conversation_id, message_id, sandbox_path):
         # 模拟发起请求以获取下载 URL
-        sandbox_info_url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/conversation/{conversation_id}/interpreter/download?message_id={message_id}&sandbox_path={sandbox_path}"
+        sandbox_info_path = f"{PROXY_API_PREFIX}/backend-api/conversation/{conversation_id}/interpreter/download?message_id={message_id}&sandbox_path={sandbox_path}"
 
         headers = {
             "Authorization": f"Bearer {api_key}"
         }
 
-        response = requests.get(sandbox_info_url, headers=headers)
+        response = upstream_pool.request(http_client.upstream, 'GET', sandbox_info_path, headers=headers)
 
         if response.status_code == 200:
             logger.debug(f"获取下载 URL 成功: {response.json()}")
@@ -408,38 +564,50 @@ def replace_sandbox(text, conversation_id, message_id, api_key):
         if not os.path.exists("./files"):
             os.makedirs("./files")
         file_path = f"./files/{filename}"
-        with requests.get(download_url, stream=True, proxies=config.PROXIES) as r:
+        with http_client.external.get(download_url, stream=True) as r:
             with open(file_path, 'wb') as f:
                 for chunk in r.iter_content(chunk_size=8192):
                     f.write(chunk)
 
-    # 替换 (sandbox:xxx) 格式的文本
-    replaced_text = re.sub(r'\(sandbox:([^)]+)\)', replace_match, text)
-    return replaced_text
+    return replace_path()
 
 
-def data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, messages):
-    all_new_text = ""
-
-    first_output = True
+def data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, messages,
+                 stream=True):
+    """
+    在线程池中执行，处理结束（数据已全部写入队列或收到停止信号）后直接返回，由调用方通过 Future 获知
+    """
+    if transport_negotiator.get(BASE_URL, api_key) == TRANSPORT_SSE:
+        # 已知上游以 SSE 返回，直接发送对话请求，不再注册与建立 websocket
+        context = StreamState(messages, api_key, model, chat_message_id, response_format, stream)
+        upstream_response = send_text_prompt_and_get_response(messages, api_key, True, model)
+        transport = handle_conversation_response(context, upstream_response, data_queue, stop_event)
+        if transport == TRANSPORT_SSE:
+            old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                             response_format, stream)
+        elif transport == TRANSPORT_WSS:
+            # 上游已改为 WSS 返回，补连 websocket 接收本次对话的后续消息
+            logger.warning(f"上游对话返回方式已变为 wss，补连 websocket")
+            transport_negotiator.remember(BASE_URL, api_key, TRANSPORT_WSS)
+            if config.WEBSOCKET_PERSISTENT:
+                process_shared_wss(data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                                   response_format, messages, stream, context)
+            else:
+                wss_url = register_websocket(api_key)
+                process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                            response_format, messages, stream, context)
+        return
 
-    # 当前时间戳
-    timestamp = int(time.time())
+    if config.WEBSOCKET_PERSISTENT:
+        process_shared_wss(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
+                           messages, stream)
+        return
 
-    buffer = ""
-    last_full_text = ""  # 用于存储之前所有出现过的 parts 组成的完整文本
-    last_full_code = ""
-    last_full_code_result = ""
-    last_content_type = None  # 用于记录上一个消息的内容类型
-    conversation_id = ''
-    citation_buffer = ""
-    citation_accumulating = False
-    file_output_buffer = ""
-    file_output_accumulating = False
-    execution_output_image_url_buffer = ""
-    execution_output_image_id_buffer = ""
-
-    wss_url = register_websocket(api_key)
+    # 注册 websocket 与构建对话请求同时进行，在 websocket 建立后发送
+    stages = PrepareStages()
+    wss_url_future = stages.submit("register_websocket", register_websocket, api_key)
+    conversation_request = build_conversation_request(messages, api_key, model, stages)
+    wss_url = wss_url_future.result()
     # response_json = upstream_response.json()
     # wss_url = response_json.get("wss_url", None)
     # logger.info(f"wss_url: {wss_url}")
@@ -447,43 +615,221 @@ def data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_i
     # 如果存在 wss_url，使用 WebSocket 连接获取数据
 
     process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
-                messages)
+                messages, stream, conversation_request=(conversation_request, stages))
 
-    while True:
-        if stop_event.is_set():
-            logger.info(f"接受到停止信号，停止数据处理线程-外层")
 
-            break
+# 一路对冲请求结束后写入其队列
+ATTEMPT_END = object()
 
 
-def keep_alive(last_data_time, stop_event, queue, model, chat_message_id):
-    while not stop_event.is_set():
-        if time.time() - last_data_time[0] >= 1:
-            # logger.debug(f"发送保活消息")
-            # 当前时间戳
-            timestamp = int(time.time())
-            new_data = {
-                "id": chat_message_id,
-                "object": "chat.completion.chunk",
-                "created": timestamp,
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": ''
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            queue.put(f'data: {json.dumps(new_data)}\n\n')  # 发送保活消息
-            last_data_time[0] = time.time()
-        time.sleep(1)
+class HedgeAttempt:
+    """
+    对冲请求中的一路，数据先写入自己的队列，胜出后才转发给客户端
+    """
+
+    def __init__(self, arrivals, avoid):
+        self.arrivals = arrivals
+        self.stop_event = StreamStopEvent()
+        self.queue = HedgeAttemptQueue(self)
+        self.last_data_time = [time.time()]
+        self.route = RequestRoute(avoid)
+        self.start_time = time.time()
+        # 产生第一条输出的时间，出错的一路始终为 None
+        self.first_event_time = None
+        self.failed = False
+        self.ended = False
+        # 这一路创建的会话，落选时隐藏
+        self.conversation_ids = set()
+        self.future = None
+
+
+# 当前线程 / 协程所属的一路对冲请求，没有时为 None
+hedge_attempt = contextvars.ContextVar('hedge_attempt', default=None)
+
+
+def mark_attempt_failed():
+    """
+    向队列写入上游错误之前调用，对冲请求中出错的一路不会因此胜出
+    """
+    attempt = hedge_attempt.get()
+    if attempt is not None:
+        attempt.failed = True
+
 
+def is_attempt_output(item):
+    """
+    :return 是否为对话的实际输出（content 增量、图片与 chunk、结束信号），会话 id、完整文本等记录信息不算
+    """
+    if isinstance(item, tuple):
+        return item[0] in (DELTA, 'image_url')
+    return item is not ATTEMPT_END
+
+
+class HedgeAttemptQueue(StreamQueue):
+    """
+    没有出错的一路写入第一条实际输出时通知 arrivals，之前的记录信息留在队列中，胜出后一并转发
+    """
+
+    def __init__(self, attempt):
+        super().__init__(config.STREAM_QUEUE_MAX_SIZE, attempt.stop_event)
+        self.attempt = attempt
+
+    def put(self, item, block=True, timeout=None):
+        attempt = self.attempt
+        if isinstance(item, tuple) and item[0] == 'conversation_id':
+            # 落选的一路停止后写入的数据会被丢弃，会话 id 单独记录
+            attempt.conversation_ids.add(item[1])
+        super().put(item, block, timeout)
+        if attempt.first_event_time is None and not attempt.failed and is_attempt_output(item):
+            attempt.first_event_time = time.time()
+            attempt.arrivals.put(attempt)
+
+
+def run_hedge_attempt(attempt, api_key, chat_message_id, model, response_format, messages, stream):
+    # 线程池中的线程会被复用，结束时恢复
+    route_token = request_route.set(attempt.route)
+    attempt_token = hedge_attempt.set(attempt)
+    try:
+        data_fetcher(attempt.queue, attempt.stop_event, attempt.last_data_time, api_key, chat_message_id, model,
+                     response_format, messages, stream)
+    except Exception as e:
+        logger.error(f"对冲请求执行失败: {e}")
+    finally:
+        hedge_attempt.reset(attempt_token)
+        request_route.reset(route_token)
+        attempt.ended = True
+        attempt.queue.put(ATTEMPT_END)
+        # 没有产生输出就结束的一路同样通知 arrivals
+        if attempt.first_event_time is None:
+            attempt.arrivals.put(attempt)
+
+
+def hedged_data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
+                        messages, stream=True):
+    """
+    与 data_fetcher 参数一致，开启对冲请求时使用
+
+    主请求在对冲延迟内没有产生数据、预算充足且主请求所在实例之外还有可用的上游实例时，
+    使用同一账号向其他实例再发起一路相同的请求（会再消耗一个 Arkose token 并重新上传附件），
+    先产生实际输出（content 增量、图片或正常结束）的一路胜出并转发给客户端，另一路停止并隐藏其会话；
+    出错的一路只在所有请求都出错时才转发其错误信息。
+    只配置了一个上游实例时对冲请求只会重复发往同一实例与账号，直接按 data_fetcher 处理。
+    各路请求在 hedge_executor 中执行，全部结束后才返回，账号在此之后才归还账号池
+    """
+    if len(upstream_pool.backends) < 2:
+        data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
+                     messages, stream)
+        return
+    hedge_policy.on_request()
+    arrivals = Queue()
+    attempts = []
+
+    def start_attempt(avoid):
+        """
+        :raise ExecutorRejectedError: 对冲线程池已满
+        """
+        attempt = HedgeAttempt(arrivals, avoid)
+        attempt.future = hedge_executor.submit(run_hedge_attempt, attempt, api_key, chat_message_id, model,
+                                               response_format, messages, stream)
+        attempts.append(attempt)
+        return attempt
+
+    # 客户端断开时停止所有请求
+    stop_event.add_callback(lambda: [attempt.stop_event.set() for attempt in attempts])
     if stop_event.is_set():
-        logger.debug(f"接受到停止信号，停止保活线程")
         return
+    try:
+        primary = start_attempt(None)
+    except ExecutorRejectedError:
+        # 不使用对冲，直接在当前线程中处理
+        data_fetcher(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
+                     messages, stream)
+        return
+    winner = None
+    try:
+        hedge_deadline = time.time() + hedge_policy.delay()
+        hedge_checked = False
+        while winner is None and not stop_event.is_set():
+            timeout = 0.5 if hedge_checked else max(min(hedge_deadline - time.time(), 0.5), 0)
+            try:
+                attempt = arrivals.get(timeout=timeout)
+            except Empty:
+                if not hedge_checked and time.time() >= hedge_deadline:
+                    hedge_checked = True
+                    # 主请求尚未发往上游或没有其他可用实例时不发起对冲
+                    backend = primary.route.backend
+                    if backend is not None and upstream_pool.has_alternative(backend) and hedge_policy.try_spend():
+                        try:
+                            start_attempt(primary.route.backend)
+                            logger.info(f"主请求 {time.time() - primary.start_time:.2f} 秒内没有产生数据，发起对冲请求")
+                        except ExecutorRejectedError:
+                            pass
+                continue
+            # 出错或没有产生输出就结束的一路，在还有其他请求时继续等待
+            if attempt.first_event_time is None and any(not other.ended for other in attempts if other is not attempt):
+                continue
+            winner = attempt
+
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.stop_event.set()
+        if winner is None:
+            return
+        if winner is not primary:
+            logger.info(f"对冲请求胜出")
+            hedge_policy.record_hedge_won()
+        # 从头转发，包括胜出之前写入的记录信息
+        item = None
+        while item is not ATTEMPT_END:
+            if item is not None:
+                data_queue.put(item)
+                last_data_time[0] = time.time()
+            try:
+                item = winner.queue.get(timeout=0.5)
+            except Empty:
+                # 停止后结束标记可能因队列已满被丢弃
+                if winner.ended and winner.queue.empty():
+                    break
+                item = None
+    finally:
+        # 等待所有请求结束后再隐藏落选一路的会话，此时不会再有新的会话产生
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.stop_event.set()
+        wait([attempt.future for attempt in attempts])
+        for attempt in attempts:
+            # 各路按自己的发起时间计算，对冲请求胜出时不把对冲延迟计入样本
+            if attempt.first_event_time is not None:
+                hedge_policy.record_first_event(attempt.first_event_time - attempt.start_time)
+            if attempt is not winner:
+                for conversation_id in attempt.conversation_ids:
+                    hide_conversation(conversation_id, api_key)
+
+
+def get_keep_alive_frame(model, chat_message_id):
+    """
+    预先序列化一条保活消息，由保活调度器在流空闲时直接写入队列
+    """
+    if config.KEEP_ALIVE_USE_COMMENT_FRAME:
+        return ': keep-alive\n\n'
+    # 当前时间戳
+    timestamp = int(time.time())
+    new_data = {
+        "id": chat_message_id,
+        "object": "chat.completion.chunk",
+        "created": timestamp,
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {
+                    "content": ''
+                },
+                "finish_reason": None
+            }
+        ]
+    }
+    return f'data: {json.dumps(new_data)}\n\n'
 
 
 def count_tokens(text, model_name):
@@ -584,7 +930,7 @@ def generate_actions_allow_payload(author_role, author_name, target_message_id,
 # 定义发送请求的函数
 def send_allow_prompt_and_get_response(message_id, author_role, author_name, target_message_id, operation_hash,
                                        conversation_id, model, api_key):
-    url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/conversation"
+    path = f"{PROXY_API_PREFIX}/backend-api/conversation"
     headers = {
         "Authorization": f"Bearer {api_key}"
     }
@@ -606,7 +952,8 @@ def send_allow_prompt_and_get_response(message_id, author_role, author_name, tar
     logger.debug(f"payload: {payload}")
     logger.info(f"继续请求上游接口")
     try:
-        response = requests.post(url, headers=headers, json=payload, stream=True, verify=False, timeout=30)
+        response = upstream_pool.request(http_client.upstream, 'POST', path, headers=headers, json=payload,
+                                         stream=True, verify=False, timeout=30)
         logger.info(f"成功与上游接口建立连接")
         # print(response)
         return response
@@ -615,16 +962,23 @@ def send_allow_prompt_and_get_response(message_id, author_role, author_name, tar
         logger.error("请求超时")
 
 
-def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
-                      response_format, timestamp, first_output, last_full_text, last_full_code, last_full_code_result,
-                      last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer,
-                      file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer,
-                      all_new_text):
+def process_data_json(context, data_json, data_queue, stop_event, last_data_time):
+    """
+    处理一条上游消息，直接更新 context（StreamState）
+    """
+    api_key = context.api_key
+    chat_message_id = context.chat_message_id
+    model = context.model
+    response_format = context.response_format
+    timestamp = context.timestamp
+    # 先输出此前已完成的图片
+    if context.pending_images:
+        put_ready_images(context, data_queue, last_data_time)
     # print(f"data_json: {data_json}")
     message = data_json.get("message", {})
 
-    if message == {} or message == None:
-        logger.debug(f"message 为空: data_json: {data_json}")
+    if (message == {} or message == None) and context.trace:
+        logger.debug("message 为空: data_json: %s", data_json)
 
     message_id = message.get("id")
 
@@ -633,7 +987,7 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
     role = message.get("author", {}).get("role")
     content_type = content.get("content_type")
     # print(f"content_type: {content_type}")
-    # print(f"last_content_type: {last_content_type}")
+    # print(f"last_content_type: {context.last_content_type}")
 
     metadata = {}
     citations = []
@@ -664,12 +1018,13 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
                 operation_hash = action.get("always_allow", {}).get("operation_hash", "")
                 break
 
-        conversation_id = data_json.get("conversation_id", "")
+        context.conversation_id = data_json.get("conversation_id", "")
         upstream_response = send_allow_prompt_and_get_response(message_id, author_role, author_name, target_message_id,
-                                                               operation_hash, conversation_id, model, api_key)
+                                                               operation_hash, context.conversation_id, model, api_key)
         if upstream_response == None:
             complete_data = 'data: [DONE]\n\n'
             logger.info(f"会话超时")
+            mark_attempt_failed()
 
             new_data = {
                 "id": chat_message_id,
@@ -693,11 +1048,12 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
             data_queue.put(('all_new_text', "{\n\"error\": \"Something went wrong...\"\n}"))
             data_queue.put(q_data)
             last_data_time[0] = time.time()
-            return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
+            return
 
         if upstream_response.status_code != 200:
             complete_data = 'data: [DONE]\n\n'
             logger.info(f"会话出错")
+            mark_attempt_failed()
             logger.error(f"upstream_response status code: {upstream_response.status_code}")
             logger.error(f"upstream_response: {upstream_response.text}")
             tmp_message = "Something went wrong..."
@@ -710,8 +1066,7 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
                 # 尝试提取 message 字段
                 tmp_message = parsed_response.get("detail", {}).get("message", None)
                 tmp_code = parsed_response.get("detail", {}).get("code", None)
-                if tmp_code == "account_deactivated" or tmp_code == "model_cap_exceeded":
-                    logger.error(f"账号被封禁或超限，异常代码: {tmp_code}")
+                report_account_error(api_key, tmp_code)
 
             except json.JSONDecodeError:
                 # 如果 JSON 解析失败，则记录错误
@@ -739,41 +1094,33 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
             data_queue.put(('all_new_text', "```\n{\n\"error\": \"" + tmp_message + "\"\n}```"))
             data_queue.put(q_data)
             last_data_time[0] = time.time()
-            return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
+            return
 
         logger.info(f"action确认事件处理成功, 上游响应数据结构类型: {type(upstream_response)}")
 
         upstream_response_json = upstream_response.json()
         upstream_response_id = upstream_response_json.get("response_id", "")
 
-        buffer = ""
-        last_full_text = ""  # 用于存储之前所有出现过的 parts 组成的完整文本
-        last_full_code = ""
-        last_full_code_result = ""
-        last_content_type = None  # 用于记录上一个消息的内容类型
-        conversation_id = ''
-        citation_buffer = ""
-        citation_accumulating = False
-        file_output_buffer = ""
-        file_output_accumulating = False
-        execution_output_image_url_buffer = ""
-        execution_output_image_id_buffer = ""
-
-        return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, upstream_response_id
+        context.reset_message()
+        context.response_id = upstream_response_id
+        return
 
     if (role == "user" or message_status == "finished_successfully" or role == "system") and role != "tool":
         # 如果是用户发来的消息，直接舍弃
-        return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
+        return
     try:
-        conversation_id = data_json.get("conversation_id")
-        # print(f"conversation_id: {conversation_id}")
-        if conversation_id:
-            data_queue.put(('conversation_id', conversation_id))
+        last_conversation_id = context.conversation_id
+        context.conversation_id = data_json.get("conversation_id")
+        # print(f"conversation_id: {context.conversation_id}")
+        if context.conversation_id and context.conversation_id != last_conversation_id:
+            data_queue.put(('conversation_id', context.conversation_id))
     except:
         pass
         # 只获取新的部分
     new_text = ""
     is_img_message = False
+    # 本条消息中交给图片线程池处理的图片
+    image_futures = []
     parts = content.get("parts", [])
     for part in parts:
         try:
@@ -784,250 +1131,123 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
                 is_img_message = True
                 asset_pointer = part.get('asset_pointer').replace('file-service://', '')
                 logger.debug(f"asset_pointer: {asset_pointer}")
-                image_url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/files/{asset_pointer}/download"
-
-                headers = {
-                    "Authorization": f"Bearer {api_key}"
-                }
-                image_response = requests.get(image_url, headers=headers)
-
-                if image_response.status_code == 200:
-                    download_url = image_response.json().get('download_url')
-                    logger.debug(f"download_url: {download_url}")
-                    if config.USE_OAIUSERCONTENT_URL == True:
-                        if ((config.BOT_MODE_ENABLED == False) or (
-                                config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
-                            new_text = f"\n![image]({download_url})\n[下载链接]({download_url})\n"
-                        if config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
-                            if all_new_text != "":
-                                new_text = f"\n图片链接：{download_url}\n"
-                            else:
-                                new_text = f"图片链接：{download_url}\n"
-                        if response_format == "url":
-                            data_queue.put(('image_url', f"{download_url}"))
-                        else:
-                            image_download_response = requests.get(download_url, proxies=config.PROXIES)
-                            if image_download_response.status_code == 200:
-                                logger.debug(f"下载图片成功")
-                                image_data = image_download_response.content
-                                # 使用base64编码图片
-                                image_base64 = base64.b64encode(image_data).decode('utf-8')
-                                data_queue.put(('image_url', image_base64))
-                    else:
-                        # 从URL下载图片
-                        # image_data = requests.get(download_url).content
-                        image_download_response = requests.get(download_url, proxies=config.PROXIES)
-                        # print(f"image_download_response: {image_download_response.text}")
-                        if image_download_response.status_code == 200:
-                            logger.debug(f"下载图片成功")
-                            image_data = image_download_response.content
-                            today_image_url = save_image(image_data)  # 保存图片，并获取文件名
-                            if response_format == "url":
-                                data_queue.put(('image_url', f"{config.UPLOAD_BASE_URL}/{today_image_url}"))
-                            else:
-                                # 使用base64编码图片
-                                image_base64 = base64.b64encode(image_data).decode('utf-8')
-                                data_queue.put(('image_url', image_base64))
-                            if ((config.BOT_MODE_ENABLED == False) or (
-                                    config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
-                                new_text = f"\n![image]({config.UPLOAD_BASE_URL}/{today_image_url})\n[下载链接]({config.UPLOAD_BASE_URL}/{today_image_url})\n"
-                            if config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
-                                if all_new_text != "":
-                                    new_text = f"\n图片链接：{config.UPLOAD_BASE_URL}/{today_image_url}\n"
-                                else:
-                                    new_text = f"图片链接：{config.UPLOAD_BASE_URL}/{today_image_url}\n"
-                        else:
-                            logger.error(f"下载图片失败: {image_download_response.text}")
-                    if last_content_type == "code":
-                        if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                            new_text = new_text
-                        else:
-                            new_text = "\n```\n" + new_text
-                    logger.debug(f"new_text: {new_text}")
-                    is_img_message = True
-                else:
-                    logger.error(f"获取图片下载链接失败: {image_response.text}")
+                # 获取下载链接与下载图片交给图片线程池，后续文本照常输出，图片完成后按顺序插入
+                image_futures.append(submit_image_task(resolve_image_asset, asset_pointer, api_key, response_format))
         except:
             pass
+    if is_img_message and context.last_content_type == "code":
+        if not (config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False):
+            new_text = "\n```\n"
 
     if is_img_message == False:
         # print(f"data_json: {data_json}")
-        if content_type == "multimodal_text" and last_content_type == "code":
+        if content_type == "multimodal_text" and context.last_content_type == "code":
             new_text = "\n```\n" + content.get("text", "")
             if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                 new_text = content.get("text", "")
         elif role == "tool" and name == "dalle.text2im":
-            logger.debug(f"无视消息: {content.get('text', '')}")
-            return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
+            logger.debug("无视消息: %s", content.get('text', ''))
+            return
         # 代码块特殊处理
-        if content_type == "code" and last_content_type != "code" and content_type != None:
-            full_code = ''.join(content.get("text", ""))
-            new_text = "\n```\n" + full_code[len(last_full_code):]
-            # print(f"full_code: {full_code}")
-            # print(f"last_full_code: {last_full_code}")
+        if content_type == "code" and context.last_content_type != "code" and content_type != None:
+            full_code = content.get("text", "")
+            new_text = "\n```\n" + full_code[context.last_code_length:]
             # print(f"new_text: {new_text}")
-            last_full_code = full_code  # 更新完整代码以备下次比较
+            context.last_code_length = len(full_code)  # 更新完整代码长度以备下次比较
             if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                 new_text = ""
 
-        elif last_content_type == "code" and content_type != "code" and content_type != None:
-            full_code = ''.join(content.get("text", ""))
-            new_text = "\n```\n" + full_code[len(last_full_code):]
-            # print(f"full_code: {full_code}")
-            # print(f"last_full_code: {last_full_code}")
+        elif context.last_content_type == "code" and content_type != "code" and content_type != None:
+            full_code = content.get("text", "")
+            new_text = "\n```\n" + full_code[context.last_code_length:]
             # print(f"new_text: {new_text}")
-            last_full_code = ""  # 更新完整代码以备下次比较
+            context.last_code_length = 0  # 更新完整代码长度以备下次比较
             if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                 new_text = ""
 
-        elif content_type == "code" and last_content_type == "code" and content_type != None:
-            full_code = ''.join(content.get("text", ""))
-            new_text = full_code[len(last_full_code):]
-            # print(f"full_code: {full_code}")
-            # print(f"last_full_code: {last_full_code}")
+        elif content_type == "code" and context.last_content_type == "code" and content_type != None:
+            full_code = content.get("text", "")
+            new_text = full_code[context.last_code_length:]
             # print(f"new_text: {new_text}")
-            last_full_code = full_code  # 更新完整代码以备下次比较
+            context.last_code_length = len(full_code)  # 更新完整代码长度以备下次比较
             if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                 new_text = ""
 
         else:
             # 只获取新的 parts
             parts = content.get("parts", [])
-            full_text = ''.join(parts)
-            logger.debug(f"last_full_text: {last_full_text}")
-            new_text = full_text[len(last_full_text):]
-            if full_text != '':
-                last_full_text = full_text  # 更新完整文本以备下次比较
-            logger.debug(f"full_text: {full_text}")
-            logger.debug(f"new_text: {new_text}")
-            if "\u3010" in new_text and not citation_accumulating:
-                citation_accumulating = True
-                citation_buffer = citation_buffer + new_text
-                logger.debug(f"开始积累引用: {citation_buffer}")
-            elif citation_accumulating:
-                citation_buffer += new_text
-                logger.debug(f"积累引用: {citation_buffer}")
-            if citation_accumulating:
-                if is_valid_citation_format(citation_buffer):
-                    logger.debug(f"合法格式: {citation_buffer}")
-                    # 继续积累
-                    if is_complete_citation_format(citation_buffer):
-
-                        # 替换完整的引用格式
-                        replaced_text, remaining_text, is_potential_citation = replace_complete_citation(
-                            citation_buffer, citations)
-                        # print(replaced_text)  # 输出替换后的文本
-
-                        new_text = replaced_text
-
-                        if (is_potential_citation):
-                            citation_buffer = remaining_text
-                        else:
-                            citation_accumulating = False
-                            citation_buffer = ""
-                        logger.debug(f"替换完整的引用格式: {new_text}")
-                    else:
-                        return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
-                else:
-                    # 不是合法格式，放弃积累并响应
-                    logger.debug(f"不合法格式: {citation_buffer}")
-                    new_text = citation_buffer
-                    citation_accumulating = False
-                    citation_buffer = ""
-
-            if "(" in new_text and not file_output_accumulating and not citation_accumulating:
-                file_output_accumulating = True
-                file_output_buffer = file_output_buffer + new_text
-
-                logger.debug(f"开始积累文件输出: {file_output_buffer}")
-                logger.debug(f"file_output_buffer: {file_output_buffer}")
-                logger.debug(f"new_text: {new_text}")
-            elif file_output_accumulating:
-                file_output_buffer += new_text
-                logger.debug(f"积累文件输出: {file_output_buffer}")
-            if file_output_accumulating:
-                if is_valid_sandbox_combined_corrected_final_v2(file_output_buffer):
-                    logger.debug(f"合法文件输出格式: {file_output_buffer}")
-                    # 继续积累
-                    if is_complete_sandbox_format(file_output_buffer):
-                        # 替换完整的引用格式
-                        logger.info(f'complete_sandbox data_json {data_json}')
-                        replaced_text = replace_sandbox(file_output_buffer, conversation_id, message_id, api_key)
-                        # print(replaced_text)  # 输出替换后的文本
-                        new_text = replaced_text
-                        file_output_accumulating = False
-                        file_output_buffer = ""
-                        logger.debug(f"替换完整的文件输出格式: {new_text}")
-                    else:
-                        return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
-                else:
-                    # 不是合法格式，放弃积累并响应
-                    logger.debug(f"不合法格式: {file_output_buffer}")
-                    new_text = file_output_buffer
-                    file_output_accumulating = False
-                    file_output_buffer = ""
+            new_text, full_text_length = parts_delta(parts, context.last_text_length)
+            if full_text_length:
+                context.last_text_length = full_text_length  # 更新完整文本长度以备下次比较
+            if context.trace:
+                logger.debug("new_text: %s", new_text)
+            # 替换引用标记与沙箱文件链接，可能是标记开头的部分暂不输出
+            new_text = context.rewriter.feed(
+                new_text, lambda citation_number: replace_citation(citation_number, citations),
+                lambda sandbox_path: replace_sandbox(sandbox_path, context.conversation_id, message_id, api_key))
+            if not new_text and context.rewriter.pending:
+                return
 
         # Python 工具执行输出特殊处理
-        if role == "tool" and name == "python" and last_content_type != "execution_output" and content_type != None:
+        if role == "tool" and name == "python" and context.last_content_type != "execution_output" and content_type != None:
 
-            full_code_result = ''.join(content.get("text", ""))
-            new_text = "`Result:` \n```\n" + full_code_result[len(last_full_code_result):]
-            if last_content_type == "code":
+            full_code_result = content.get("text", "")
+            new_text = "`Result:` \n```\n" + full_code_result[context.last_code_result_length:]
+            if context.last_content_type == "code":
                 if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                     new_text = ""
                 else:
                     new_text = "\n```\n" + new_text
-            # print(f"full_code_result: {full_code_result}")
-            # print(f"last_full_code_result: {last_full_code_result}")
             # print(f"new_text: {new_text}")
-            last_full_code_result = full_code_result  # 更新完整代码以备下次比较
-        elif last_content_type == "execution_output" and (role != "tool" or name != "python") and content_type != None:
+            # 新的执行结果
+            context.reset_code_result()
+            context.update_code_result(full_code_result)  # 更新完整代码长度以备下次比较
+        elif context.last_content_type == "execution_output" and (role != "tool" or name != "python") and content_type != None:
             # new_text = content.get("text", "") + "\n```"
-            full_code_result = ''.join(content.get("text", ""))
-            new_text = full_code_result[len(last_full_code_result):] + "\n```\n"
+            full_code_result = content.get("text", "")
+            new_text = full_code_result[context.last_code_result_length:] + "\n```\n"
             if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                 new_text = ""
             tmp_new_text = new_text
-            if execution_output_image_url_buffer != "":
-                if ((config.BOT_MODE_ENABLED == False) or (
-                        config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
-                    logger.debug(f"BOT_MODE_ENABLED: {config.BOT_MODE_ENABLED}")
-                    logger.debug(f"BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT: {config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT}")
-                    new_text = tmp_new_text + f"![image]({execution_output_image_url_buffer})\n[下载链接]({execution_output_image_url_buffer})\n"
-                if config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
-                    logger.debug(f"BOT_MODE_ENABLED: {config.BOT_MODE_ENABLED}")
-                    logger.debug(f"BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT: {config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT}")
-                    new_text = tmp_new_text + f"图片链接：{execution_output_image_url_buffer}\n"
-                execution_output_image_url_buffer = ""
+            if context.execution_output_image_future is not None:
+                # 图片在检测到 <<ImageDisplayed>> 时已开始获取，与执行结果的输出同时进行，此处通常无需等待
+                image_url = wait_image(context.execution_output_image_future)
+                context.execution_output_image_future = None
+                if image_url:
+                    if ((config.BOT_MODE_ENABLED == False) or (
+                            config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
+                        logger.debug(f"BOT_MODE_ENABLED: {config.BOT_MODE_ENABLED}")
+                        logger.debug(f"BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT: {config.BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT}")
+                        new_text = tmp_new_text + f"![image]({image_url})\n[下载链接]({image_url})\n"
+                    if config.BOT_MODE_ENABLED == True and config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
+                        logger.debug(f"BOT_MODE_ENABLED: {config.BOT_MODE_ENABLED}")
+                        logger.debug(f"BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT: {config.BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT}")
+                        new_text = tmp_new_text + f"图片链接：{image_url}\n"
 
             if content_type == "code":
                 new_text = new_text + "\n```\n"
-            # print(f"full_code_result: {full_code_result}")
-            # print(f"last_full_code_result: {last_full_code_result}")
             # print(f"new_text: {new_text}")
-            last_full_code_result = ""  # 更新完整代码以备下次比较
-        elif last_content_type == "execution_output" and role == "tool" and name == "python" and content_type != None:
-            full_code_result = ''.join(content.get("text", ""))
+            context.reset_code_result()  # 更新完整代码长度以备下次比较
+        elif context.last_content_type == "execution_output" and role == "tool" and name == "python" and content_type != None:
+            full_code_result = content.get("text", "")
             if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                 new_text = ""
             else:
-                new_text = full_code_result[len(last_full_code_result):]
-            # print(f"full_code_result: {full_code_result}")
-            # print(f"last_full_code_result: {last_full_code_result}")
+                new_text = full_code_result[context.last_code_result_length:]
             # print(f"new_text: {new_text}")
-            last_full_code_result = full_code_result
+            context.update_code_result(full_code_result)
 
         # 其余Action执行输出特殊处理
-        if role == "tool" and name != "python" and name != "dalle.text2im" and last_content_type != "execution_output" and content_type != None:
+        if role == "tool" and name != "python" and name != "dalle.text2im" and context.last_content_type != "execution_output" and content_type != None:
             new_text = ""
-            if last_content_type == "code":
+            if context.last_content_type == "code":
                 if config.BOT_MODE_ENABLED and config.BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
                     new_text = ""
                 else:
                     new_text = "\n```\n" + new_text
 
-    # 检查 new_text 中是否包含 <<ImageDisplayed>>
-    if "<<ImageDisplayed>>" in last_full_code_result:
+    # 检查代码执行结果中是否包含 <<ImageDisplayed>>
+    if context.code_result_image_displayed:
         # 进行提取操作
         aggregate_result = message.get("metadata", {}).get("aggregate_result", {})
         if aggregate_result:
@@ -1039,169 +1259,183 @@ def process_data_json(data_json, data_queue, stop_event, last_data_time, api_key
                         # 从 image_url 提取所需的字段
                         image_file_id = image_url.split('://')[-1]
                         logger.info(f"提取到的图片文件ID: {image_file_id}")
-                        if image_file_id != execution_output_image_id_buffer:
-                            image_url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/files/{image_file_id}/download"
+                        if image_file_id != context.execution_output_image_id_buffer:
+                            context.execution_output_image_future = submit_image_task(
+                                resolve_execution_output_image, image_file_id, api_key)
 
-                            headers = {
-                                "Authorization": f"Bearer {api_key}"
-                            }
-                            image_response = requests.get(image_url, headers=headers)
-
-                            if image_response.status_code == 200:
-                                download_url = image_response.json().get('download_url')
-                                logger.debug(f"download_url: {download_url}")
-                                if config.USE_OAIUSERCONTENT_URL == True:
-                                    execution_output_image_url_buffer = download_url
-
-                                else:
-                                    # 从URL下载图片
-                                    # image_data = requests.get(download_url).content
-                                    image_download_response = requests.get(download_url, proxies=config.PROXIES)
-                                    # print(f"image_download_response: {image_download_response.text}")
-                                    if image_download_response.status_code == 200:
-                                        logger.debug(f"下载图片成功")
-                                        image_data = image_download_response.content
-                                        today_image_url = save_image(image_data)  # 保存图片，并获取文件名
-                                        execution_output_image_url_buffer = f"{config.UPLOAD_BASE_URL}/{today_image_url}"
-
-                                    else:
-                                        logger.error(f"下载图片失败: {image_download_response.text}")
-
-                        execution_output_image_id_buffer = image_file_id
+                        context.execution_output_image_id_buffer = image_file_id
 
     # 从 new_text 中移除 <<ImageDisplayed>>
     new_text = new_text.replace("<<ImageDisplayed>>", "图片生成中，请稍后\n")
 
     # print(f"收到数据: {data_json}")
-    # print(f"收到的完整文本: {full_text}")
-    # print(f"上次收到的完整文本: {last_full_text}")
     # print(f"新的文本: {new_text}")
 
     # 更新 last_content_type
     if content_type != None:
-        last_content_type = content_type if role != "user" else last_content_type
+        context.last_content_type = content_type if role != "user" else context.last_content_type
+
+    # 累积 new_text
+    context.all_new_text.append(new_text)
+    # 图片在完整文本中的位置紧随本条消息的文本
+    for future in image_futures:
+        defer_image(context, future, message.get("metadata", {}).get("model_slug") or model)
+    if context.trace:
+        logger.info("Send: %s", new_text.replace('\n', '\\n'))
+
+    # 非流式响应只需要累积文本，不需要构造每个 chunk
+    if context.stream:
+        model_slug = message.get("metadata", {}).get("model_slug") or model
+
+        if context.first_output:
+            data_queue.put(context.encoder.role(model_slug))
+            logger.info(f"开始流式响应...")
+            context.first_output = False
+        elif not new_text:
+            # 空增量不输出，也不刷新 last_data_time，长时间没有新文本时仍会发送 keep-alive
+            return
 
-    model_slug = message.get("metadata", {}).get("model_slug") or model
+        if new_text:
+            # 由输出端合并相邻的增量后再编码
+            data_queue.put((DELTA, context.encoder, new_text, model_slug))
+    last_data_time[0] = time.time()
 
-    if first_output:
-        new_data = {
-            "id": chat_message_id,
-            "object": "chat.completion.chunk",
-            "created": timestamp,
-            "model": model_slug,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {"role": "assistant"},
-                    "finish_reason": None
-                }
-            ]
-        }
-        q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-        data_queue.put(q_data)
-        logger.info(f"开始流式响应...")
-        first_output = False
+
+def put_upstream_error(context, data_queue):
+    mark_attempt_failed()
+    complete_data = 'data: [DONE]\n\n'
+    timestamp = context.timestamp
 
     new_data = {
-        "id": chat_message_id,
+        "id": context.chat_message_id,
         "object": "chat.completion.chunk",
         "created": timestamp,
-        "model": model_slug,
+        "model": context.model,
         "choices": [
             {
                 "index": 0,
                 "delta": {
-                    "content": ''.join(new_text)
+                    "content": ''.join("```json\n{\n\"error\": \"Upstream error...\"\n}\n```")
                 },
                 "finish_reason": None
             }
         ]
     }
-    # print(f"Role: {role}")
-    # logger.info(f".")
-    tmp = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-    # print(f"发送数据: {tmp}")
-    # 累积 new_text
-    all_new_text += new_text
-    tmp_t = new_text.replace('\n', '\\n')
-    logger.info(f"Send: {tmp_t}")
-
-    # if new_text != None:
     q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
     data_queue.put(q_data)
-    last_data_time[0] = time.time()
-    if stop_event.is_set():
-        return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
-    return all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, None
+
+    q_data = complete_data
+    data_queue.put(('all_new_text', "```json\n{\n\"error\": \"Upstream error...\"\n}\n```"))
+    data_queue.put(q_data)
+
+
+def process_wss_message(context, message, data_queue, stop_event, last_data_time):
+    """
+    处理一条 websocket 消息
+    :return 会话是否已经结束
+    """
+    return process_wss_result(context, json.loads(message), data_queue, stop_event, last_data_time)
 
 
-def process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, messages):
+def process_wss_result(context, result_json, data_queue, stop_event, last_data_time):
+    """
+    处理一条已解析的 websocket 消息
+    :return 会话是否已经结束
+    """
+    result_id = result_json.get('response_id', '')
+    # print("context: " + str(context.response_id))
+    # print("result_id: " + str(result_id))
+    if str(result_id).strip() != str(context.response_id).strip():
+        logger.debug("response_id 不匹配，忽略")
+        return False
+    if context.trace:
+        logger.debug("on_message: %s", result_json)
+    body = result_json.get('body', '')
+    if not body:
+        return False
+    events = decode_frame_body(body)
+    context.wss_frame_count += 1
+    context.wss_event_count += len(events)
+    for data in events:
+        if process_event_data(context, data, data_queue, stop_event, last_data_time):
+            logger.debug("websocket 消息 %d 条，事件 %d 条", context.wss_frame_count, context.wss_event_count)
+            stop_event.set()
+            return True
+    return False
+
+
+def get_error_code(response_text):
+    """
+    从上游错误响应中提取 detail.code
+    """
+    try:
+        detail = json.loads(response_text).get("detail", {})
+    except (json.JSONDecodeError, AttributeError):
+        return None
+    if isinstance(detail, dict):
+        return detail.get("code", None)
+    return None
+
+
+def report_account_error(api_key, code):
+    if code == "account_deactivated" or code == "model_cap_exceeded":
+        logger.error(f"账号被封禁或超限，异常代码: {code}")
+        account_pool.report_error(api_key, code)
+
+
+def handle_conversation_response(context, upstream_response, data_queue, stop_event):
+    """
+    根据对话接口的响应判断本次对话的返回方式
+    :return TRANSPORT_SSE / TRANSPORT_WSS，上游出错时写入错误信息并返回 None
+    """
+    # 检查 Content-Type 是否为 SSE 响应
+    content_type = upstream_response.headers.get('Content-Type')
+    logger.debug(f"Content-Type: {content_type}")
+    # 判断content_type是否包含'text/event-stream'
+    if content_type and 'text/event-stream' in content_type:
+        logger.debug("上游响应为 SSE 响应")
+        context.is_sse = True
+        context.upstream_response = upstream_response
+        return TRANSPORT_SSE
+    if upstream_response.status_code != 200:
+        logger.error(f"upstream_response status code: {upstream_response.status_code}, upstream_response: {upstream_response.text}")
+        report_account_error(context.api_key, get_error_code(upstream_response.text))
+        put_upstream_error(context, data_queue)
+        stop_event.set()
+        return None
+    try:
+        upstream_response_json = upstream_response.json()
+        logger.debug("upstream_response_json: %s", upstream_response_json)
+        # upstream_wss_url = upstream_response_json.get("wss_url", None)
+        upstream_response_id = upstream_response_json.get("response_id", None)
+        context.response_id = upstream_response_id
+    except json.JSONDecodeError:
+        pass
+    return TRANSPORT_WSS
+
+
+def process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, messages,
+                stream=True, context=None, conversation_request=None):
+    """
+    :param context: 对话请求已经发出时传入其处理上下文，此时 websocket 只用于接收该对话的后续消息
+    :param conversation_request: 已经构建好的 (对话请求, 准备阶段)，websocket 建立后直接发送
+    """
     headers = {
         "Sec-Ch-Ua-Mobile": "?0",
         "User-Agent": ua.random
     }
-    context = {
-        "all_new_text": "",
-        "first_output": True,
-        "timestamp": int(time.time()),
-        "buffer": "",
-        "last_full_text": "",
-        "last_full_code": "",
-        "last_full_code_result": "",
-        "last_content_type": None,
-        "conversation_id": "",
-        "citation_buffer": "",
-        "citation_accumulating": False,
-        "file_output_buffer": "",
-        "file_output_accumulating": False,
-        "execution_output_image_url_buffer": "",
-        "execution_output_image_id_buffer": "",
-        "is_sse": False,
-        "upstream_response": None,
-        "messages": messages,
-        "api_key": api_key,
-        "model": model
-    }
+    attach_only = context is not None
+    if context is None:
+        context = StreamState(messages, api_key, model, chat_message_id, response_format, stream)
+    attach_timer = None
 
     def on_message(ws, message):
-        logger.debug(f"on_message: {message}")
         if stop_event.is_set():
             logger.info(f"接受到停止信号，停止 Websocket 处理线程")
             ws.close()
             return
-        result_json = json.loads(message)
-        result_id = result_json.get('response_id', '')
-        # print("context: " + str(context["response_id"]))
-        # print("result_id: " + str(result_id))
-        if str(result_id).strip() != str(context["response_id"]).strip():
-            logger.debug(f"response_id 不匹配，忽略")
-            return
-        body = result_json.get('body', '')
-        # logger.debug("wss result: " + str(result_json))
-        if body:
-            buffer_data = base64.b64decode(body).decode('utf-8')
-            end_index = buffer_data.index('\n\n') + 2
-            complete_data, _ = buffer_data[:end_index], buffer_data[end_index:]
-            # logger.debug(f"complete_data: {complete_data}")
-            try:
-                data_json = json.loads(complete_data.replace('data: ', ''))
-                logger.debug(f"data_json: {data_json}")
-
-                context["all_new_text"], context["first_output"], context["last_full_text"], context["last_full_code"], context["last_full_code_result"], context["last_content_type"], context["conversation_id"], context["citation_buffer"], context["citation_accumulating"], context["file_output_buffer"], context["file_output_accumulating"], context["execution_output_image_url_buffer"], context["execution_output_image_id_buffer"], allow_id = process_data_json(data_json, data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, context["timestamp"], context["first_output"], context["last_full_text"], context["last_full_code"], context["last_full_code_result"], context["last_content_type"], context["conversation_id"], context["citation_buffer"], context["citation_accumulating"], context["file_output_buffer"], context["file_output_accumulating"], context["execution_output_image_url_buffer"], context["execution_output_image_id_buffer"], context["all_new_text"])
-
-                if allow_id:
-                    context["response_id"] = allow_id
-            except json.JSONDecodeError:
-                logger.error(f"Failed to parse the response as JSON: {complete_data}")
-                if complete_data == 'data: [DONE]\n\n':
-                    logger.info(f"会话结束")
-                    q_data = complete_data
-                    data_queue.put(('all_new_text', context["all_new_text"]))
-                    data_queue.put(q_data)
-                    q_data = complete_data
-                    data_queue.put(q_data)
-                    stop_event.set()
-                    ws.close()
+        if process_wss_message(context, message, data_queue, stop_event, last_data_time):
+            ws.close()
 
     def on_error(ws, error):
         logger.error(error)
@@ -1209,65 +1443,33 @@ def process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_m
     def on_close(ws, b, c):
         logger.debug("wss closed")
 
+    def check_attached():
+        # 补连之前上游已经推送完的对话无法再收到消息，超时后按上游错误结束
+        if not context.conversation_id and not stop_event.is_set():
+            logger.error(f"补连 websocket 后未收到对话消息")
+            put_upstream_error(context, data_queue)
+            stop_event.set()
+
     def on_open(ws):
+        nonlocal attach_timer
         logger.debug(f"on_open: wss")
-        upstream_response = send_text_prompt_and_get_response(context["messages"], context["api_key"], True, context["model"])
-        # upstream_wss_url = None
-        # 检查 Content-Type 是否为 SSE 响应
-        content_type = upstream_response.headers.get('Content-Type')
-        logger.debug(f"Content-Type: {content_type}")
-        # 判断content_type是否包含'text/event-stream'
-        if content_type and 'text/event-stream' in content_type:
-            logger.debug("上游响应为 SSE 响应")
-            context["is_sse"] = True
-            context["upstream_response"] = upstream_response
-            ws.close()
+        if attach_only:
+            attach_timer = threading.Timer(config.TRANSPORT_ATTACH_TIMEOUT, check_attached)
+            attach_timer.daemon = True
+            attach_timer.start()
             return
+        if conversation_request is not None:
+            request, stages = conversation_request
+            upstream_response = post_conversation_request(request, stages) if request is not None else None
         else:
-            if upstream_response.status_code != 200:
-                logger.error(f"upstream_response status code: {upstream_response.status_code}, upstream_response: {upstream_response.text}")
-                complete_data = 'data: [DONE]\n\n'
-                timestamp = context["timestamp"]
-
-                new_data = {
-                    "id": chat_message_id,
-                    "object": "chat.completion.chunk",
-                    "created": timestamp,
-                    "model": model,
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": ''.join("```json\n{\n\"error\": \"Upstream error...\"\n}\n```")
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                data_queue.put(q_data)
-
-                q_data = complete_data
-                data_queue.put(('all_new_text', "```json\n{\n\"error\": \"Upstream error...\"\n}\n```"))
-                data_queue.put(q_data)
-                stop_event.set()
-                ws.close()
-            try:
-                upstream_response_json = upstream_response.json()
-                logger.debug(f"upstream_response_json: {upstream_response_json}")
-                # upstream_wss_url = upstream_response_json.get("wss_url", None)
-                upstream_response_id = upstream_response_json.get("response_id", None)
-                context["response_id"] = upstream_response_id
-            except json.JSONDecodeError:
-                pass
-        def run(*args):
-            while True:
-                if stop_event.is_set():
-                    logger.debug(f"接受到停止信号，停止 Websocket")
-                    ws.close()
-                    break
-
-    logger.debug(f"start wss...")
+            upstream_response = send_text_prompt_and_get_response(context.messages, context.api_key, True,
+                                                                  context.model)
+        # upstream_wss_url = None
+        transport = handle_conversation_response(context, upstream_response, data_queue, stop_event)
+        if transport is not None:
+            transport_negotiator.remember(BASE_URL, context.api_key, transport)
+        if transport != TRANSPORT_WSS:
+            ws.close()
 
     logger.debug(f"start wss...")
     wss_connect = websocket.WebSocketApp(wss_url,
@@ -1275,6 +1477,8 @@ def process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_m
                                          on_message=on_message,
                                          on_error=on_error,
                                          on_close=on_close)
+    # 客户端断开时立即关闭 websocket，不必等待下一条消息到达
+    stop_event.add_callback(wss_connect.close)
 
     if config.PROXY_CONFIG_ENABLED:
         logger.debug(f"start wss enabled proxy...")
@@ -1288,24 +1492,133 @@ def process_wss(wss_url, data_queue, stop_event, last_data_time, api_key, chat_m
     else:
         wss_connect.run_forever()
 
-    wss_connect.on_open = on_open
-    wss_connect.run_forever()
+    if attach_timer is not None:
+        attach_timer.cancel()
 
     logger.debug(f"end wss...")
-    if context["is_sse"] == True:
+    if context.is_sse == True:
         logger.debug(f"process sse...")
-        old_data_fetcher(context["upstream_response"], data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format)
+        old_data_fetcher(context.upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format, stream)
+
+    last_data_time[0] = time.time()
+
+
+def process_shared_wss(data_queue, stop_event, last_data_time, api_key, chat_message_id, model, response_format,
+                       messages, stream=True, context=None):
+    """
+    通过该账号共用的长连接 websocket 获取数据，参数与 process_wss 一致
+    """
+    attach_only = context is not None
+    if context is None:
+        context = StreamState(messages, api_key, model, chat_message_id, response_format, stream)
+    if attach_only:
+        connection = websocket_manager.acquire(api_key)
+    else:
+        # 建立 websocket 连接与构建对话请求（附件上传、arkose token）同时进行
+        stages = PrepareStages()
+        connection_future = stages.submit("websocket", websocket_manager.acquire, api_key)
+        try:
+            conversation_request = build_conversation_request(messages, api_key, model, stages)
+        except Exception:
+            release_connection_when_done(connection_future)
+            raise
+        connection = connection_future.result()
+    generation = connection.generation
+    try:
+        if not attach_only:
+            upstream_response = None
+            if conversation_request is not None:
+                upstream_response = post_conversation_request(conversation_request, stages)
+            transport = handle_conversation_response(context, upstream_response, data_queue, stop_event)
+            if transport is not None:
+                transport_negotiator.remember(BASE_URL, api_key, transport)
+            if transport == TRANSPORT_SSE:
+                connection.release()
+                connection = None
+                logger.debug(f"process sse...")
+                old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id,
+                                 model, response_format, stream)
+                return
+            if transport is None:
+                return
+
+        # 共用连接的线程不能阻塞，消息积压达到上限（客户端读取过慢）时放弃该对话，不在内存中缓存整段响应
+        results = Queue(config.STREAM_QUEUE_MAX_SIZE)
+        overflow = threading.Event()
+
+        def sink(result_json):
+            if overflow.is_set():
+                return
+            try:
+                results.put_nowait(result_json)
+            except Full:
+                overflow.set()
+
+        def wake_reader():
+            # 队列已满时读取方不会阻塞，不需要唤醒
+            try:
+                results.put_nowait(None)
+            except Full:
+                pass
+
+        # 停止时唤醒等待中的读取
+        stop_event.add_callback(wake_reader)
+        connection.subscribe(context.response_id, sink, generation)
+        try:
+            # 补连之前上游已经推送完的对话无法再收到消息，超时后按上游错误结束
+            timeout = config.TRANSPORT_ATTACH_TIMEOUT if attach_only else None
+            while not stop_event.is_set():
+                if overflow.is_set():
+                    logger.error("客户端读取过慢，websocket 消息积压超过 %d 条，停止接收", config.STREAM_QUEUE_MAX_SIZE)
+                    put_upstream_error(context, data_queue)
+                    stop_event.set()
+                    break
+                try:
+                    result_json = results.get(timeout=timeout)
+                except Empty:
+                    logger.error(f"补连 websocket 后未收到对话消息")
+                    put_upstream_error(context, data_queue)
+                    stop_event.set()
+                    break
+                if result_json is None:
+                    if not stop_event.is_set():
+                        logger.error(f"wss 连接已断开")
+                        put_upstream_error(context, data_queue)
+                        stop_event.set()
+                    break
+                timeout = None
+                if process_wss_result(context, result_json, data_queue, stop_event, last_data_time):
+                    break
+        finally:
+            connection.unsubscribe(context.response_id)
+    finally:
+        if connection is not None:
+            connection.release()
+
+    last_data_time[0] = time.time()
+
+
+def release_connection_when_done(connection_future):
+    """
+    不再需要正在建立的长连接时，在其建立完成后释放
+    """
+
+    def release(future):
+        if not future.cancelled() and future.exception() is None:
+            future.result().release()
+
+    connection_future.add_done_callback(release)
 
 
 def register_websocket(api_key):
-    url = f"{BASE_URL}{PROXY_API_PREFIX}/backend-api/register-websocket"
+    path = f"{PROXY_API_PREFIX}/backend-api/register-websocket"
     headers = {
         "Authorization": f"Bearer {api_key}"
     }
-    response = requests.post(url, headers=headers)
+    response = upstream_pool.request(http_client.upstream, 'POST', path, headers=headers)
     try:
         response_json = response.json()
-        logger.debug(f"register_websocket response: {response_json}")
+        logger.debug("register_websocket response: %s", response_json)
         wss_url = response_json.get("wss_url", None)
         return wss_url
     except json.JSONDecodeError:
@@ -1313,160 +1626,165 @@ def register_websocket(api_key):
         return None
 
 
-def old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
-                     response_format):
-    all_new_text = ""
+websocket_manager = WebSocketManager(register_websocket, config.WEBSOCKET_PING_INTERVAL, config.WEBSOCKET_PING_TIMEOUT,
+                                     config.WEBSOCKET_IDLE_TIMEOUT, config.WEBSOCKET_CONNECT_TIMEOUT,
+                                     config.WEBSOCKET_RECONNECT_ATTEMPTS)
 
-    first_output = True
 
-    # 当前时间戳
-    timestamp = int(time.time())
+def process_sse_text(context, chunk, data_queue, stop_event, last_data_time):
+    """
+    将上游 SSE 响应的字节数据交给增量解析器，并处理其中所有完整的事件
+    """
+    process_sse_events(context, context.sse_decoder.feed(chunk), data_queue, stop_event, last_data_time)
+
+
+def process_sse_events(context, events, data_queue, stop_event, last_data_time):
+    """
+    处理增量解析器返回的事件
+    """
+    for data in events:
+        if process_event_data(context, data, data_queue, stop_event, last_data_time) and stop_event.is_set():
+            break
+
 
-    buffer = ""
-    last_full_text = ""  # 用于存储之前所有出现过的 parts 组成的完整文本
-    last_full_code = ""
-    last_full_code_result = ""
-    last_content_type = None  # 用于记录上一个消息的内容类型
-    conversation_id = ''
-    citation_buffer = ""
-    citation_accumulating = False
-    file_output_buffer = ""
-    file_output_accumulating = False
-    execution_output_image_url_buffer = ""
-    execution_output_image_id_buffer = ""
+def process_event_data(context, data, data_queue, stop_event, last_data_time):
+    """
+    处理一个 SSE 事件的 data 字段，SSE 与 WSS 返回方式共用
+    :return 是否为结束事件
+    """
+    if data == '[DONE]':
+        logger.info(f"会话结束")
+        flush_pending_text(context, data_queue, last_data_time)
+        data_queue.put(('all_new_text', ''.join(context.all_new_text)))
+        data_queue.put('data: [DONE]\n\n')
+        last_data_time[0] = time.time()
+        return True
+    # 解析 data 块
     try:
-        for chunk in upstream_response.iter_content(chunk_size=1024):
-            if stop_event.is_set():
-                logger.info(f"接受到停止信号，停止数据处理线程")
-                break
-            if chunk:
-                buffer += chunk.decode('utf-8')
-                # 检查是否存在 "event: ping"，如果存在，则只保留 "data:" 后面的内容
-                if "event: ping" in buffer:
-                    if "data:" in buffer:
-                        buffer = buffer.split("data:", 1)[1]
-                        buffer = "data:" + buffer
-                # 使用正则表达式移除特定格式的字符串
-                # print("应用正则表达式之前的 buffer:", buffer.replace('\n', '\\n'))
-                buffer = re.sub(r'data: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}(\r\n|\r|\n){2}', '', buffer)
-                # print("应用正则表达式之后的 buffer:", buffer.replace('\n', '\\n'))
-
-                while 'data:' in buffer and '\n\n' in buffer:
-                    end_index = buffer.index('\n\n') + 2
-                    complete_data, buffer = buffer[:end_index], buffer[end_index:]
-                    # 解析 data 块
-                    try:
-                        data_json = json.loads(complete_data.replace('data: ', ''))
-                        logger.debug(f"data_json: {data_json}")
-                        # print(f"data_json: {data_json}")
-                        all_new_text, first_output, last_full_text, last_full_code, last_full_code_result, last_content_type, conversation_id, citation_buffer, citation_accumulating, file_output_buffer, file_output_accumulating, execution_output_image_url_buffer, execution_output_image_id_buffer, allow_id = process_data_json(
-                            data_json, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
-                            response_format, timestamp, first_output, last_full_text, last_full_code,
-                            last_full_code_result, last_content_type, conversation_id, citation_buffer,
-                            citation_accumulating, file_output_buffer, file_output_accumulating,
-                            execution_output_image_url_buffer, execution_output_image_id_buffer, all_new_text)
-                    except json.JSONDecodeError:
-                        # print("JSON 解析错误")
-                        logger.info(f"发送数据: {complete_data}")
-                        if complete_data == 'data: [DONE]\n\n':
-                            logger.info(f"会话结束")
-                            q_data = complete_data
-                            data_queue.put(('all_new_text', all_new_text))
-                            data_queue.put(q_data)
-                            last_data_time[0] = time.time()
-                            if stop_event.is_set():
-                                break
-        if citation_buffer != "":
-            new_data = {
+        data_json = decode_event(data)
+    except json.JSONDecodeError:
+        logger.info("发送数据: %s", data)
+        return False
+    if context.trace:
+        logger.debug("data_json: %s", data_json)
+    process_data_json(context, data_json, data_queue, stop_event, last_data_time)
+    return False
+
+
+def flush_pending_text(context, data_queue, last_data_time):
+    """
+    会话结束时输出尚未完成的图片，以及尚未确定是否为引用标记或沙箱文件链接的文本
+    """
+    if context.pending_images:
+        put_ready_images(context, data_queue, last_data_time, wait=True)
+    pending = context.rewriter.flush()
+    if not pending:
+        return
+    context.all_new_text.append(pending)
+    if context.stream:
+        data_queue.put((DELTA, context.encoder, pending, context.model))
+    last_data_time[0] = time.time()
+
+
+def finish_sse_text(context, data_queue, stop_event, last_data_time):
+    """
+    上游 SSE 响应结束后，处理残留的引用缓冲与无法解析的数据
+    """
+    chat_message_id = context.chat_message_id
+    timestamp = context.timestamp
+    buffer = context.sse_decoder.remaining()
+    flush_pending_text(context, data_queue, last_data_time)
+    if buffer:
+        # print(f"最后的数据: {buffer}")
+        # delete_conversation(conversation_id, api_key)
+        try:
+            buffer_json = json.loads(buffer)
+            logger.info(f"最后的缓存数据: {buffer_json}")
+            error_message = buffer_json.get("detail", {}).get("message", "未知错误")
+            error_data = {
                 "id": chat_message_id,
                 "object": "chat.completion.chunk",
                 "created": timestamp,
-                "model": message.get("metadata", {}).get("model_slug"),
+                "model": "error",
                 "choices": [
                     {
                         "index": 0,
                         "delta": {
-                            "content": ''.join(citation_buffer)
+                            "content": ''.join("```\n" + error_message + "\n```")
                         },
                         "finish_reason": None
                     }
                 ]
             }
-            tmp = 'data: ' + json.dumps(new_data) + '\n\n'
-            # print(f"发送数据: {tmp}")
+            tmp = 'data: ' + json.dumps(error_data) + '\n\n'
+            logger.info(f"发送最后的数据: {tmp}")
             # 累积 new_text
-            all_new_text += citation_buffer
-            q_data = 'data: ' + json.dumps(new_data) + '\n\n'
+            context.all_new_text.append("```\n" + error_message + "\n```")
+            q_data = 'data: ' + json.dumps(error_data) + '\n\n'
             data_queue.put(q_data)
             last_data_time[0] = time.time()
-        if buffer:
-            # print(f"最后的数据: {buffer}")
-            # delete_conversation(conversation_id, api_key)
-            try:
-                buffer_json = json.loads(buffer)
-                logger.info(f"最后的缓存数据: {buffer_json}")
-                error_message = buffer_json.get("detail", {}).get("message", "未知错误")
-                error_data = {
-                    "id": chat_message_id,
-                    "object": "chat.completion.chunk",
-                    "created": timestamp,
-                    "model": "error",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": ''.join("```\n" + error_message + "\n```")
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                tmp = 'data: ' + json.dumps(error_data) + '\n\n'
-                logger.info(f"发送最后的数据: {tmp}")
-                # 累积 new_text
-                all_new_text += ''.join("```\n" + error_message + "\n```")
-                q_data = 'data: ' + json.dumps(error_data) + '\n\n'
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
-                complete_data = 'data: [DONE]\n\n'
-                logger.info(f"会话结束")
-                q_data = complete_data
-                data_queue.put(('all_new_text', all_new_text))
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
-            except:
-                # print("JSON 解析错误")
-                logger.info(f"发送最后的数据: {buffer}")
-                error_data = {
-                    "id": chat_message_id,
-                    "object": "chat.completion.chunk",
-                    "created": timestamp,
-                    "model": "error",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": ''.join("```\n" + buffer + "\n```")
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                tmp = 'data: ' + json.dumps(error_data) + '\n\n'
-                q_data = tmp
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
-                complete_data = 'data: [DONE]\n\n'
-                logger.info(f"会话结束")
-                q_data = complete_data
-                data_queue.put(('all_new_text', all_new_text))
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
+            complete_data = 'data: [DONE]\n\n'
+            logger.info(f"会话结束")
+            q_data = complete_data
+            data_queue.put(('all_new_text', ''.join(context.all_new_text)))
+            data_queue.put(q_data)
+            last_data_time[0] = time.time()
+        except:
+            # print("JSON 解析错误")
+            logger.info(f"发送最后的数据: {buffer}")
+            error_data = {
+                "id": chat_message_id,
+                "object": "chat.completion.chunk",
+                "created": timestamp,
+                "model": "error",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "content": ''.join("```\n" + buffer + "\n```")
+                        },
+                        "finish_reason": None
+                    }
+                ]
+            }
+            tmp = 'data: ' + json.dumps(error_data) + '\n\n'
+            q_data = tmp
+            data_queue.put(q_data)
+            last_data_time[0] = time.time()
+            complete_data = 'data: [DONE]\n\n'
+            logger.info(f"会话结束")
+            q_data = complete_data
+            data_queue.put(('all_new_text', ''.join(context.all_new_text)))
+            data_queue.put(q_data)
+            last_data_time[0] = time.time()
+
+
+def put_stream_exception(context, data_queue, last_data_time, e):
+    logger.error(f"Exception: {e}")
+    mark_attempt_failed()
+    complete_data = 'data: [DONE]\n\n'
+    logger.info(f"会话结束")
+    q_data = complete_data
+    data_queue.put(('all_new_text', ''.join(context.all_new_text)))
+    data_queue.put(q_data)
+    last_data_time[0] = time.time()
+
+
+def old_data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+                     response_format, stream=True):
+    context = StreamState(None, api_key, model, chat_message_id, response_format, stream)
+    # 客户端断开时关闭上游连接，使阻塞中的 iter_content 立即返回
+    stop_event.add_callback(upstream_response.close)
+    try:
+        for chunk in upstream_response.iter_content(chunk_size=1024):
+            if stop_event.is_set():
+                logger.info(f"接受到停止信号，停止数据处理线程")
+                break
+            if chunk:
+                process_sse_text(context, chunk, data_queue, stop_event, last_data_time)
+        finish_sse_text(context, data_queue, stop_event, last_data_time)
     except Exception as e:
-        logger.error(f"Exception: {e}")
-        complete_data = 'data: [DONE]\n\n'
-        logger.info(f"会话结束")
-        q_data = complete_data
-        data_queue.put(('all_new_text', all_new_text))
-        data_queue.put(q_data)
-        last_data_time[0] = time.time()
+        if stop_event.is_set():
+            logger.info(f"上游连接已关闭，停止数据处理线程")
+            return
+        put_stream_exception(context, data_queue, last_data_time, e)
@@ -6,7 +6,8 @@ from flask_cors import CORS
 
 logger = init_logger(
     level=config.LOG_LEVEL,
-    need_to_file=config.NEED_LOG_TO_FILE
+    need_to_file=config.NEED_LOG_TO_FILE,
+    async_handlers=config.LOG_ASYNC
 )
 
 redis_client = init_redis(
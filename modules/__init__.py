@@ -1,6 +1,8 @@
+import atexit
 import config
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from fake_useragent import UserAgent
 from modules.RedisClient import RedisClient
 
@@ -19,7 +21,11 @@ def init_redis(host='127.0.0.1', port=6379, password=None, db=0):
     return redis_client
 
 
-def init_logger(level, need_to_file):
+def init_logger(level, need_to_file, async_handlers=False):
+    """
+    :param async_handlers: 是否异步输出日志，开启后请求线程（或事件循环）只将日志记录放入队列，
+                           由后台线程写入文件与控制台
+    """
     # 设置日志级别
     log_level_dict = {
         'DEBUG': logging.DEBUG,
@@ -34,16 +40,29 @@ def init_logger(level, need_to_file):
     logger = logging.getLogger()
     logger.setLevel(log_level_dict.get(level, logging.DEBUG))
 
+    handlers = []
+
     # 如果环境变量指示需要输出到文件
     if need_to_file:
         log_filename = './log/access.log'
         file_handler = TimedRotatingFileHandler(log_filename, when="midnight", interval=1, backupCount=30)
         file_handler.setFormatter(log_formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
     # 添加标准输出流处理器（控制台输出）
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(log_formatter)
-    logger.addHandler(stream_handler)
+    handlers.append(stream_handler)
+
+    if async_handlers:
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(QueueHandler(log_queue))
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        # 进程退出前写完队列中剩余的日志
+        atexit.register(listener.stop)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     return logger
@@ -0,0 +1,139 @@
+import threading
+import time
+
+import config
+from init import logger, redis_client
+
+# 账号隔离状态在 Redis 中的 key，多个 worker 共享
+quarantine_cache_key = "gpt_account_quarantine:"
+
+# 本进程从 Redis 同步隔离状态的间隔（秒）
+QUARANTINE_SYNC_INTERVAL = 5
+
+
+class NoAvailableAccountError(Exception):
+    """
+    账号池中没有可用的账号
+    """
+    pass
+
+
+class Account:
+    """
+    账号池中的一个上游账号
+    """
+
+    def __init__(self, username, password, weight):
+        self.username = username
+        self.password = password
+        self.weight = max(weight, 1)
+        # 最近一次获取到的 access token，用于将上游错误对应回账号
+        self.access_token = None
+        self.in_flight = 0
+        self.current_weight = 0
+        self.quarantined_until = 0
+
+
+class AccountPool:
+    """
+    上游账号池
+
+    按 strategy 在未被隔离的账号之间分配请求：
+    - least_in_flight: 选择（进行中的请求数 / 权重）最小的账号
+    - weighted_round_robin: 平滑加权轮询
+    账号返回 model_cap_exceeded / account_deactivated 等错误时会被隔离一段时间，隔离状态通过 Redis 在 worker 之间共享。
+    """
+
+    def __init__(self, accounts, strategy):
+        self.accounts = accounts
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._last_sync = 0
+
+    def acquire(self):
+        """
+        选择一个账号并计入进行中的请求，用完后必须调用 release
+        """
+        with self._lock:
+            account = self._select()
+            account.in_flight += 1
+            return account
+
+    def pick(self):
+        """
+        选择一个账号，不计入进行中的请求，用于获取 GPTs 信息等一次性的请求
+        """
+        with self._lock:
+            return self._select()
+
+    def release(self, account):
+        with self._lock:
+            account.in_flight -= 1
+
+    def _select(self):
+        now = time.time()
+        self._sync_quarantine(now)
+        candidates = [account for account in self.accounts if account.quarantined_until <= now]
+        if not candidates:
+            raise NoAvailableAccountError("no available upstream account")
+        if self.strategy == 'weighted_round_robin':
+            total_weight = sum(account.weight for account in candidates)
+            for account in candidates:
+                account.current_weight += account.weight
+            selected = max(candidates, key=lambda account: account.current_weight)
+            selected.current_weight -= total_weight
+            return selected
+        return min(candidates, key=lambda account: account.in_flight / account.weight)
+
+    def quarantine(self, account, seconds, reason):
+        until = time.time() + seconds
+        logger.warning(f"账号 {account.username} 已隔离 {seconds} 秒，原因: {reason}")
+        with self._lock:
+            account.quarantined_until = max(account.quarantined_until, until)
+        try:
+            redis_client.set(quarantine_cache_key + account.username, str(until), px=int(seconds * 1000))
+        except Exception as e:
+            logger.error(f"保存账号隔离状态失败: {e}")
+
+    def report_error(self, access_token, code):
+        """
+        根据上游返回的错误代码隔离对应的账号
+        """
+        seconds = QUARANTINE_SECONDS.get(code)
+        if not seconds or not access_token:
+            return
+        for account in self.accounts:
+            if account.access_token == access_token:
+                self.quarantine(account, seconds, code)
+                return
+
+    def _sync_quarantine(self, now):
+        if now - self._last_sync < QUARANTINE_SYNC_INTERVAL:
+            return
+        self._last_sync = now
+        try:
+            values = redis_client.mget([quarantine_cache_key + account.username for account in self.accounts])
+        except Exception as e:
+            logger.error(f"读取账号隔离状态失败: {e}")
+            return
+        for account, value in zip(self.accounts, values):
+            if value:
+                account.quarantined_until = max(account.quarantined_until, float(value))
+
+
+QUARANTINE_SECONDS = {
+    "model_cap_exceeded": config.ACCOUNT_POOL_MODEL_CAP_QUARANTINE_SECONDS,
+    "account_deactivated": config.ACCOUNT_POOL_DEACTIVATED_QUARANTINE_SECONDS,
+}
+
+
+def load_accounts():
+    accounts = [Account(item.get('username', ''), item.get('password', ''), int(item.get('weight', 1)))
+                for item in config.ACCOUNTS_CONFIG]
+    # 兼容只配置了单个 account 的情况
+    if not accounts:
+        accounts.append(Account(config.ACCOUNT_CONFIG_USERNAME, config.ACCOUNT_CONFIG_PASSWORD, 1))
+    return accounts
+
+
+account_pool = AccountPool(load_accounts(), config.ACCOUNT_POOL_STRATEGY)
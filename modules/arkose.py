@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+
+import config
+from init import logger
+from modules import http_client
+
+
+class ArkoseUrlStats:
+    """
+    单个 Arkose Token 获取地址的延迟与健康状况
+    """
+
+    def __init__(self, url):
+        self.url = url
+        # 请求耗时的指数移动平均（秒），未请求过时为 0，优先尝试
+        self.latency = 0.0
+        self.failures = 0
+        self.down_until = 0
+
+    def record_success(self, latency):
+        self.latency = latency if self.latency == 0 else self.latency * 0.7 + latency * 0.3
+        self.failures = 0
+        self.down_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        # 连续失败后暂停使用一段时间，指数退避，最长 60 秒
+        self.down_until = time.time() + min(2 ** self.failures, 60)
+
+    def is_healthy(self, now):
+        return self.down_until <= now
+
+
+class ArkosePool:
+    """
+    预取 Arkose Token 的池
+
+    后台线程保持 pool_size 个未过期的 token，取用后立即补充，补充时并行请求多个地址。
+    池为空时按地址的健康状况与延迟排序发起对冲请求：先请求最优的地址，hedge_delay 秒内没有结果再请求下一个，
+    使用最先返回的 token，其余请求返回的 token 放入池中。
+    """
+
+    def __init__(self, urls, pool_size, token_ttl, request_timeout, hedge_delay):
+        self.urls = [ArkoseUrlStats(url) for url in urls]
+        self.pool_size = pool_size
+        self.token_ttl = token_ttl
+        self.request_timeout = request_timeout
+        self.hedge_delay = hedge_delay
+        # (token, 过期时间)，按获取顺序排列
+        self._tokens = deque()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.urls) * 2, 1), thread_name_prefix="arkose")
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None or self.pool_size <= 0 or not self.urls:
+                return
+            self._thread = threading.Thread(target=self._run, name="arkose-prefetch", daemon=True)
+            self._thread.start()
+
+    def get(self):
+        """
+        :return arkose token，所有地址均获取失败时抛出异常
+        """
+        with self._condition:
+            token = self._pop_fresh()
+            # 通知后台线程补充
+            self._condition.notify_all()
+        if token:
+            return token
+        token = self._fetch_hedged()
+        if token:
+            return token
+        raise Exception("获取 arkose token 失败")
+
+    def _pop_fresh(self):
+        now = time.time()
+        while self._tokens:
+            token, expires_at = self._tokens.popleft()
+            if expires_at > now:
+                return token
+        return None
+
+    def _put(self, token):
+        with self._condition:
+            self._tokens.append((token, time.time() + self.token_ttl))
+
+    def _deficit(self):
+        now = time.time()
+        while self._tokens and self._tokens[0][1] <= now:
+            self._tokens.popleft()
+        return self.pool_size - len(self._tokens)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._deficit() <= 0:
+                    # 最早的 token 过期时也需要补充
+                    self._condition.wait(max(self._tokens[0][1] - time.time(), 0.1))
+                deficit = self._deficit()
+
+            urls = self._ranked_urls()
+            # 同时向多个地址请求，地址数不足时最优的地址承担多个请求
+            futures = [self._executor.submit(self._fetch_from, urls[i % len(urls)]) for i in range(deficit)]
+            fetched = 0
+            for future in futures:
+                token = future.result()
+                if token:
+                    self._put(token)
+                    fetched += 1
+            if fetched == 0:
+                # 所有地址均失败，稍后再试
+                time.sleep(1)
+
+    def _ranked_urls(self):
+        now = time.time()
+        healthy = sorted([stats for stats in self.urls if stats.is_healthy(now)], key=lambda stats: stats.latency)
+        # 全部不可用时仍按最早恢复的顺序尝试
+        unhealthy = sorted([stats for stats in self.urls if not stats.is_healthy(now)],
+                           key=lambda stats: stats.down_until)
+        return healthy + unhealthy
+
+    def _fetch_hedged(self):
+        pending = set()
+        token = None
+        for stats in self._ranked_urls():
+            pending.add(self._executor.submit(self._fetch_from, stats))
+            done, pending = wait(pending, timeout=self.hedge_delay, return_when=FIRST_COMPLETED)
+            token = self._first_token(done)
+            if token:
+                break
+        while not token and pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            token = self._first_token(done)
+        # 其余仍在进行的请求返回的 token 放入池中，不浪费
+        for future in pending:
+            future.add_done_callback(lambda f: f.result() and self._put(f.result()))
+        return token
+
+    def _first_token(self, done):
+        tokens = [future.result() for future in done if future.result()]
+        for token in tokens[1:]:
+            self._put(token)
+        return tokens[0] if tokens else None
+
+    def _fetch_from(self, stats):
+        full_url = f"{stats.url}/api/arkose/token"
+        payload = {'type': 'gpt-4'}
+        start_time = time.time()
+        try:
+            response = http_client.upstream.post(full_url, data=payload,
+                                                 timeout=(config.HTTP_CLIENT_CONNECT_TIMEOUT, self.request_timeout))
+            if response.status_code == 200:
+                token = response.json().get('token')
+                # 确保 token 字段存在且不是 None 或空字符串
+                if token:
+                    stats.record_success(time.time() - start_time)
+                    logger.debug(f"成功从 {stats.url} 获取 arkose token")
+                    return token
+                else:
+                    logger.error(f"获取的 token 响应无效: {token}")
+            else:
+                logger.error(f"获取 arkose token 失败: {response.status_code}, {response.text}")
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"请求异常: {e}")
+        stats.record_failure()
+        return None
+
+
+# 从环境变量获取 URL 列表，并去除每个 URL 周围的空白字符
+arkose_pool = ArkosePool([url.strip() for url in config.ARKOSE_URLS.split(",") if url.strip()],
+                         config.ARKOSE_POOL_SIZE, config.ARKOSE_POOL_TOKEN_TTL, config.ARKOSE_POOL_REQUEST_TIMEOUT,
+                         config.ARKOSE_POOL_HEDGE_DELAY)
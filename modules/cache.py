@@ -0,0 +1,130 @@
+import threading
+import time
+
+import config
+from init import logger, redis_client
+
+
+class RedisCache:
+    """
+    Redis 前的进程内缓存（L1）
+
+    命中时不访问 Redis；未命中时用一次 pipeline 同时取回值与剩余有效期（PTTL），
+    本地条目与 Redis 中的 key 同时过期（如 access token 的 exat），没有过期时间的 key 最多缓存 max_ttl 秒。
+    开启 keyspace_notifications 后订阅 Redis 的 keyspace 通知，其他进程修改或删除 key 时立即失效本地条目。
+    """
+
+    def __init__(self, max_ttl, max_entries, keyspace_notifications):
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.keyspace_notifications = keyspace_notifications
+        # key -> (value, 本地过期时间)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._listener = None
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+
+        self._start_listener()
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.pttl(key)
+        value, ttl = pipeline.execute()
+        # 不缓存不存在的 key，以免其他进程写入后仍读到空值
+        if value is not None:
+            self._store(key, value, ttl, now)
+        return value
+
+    def set(self, key, value, **kwargs):
+        """
+        写入 Redis 并更新本地条目，参数与 redis_client.set 相同
+        """
+        redis_client.set(key, value, **kwargs)
+        now = time.time()
+        if kwargs.get('exat') is not None:
+            ttl = (kwargs['exat'] - now) * 1000
+        elif kwargs.get('px') is not None:
+            ttl = kwargs['px']
+        elif kwargs.get('ex') is not None:
+            ttl = kwargs['ex'] * 1000
+        else:
+            ttl = -1
+        if isinstance(value, str):
+            value = value.encode()
+        self._store(key, value, ttl, now)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._invalidations += 1
+
+    def _store(self, key, value, ttl, now):
+        # ttl 为 Redis PTTL 的返回值（毫秒），-1 表示没有过期时间
+        if ttl is not None and ttl >= 0:
+            expires_at = now + min(ttl / 1000, self.max_ttl)
+        else:
+            expires_at = now + self.max_ttl
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._evict(now)
+            self._entries[key] = (value, expires_at)
+
+    def _evict(self, now):
+        for key in [key for key, entry in self._entries.items() if entry[1] <= now]:
+            del self._entries[key]
+        # 仍然超出时淘汰最早写入的条目
+        while len(self._entries) >= self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+    def _start_listener(self):
+        if not self.keyspace_notifications or self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is not None:
+                return
+            # 延迟到第一次访问时再启动，避免在 gunicorn fork 之前创建线程
+            self._listener = threading.Thread(target=self._listen, name="redis-cache-listener", daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        db = redis_client.connection_pool.connection_kwargs.get('db', 0)
+        prefix = f"__keyspace@{db}__:"
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(prefix + '*')
+                # 重新订阅之前可能错过了通知，清空本地条目
+                with self._lock:
+                    self._entries.clear()
+                for message in pubsub.listen():
+                    channel = message['channel']
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    self.invalidate(channel[len(prefix):])
+            except Exception as e:
+                logger.error(f"Redis keyspace 通知订阅失败: {e}")
+            time.sleep(1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0,
+            }
+
+
+redis_cache = RedisCache(config.L1_CACHE_MAX_TTL, config.L1_CACHE_MAX_ENTRIES, config.L1_CACHE_KEYSPACE_NOTIFICATIONS)
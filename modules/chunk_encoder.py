@@ -0,0 +1,95 @@
+import json
+from json.encoder import encode_basestring
+
+import config
+from init import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_json_string(text):
+    """
+    :return 与 json.dumps(text, ensure_ascii=False) 一致的 UTF-8 字节串
+    """
+    return encode_basestring(text).encode('utf-8')
+
+
+def encode_json_string_orjson(text):
+    return orjson.dumps(text)
+
+
+if config.JSON_ENCODER == 'orjson' and orjson is None:
+    logger.warning("未安装 orjson，将使用标准库 json 序列化流式响应")
+encode_content = encode_json_string_orjson if config.JSON_ENCODER == 'orjson' and orjson is not None \
+    else encode_json_string
+
+
+class ChunkEncoder:
+    """
+    单次会话的 chat.completion.chunk 编码
+
+    id、created 与 model 在整个会话中不变，chunk 中 content 之前与之后的部分每个模型只序列化一次，
+    之后每条增量只需转义 content 字符串并拼接，直接得到写给客户端的字节串。
+    输出与 json.dumps(chunk, ensure_ascii=False) 逐字节一致（orjson 对控制字符的转义写法不同，但同样是合法的 JSON）
+    """
+
+    __slots__ = ("chat_message_id", "timestamp", "_envelopes")
+
+    def __init__(self, chat_message_id, timestamp):
+        self.chat_message_id = chat_message_id
+        self.timestamp = timestamp
+        # model -> (content 之前的部分, content 之后的部分)
+        self._envelopes = {}
+
+    def _envelope(self, model):
+        envelope = self._envelopes.get(model)
+        if envelope is None:
+            placeholder = "\0"
+            chunk = json.dumps({
+                "id": self.chat_message_id,
+                "object": "chat.completion.chunk",
+                "created": self.timestamp,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "content": placeholder
+                        },
+                        "finish_reason": None
+                    }
+                ]
+            }, ensure_ascii=False)
+            prefix, suffix = chunk.split('"\\u0000"')
+            envelope = (b'data: ' + prefix.encode('utf-8'), suffix.encode('utf-8') + b'\n\n')
+            self._envelopes[model] = envelope
+        return envelope
+
+    def content(self, text, model):
+        """
+        :return 包含 content 增量的 chunk
+        """
+        prefix, suffix = self._envelope(model)
+        return prefix + encode_content(text) + suffix
+
+    def role(self, model):
+        """
+        :return 流式响应开头声明 assistant 角色的 chunk
+        """
+        chunk = {
+            "id": self.chat_message_id,
+            "object": "chat.completion.chunk",
+            "created": self.timestamp,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"role": "assistant"},
+                    "finish_reason": None
+                }
+            ]
+        }
+        return ('data: ' + json.dumps(chunk, ensure_ascii=False) + '\n\n').encode('utf-8')
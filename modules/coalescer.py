@@ -0,0 +1,124 @@
+import asyncio
+import time
+from queue import Empty
+
+import config
+
+# 数据队列中的 content 增量：('delta', ChunkEncoder, 文本, model)，由输出端编码为 chunk
+DELTA = 'delta'
+
+# 队列中暂时没有数据
+NO_ITEM = object()
+
+
+def is_delta(item):
+    return isinstance(item, tuple) and item[0] == DELTA
+
+
+class DeltaCoalescer:
+    """
+    数据队列与 HTTP 响应之间的输出阶段，将连续的 content 增量合并为一个 chunk
+
+    两次增量的间隔小于 max_delay 时（上游输出较快），等待 max_delay 后把队列中已有的增量一起合并，
+    合并的文本达到 max_chars 个字符时立即输出；间隔较大时不等待，不增加首字与逐字的延迟。
+    max_delay 为 0 时只合并队列中已经积压的增量。
+    """
+
+    def __init__(self, max_delay, max_chars):
+        self.max_delay = max_delay
+        self.max_chars = max_chars
+        self._last_delta_time = 0
+        # 合并时取出的下一条非增量数据
+        self._held = NO_ITEM
+
+    def wait_time(self):
+        """
+        :return 收到一条增量后，合并前需要等待的秒数
+        """
+        now = time.monotonic()
+        fast = now - self._last_delta_time < self.max_delay
+        self._last_delta_time = now
+        return self.max_delay if fast else 0
+
+    def take_held(self):
+        item, self._held = self._held, NO_ITEM
+        return item
+
+    def merge(self, first, get_nowait):
+        """
+        :param get_nowait: 不阻塞地取出一条数据，队列为空时返回 NO_ITEM
+        :return 合并后的 chunk
+        """
+        _, encoder, text, model = first
+        texts = [text]
+        size = len(text)
+        while size < self.max_chars:
+            item = get_nowait()
+            if item is NO_ITEM:
+                break
+            if not is_delta(item) or item[3] != model:
+                self._held = item
+                break
+            texts.append(item[2])
+            size += len(item[2])
+        if len(texts) > 1:
+            # 合并的增量在等待期间到达，下一条增量的间隔从最后合并的一条算起，而不是从本次等待开始时算起，
+            # 否则正常速率下合并后的下一条增量总被当作慢速增量单独输出
+            self._last_delta_time = time.monotonic()
+        return encoder.content(''.join(texts), model)
+
+
+def coalesce(data_queue):
+    """
+    逐条产出数据队列中的数据，content 增量合并并编码为 chunk
+    """
+    coalescer = DeltaCoalescer(config.STREAM_COALESCE_MAX_DELAY, config.STREAM_COALESCE_MAX_CHARS)
+
+    def get_nowait():
+        try:
+            return data_queue.get_nowait()
+        except Empty:
+            return NO_ITEM
+
+    while True:
+        item = coalescer.take_held()
+        if item is NO_ITEM:
+            item = data_queue.get()
+        if not is_delta(item):
+            yield item
+            continue
+        if config.STREAM_COALESCE_ENABLED:
+            delay = coalescer.wait_time()
+            if delay:
+                time.sleep(delay)
+            yield coalescer.merge(item, get_nowait)
+        else:
+            yield item[1].content(item[2], item[3])
+
+
+async def async_coalesce(data_queue):
+    """
+    与 coalesce 一致，用于 asyncio 执行模式
+    """
+    coalescer = DeltaCoalescer(config.STREAM_COALESCE_MAX_DELAY, config.STREAM_COALESCE_MAX_CHARS)
+
+    def get_nowait():
+        try:
+            return data_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return NO_ITEM
+
+    while True:
+        item = coalescer.take_held()
+        if item is NO_ITEM:
+            item = await data_queue.get()
+        if not is_delta(item):
+            yield item
+            continue
+        if config.STREAM_COALESCE_ENABLED:
+            delay = coalescer.wait_time()
+            if delay:
+                await asyncio.sleep(delay)
+            yield coalescer.merge(item, get_nowait)
+        else:
+            yield item[1].content(item[2], item[3])
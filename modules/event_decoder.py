@@ -0,0 +1,29 @@
+import json
+
+import config
+from init import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decode_event_orjson(data):
+    """
+    orjson 不接受部分标准库可以解析的输入（如不成对的 UTF-16 代理），解析失败时交给标准库再试一次，
+    仍然失败时抛出的错误与 json.loads 一致
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+if config.JSON_DECODER == 'orjson' and orjson is None:
+    logger.warning("未安装 orjson，将使用标准库 json 解析上游消息")
+# 解析一条上游消息的 data 字段
+# 不按需解析 metadata：process_data_json 每条消息都会读取其中的 citations、jit_plugin_data、model_slug，
+# 而纯 Python 找到 metadata 的起止位置需要逐个扫描字符串与括号，耗时为完整解析的数倍（见 bench/event_decoder.py），
+# 引用与执行结果较多的消息改用 orjson 完整解析
+decode_event = decode_event_orjson if config.JSON_DECODER == 'orjson' and orjson is not None else json.loads
@@ -0,0 +1,105 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from init import logger
+
+
+class ExecutorRejectedError(Exception):
+    """
+    线程池与等待队列均已满，请求被拒绝
+    """
+    pass
+
+
+class BoundedExecutor:
+    """
+    有界的线程池
+
+    同时执行的任务数不超过 max_workers，排队等待的任务数不超过 queue_size，
+    超出时按 rejection_policy 处理：reject 立即拒绝，block 最多等待 block_timeout 秒后再拒绝。
+    任务完成通过 Future 通知，调用方不需要轮询。
+    """
+
+    def __init__(self, name, max_workers, queue_size, rejection_policy, block_timeout):
+        self.name = name
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.rejection_policy = rejection_policy
+        self.block_timeout = block_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._running = 0
+        self._peak_running = 0
+        self._total_wait_time = 0.0
+
+    def submit(self, fn, *args):
+        if self.rejection_policy == 'block':
+            acquired = self._slots.acquire(timeout=self.block_timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self._rejected += 1
+            logger.warning(f"{self.name} 线程池已满，拒绝新任务: {self.stats()}")
+            raise ExecutorRejectedError(f"{self.name} is busy")
+
+        with self._lock:
+            self._submitted += 1
+        try:
+            future = self._executor.submit(self._run, fn, args, time.time())
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _run(self, fn, args, submit_time):
+        wait_time = time.time() - submit_time
+        with self._lock:
+            self._running += 1
+            self._peak_running = max(self._peak_running, self._running)
+            self._total_wait_time += wait_time
+        try:
+            return fn(*args)
+        except Exception as e:
+            with self._lock:
+                self._failed += 1
+            logger.error(f"{self.name} 任务执行失败: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+            if wait_time > 1:
+                logger.info(f"{self.name} 任务排队 {wait_time:.2f} 秒后开始执行")
+
+    def stats(self):
+        with self._lock:
+            queued = self._submitted - self._completed - self._running
+            return {
+                "max_workers": self.max_workers,
+                "queue_size": self.queue_size,
+                "running": self._running,
+                "queued": queued,
+                "peak_running": self._peak_running,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_wait_time": round(self._total_wait_time / self._submitted, 4) if self._submitted else 0,
+            }
+
+
+# 对话与绘图请求的上游数据处理线程池
+fetcher_executor = BoundedExecutor("fetcher", config.FETCHER_POOL_MAX_WORKERS, config.FETCHER_POOL_QUEUE_SIZE,
+                                   config.FETCHER_POOL_REJECTION_POLICY, config.FETCHER_POOL_BLOCK_TIMEOUT)
+
+# 对冲请求中各路请求的线程池，不排队，已满时不再发起对冲请求
+hedge_executor = BoundedExecutor("hedge", config.HEDGE_MAX_WORKERS, 0, 'reject', 0)
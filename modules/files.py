@@ -2,13 +2,13 @@ import hashlib
 import json
 from io import BytesIO
 
-import requests
 from PIL import Image
 from flask import jsonify
 
-import config
 from auth import get_access_key
-from init import logger, redis_client
+from init import logger
+from modules import http_client
+from modules.cache import redis_cache
 
 
 def get_image_dimensions(file_content):
@@ -73,7 +73,7 @@ def upload_file(file_content, mime_type, api_key, base_url, proxy_api_prefix):
     headers = {
         "Authorization": f"Bearer {api_key}"
     }
-    upload_response = requests.post(upload_api_url, json=upload_request_payload, headers=headers)
+    upload_response = http_client.upstream.post(upload_api_url, json=upload_request_payload, headers=headers)
     logger.debug(f"upload_response: {upload_response.text}")
     if upload_response.status_code != 200:
         raise Exception("Failed to get upload URL")
@@ -89,7 +89,7 @@ def upload_file(file_content, mime_type, api_key, base_url, proxy_api_prefix):
         'Content-Type': mime_type,
         'x-ms-blob-type': 'BlockBlob'  # 添加这个头部
     }
-    put_response = requests.put(upload_url, data=file_content, headers=put_headers, proxies=config.PROXIES)
+    put_response = http_client.external.put(upload_url, data=file_content, headers=put_headers)
     if put_response.status_code != 201:
         logger.debug(f"put_response: {put_response.text}")
         logger.debug(f"put_response status_code: {put_response.status_code}")
@@ -97,7 +97,7 @@ def upload_file(file_content, mime_type, api_key, base_url, proxy_api_prefix):
 
     # 第3步：检测上传是否成功并检查响应
     check_url = f"{base_url}{proxy_api_prefix}/backend-api/files/{file_id}/uploaded"
-    check_response = requests.post(check_url, json={}, headers=headers)
+    check_response = http_client.upstream.post(check_url, json={}, headers=headers)
     logger.debug(f"check_response: {check_response.text}")
     if check_response.status_code != 200:
         raise Exception("Failed to check file upload completion")
@@ -120,7 +120,7 @@ def get_file_metadata(file_content, mime_type, api_key, base_url, proxy_api_pref
     sha256_hash = hashlib.sha256(file_content).hexdigest()
     logger.debug(f"sha256_hash: {sha256_hash}")
     # 首先尝试从Redis中获取数据
-    cached_data = redis_client.get(sha256_hash)
+    cached_data = redis_cache.get(sha256_hash)
     if cached_data is not None:
         # 如果在Redis中找到了数据，解码后直接返回
         logger.info(f"从Redis中获取到文件缓存数据")
@@ -134,7 +134,7 @@ def get_file_metadata(file_content, mime_type, api_key, base_url, proxy_api_pref
         headers = {
             "Authorization": f"Bearer {api_key}"
         }
-        check_response = requests.post(check_url, json={}, headers=headers)
+        check_response = http_client.upstream.post(check_url, json={}, headers=headers)
         logger.debug(f"check_response: {check_response.text}")
         if check_response.status_code != 200:
             tag = False
@@ -160,7 +160,7 @@ def get_file_metadata(file_content, mime_type, api_key, base_url, proxy_api_pref
         new_file_data['height'] = height
 
     # 将新的文件数据存入Redis
-    redis_client.set(sha256_hash, json.dumps(new_file_data))
+    redis_cache.set(sha256_hash, json.dumps(new_file_data))
 
     return new_file_data
 
@@ -0,0 +1,74 @@
+import math
+import threading
+from collections import deque
+
+import config
+
+# 样本数不足时使用 max_delay
+MIN_SAMPLES = 20
+
+
+class HedgePolicy:
+    """
+    对冲请求的触发时机与预算
+
+    记录最近 window 个对话请求从发出到产生第一条数据的耗时，超过其 percentile 分位数（限制在 min_delay 与 max_delay 之间）
+    仍没有数据时才发起对冲请求；每个对话请求为预算增加 budget_ratio，每次对冲消耗 1，
+    预算最多累积 budget_burst，对冲请求数因此不会超过对话请求数的 budget_ratio 倍。
+    """
+
+    def __init__(self, percentile, min_delay, max_delay, window, budget_ratio, budget_burst):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self._samples = deque(maxlen=window)
+        self._budget = 0.0
+        self._hedged = 0
+        self._won = 0
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        with self._lock:
+            self._budget = min(self._budget + self.budget_ratio, self.budget_burst)
+
+    def try_spend(self):
+        """
+        :return 预算充足时扣除并返回 True
+        """
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            self._hedged += 1
+            return True
+
+    def record_first_event(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def record_hedge_won(self):
+        with self._lock:
+            self._won += 1
+
+    def delay(self):
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return self.max_delay
+            samples = sorted(self._samples)
+        index = min(math.ceil(len(samples) * self.percentile / 100), len(samples)) - 1
+        return min(max(samples[index], self.min_delay), self.max_delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "samples": len(self._samples),
+                "budget": round(self._budget, 2),
+                "hedged": self._hedged,
+                "hedge_won": self._won,
+            }
+
+
+hedge_policy = HedgePolicy(config.HEDGE_PERCENTILE, config.HEDGE_MIN_DELAY, config.HEDGE_MAX_DELAY, config.HEDGE_WINDOW,
+                           config.HEDGE_BUDGET_RATIO, config.HEDGE_BUDGET_BURST)
@@ -0,0 +1,195 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from urllib3.util.ssl_ import is_ipaddress
+
+import config
+from init import logger
+
+"""
+共用的 HTTP 客户端
+
+所有上游请求复用同一组连接池，避免每次请求都重新建立 TCP / TLS 连接：
+- upstream: 访问 upstream_base_url（Ninja）与 arkose 等服务，不走代理
+- external: 访问文件上传下载、图片下载等外部地址，按 proxy 配置走代理
+"""
+
+
+class NoCookiePolicy(DefaultCookiePolicy):
+    """
+    会话在多个账号之间共用，不保存任何 cookie，避免不同账号的请求互相携带
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class PooledSession(requests.Session):
+    """
+    带默认超时的 requests.Session
+    """
+
+    def __init__(self, proxies, pool_connections, pool_maxsize, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+        self.cookies.set_policy(NoCookiePolicy())
+        if proxies:
+            self.proxies.update(proxies)
+        adapter_class = DNSCacheAdapter if config.HTTP_CLIENT_DNS_CACHE_TTL > 0 else HTTPAdapter
+        adapter = adapter_class(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        return super().request(method, url, **kwargs)
+
+
+class DNSCache:
+    """
+    域名解析结果的缓存，只用于 upstream / external 两个会话建立的连接，不影响进程内的其他连接
+
+    最多保存 max_size 个域名，超出时淘汰最早解析的域名；条目按解析时间先后排列，每次查询时先淘汰已经过期的条目
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        # 域名 -> (过期时间, 地址列表)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        :return 域名解析得到的地址列表，解析失败时抛出 socket.gaierror
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._entries.get(host)
+        if entry is not None:
+            return entry[1]
+        infos = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self._entries.pop(host, None)
+            self._entries[host] = (now + self.ttl, addresses)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return addresses
+
+    def discard(self, host):
+        with self._lock:
+            self._entries.pop(host, None)
+
+    def _evict_expired(self, now):
+        entries = self._entries
+        while entries:
+            host, (expires_at, _) = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            del entries[host]
+
+
+dns_cache = DNSCache(config.HTTP_CLIENT_DNS_CACHE_TTL, config.HTTP_CLIENT_DNS_CACHE_MAX_SIZE)
+
+
+class DNSCacheConnectionMixin:
+    """
+    建立连接时使用缓存的解析结果，依次尝试各个地址
+
+    只在建立 TCP 连接期间把 _dns_host 换成地址，TLS 的 SNI、证书校验与 Host 请求头仍使用原域名
+    """
+
+    def _new_conn(self):
+        host = self._dns_host
+        if is_ipaddress(host.strip("[]")):
+            return super()._new_conn()
+        try:
+            addresses = dns_cache.resolve(host, self.port)
+        except OSError:
+            # 解析失败时交给 urllib3 自行解析，抛出的错误与不使用缓存时一致
+            return super()._new_conn()
+        error = None
+        for address in addresses:
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (ConnectTimeoutError, NewConnectionError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+        # 缓存的地址全部连接失败时可能已经变更，下次连接重新解析
+        dns_cache.discard(host)
+        raise error
+
+
+class DNSCacheHTTPConnection(DNSCacheConnectionMixin, HTTPConnection):
+    pass
+
+
+class DNSCacheHTTPSConnection(DNSCacheConnectionMixin, HTTPSConnection):
+    pass
+
+
+class DNSCacheHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = DNSCacheHTTPConnection
+
+
+class DNSCacheHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = DNSCacheHTTPSConnection
+
+
+DNS_CACHE_POOL_CLASSES = {"http": DNSCacheHTTPConnectionPool, "https": DNSCacheHTTPSConnectionPool}
+
+
+class DNSCacheAdapter(HTTPAdapter):
+    """
+    建立连接时使用 DNSCache 的 HTTPAdapter；经 HTTP 代理访问时缓存代理地址的解析结果，SOCKS 代理不使用缓存
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = DNS_CACHE_POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if proxy.lower().startswith(("http://", "https://")):
+            manager.pool_classes_by_scheme = DNS_CACHE_POOL_CLASSES
+        return manager
+
+
+def warm_up(urls):
+    """
+    在后台预先建立到上游的连接，首个请求不必再等待握手
+    """
+
+    def run():
+        for url in urls:
+            try:
+                upstream.head(url, timeout=config.HTTP_CLIENT_CONNECT_TIMEOUT)
+                logger.debug(f"已预热连接: {url}")
+            except requests.RequestException as e:
+                logger.debug(f"预热连接失败: {url}, {e}")
+
+    if config.HTTP_CLIENT_WARM_UP:
+        threading.Thread(target=run, name="http-warm-up", daemon=True).start()
+
+
+# 普通请求的默认超时（连接超时, 读取超时），流式对话请求使用 STREAM_TIMEOUT
+DEFAULT_TIMEOUT = (config.HTTP_CLIENT_CONNECT_TIMEOUT, config.HTTP_CLIENT_READ_TIMEOUT)
+STREAM_TIMEOUT = (config.HTTP_CLIENT_CONNECT_TIMEOUT, config.HTTP_CLIENT_STREAM_READ_TIMEOUT)
+
+upstream = PooledSession({}, config.HTTP_CLIENT_POOL_CONNECTIONS, config.HTTP_CLIENT_POOL_MAXSIZE, DEFAULT_TIMEOUT)
+external = PooledSession(config.PROXIES, config.HTTP_CLIENT_POOL_CONNECTIONS, config.HTTP_CLIENT_POOL_MAXSIZE,
+                         DEFAULT_TIMEOUT)
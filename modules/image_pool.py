@@ -0,0 +1,39 @@
+from concurrent.futures import Future
+
+import config
+from modules.executor import BoundedExecutor, ExecutorRejectedError
+
+# 获取与下载回复中图片的线程池，流处理线程不再等待图片下载
+image_executor = BoundedExecutor("image", config.IMAGE_POOL_MAX_WORKERS, config.IMAGE_POOL_QUEUE_SIZE, 'reject', 0)
+
+
+class PendingImage:
+    """
+    已提交到图片线程池、尚未输出的图片
+    """
+
+    __slots__ = ("future", "slot", "has_text", "model_slug")
+
+    def __init__(self, future, slot, has_text, model_slug):
+        self.future = future
+        # 在 StreamState.all_new_text 中预留的位置
+        self.slot = slot
+        # 图片之前是否已经输出过文本
+        self.has_text = has_text
+        self.model_slug = model_slug
+
+
+def submit_image_task(fn, *args):
+    """
+    提交图片任务，线程池已满时在当前线程中直接执行
+    :return Future
+    """
+    try:
+        return image_executor.submit(fn, *args)
+    except ExecutorRejectedError:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from queue import Full
+
+import config
+from init import logger
+
+
+class KeepAliveHandle:
+    """
+    一个注册到保活调度器中的流
+    """
+
+    def __init__(self, last_data_time, stop_event, queue, frame):
+        self.last_data_time = last_data_time
+        self.stop_event = stop_event
+        self.queue = queue
+        # 预先序列化好的保活消息，调度时直接写入队列
+        self.frame = frame
+        self.cancelled = False
+        self.timer = None
+
+    def is_active(self):
+        return not self.cancelled and not self.stop_event.is_set()
+
+
+class KeepAliveScheduler:
+    """
+    进程内共用的保活调度器（线程模式）
+
+    以每个流的 last_data_time + interval 作为到期时间放入最小堆，由单个后台线程按到期顺序唤醒，
+    只有真正空闲达到 interval 的流才会收到保活消息，正在输出数据的流只会被顺延。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def register(self, last_data_time, stop_event, queue, frame):
+        handle = KeepAliveHandle(last_data_time, stop_event, queue, frame)
+        with self._condition:
+            if self._thread is None:
+                # 延迟到第一次注册时再启动，避免在 gunicorn fork 之前创建线程
+                self._thread = threading.Thread(target=self._run, name="keep-alive-scheduler", daemon=True)
+                self._thread.start()
+            self._push(last_data_time[0] + self.interval, handle)
+        return handle
+
+    def unregister(self, handle):
+        # 惰性删除：堆中的条目在下次到期时被丢弃
+        handle.cancelled = True
+
+    def _push(self, due, handle):
+        heapq.heappush(self._heap, (due, next(self._counter), handle))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                due, _, handle = self._heap[0]
+                now = time.time()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                if not handle.is_active():
+                    continue
+                try:
+                    self._push(fire(handle, self.interval, now), handle)
+                except Exception as e:
+                    logger.error(f"发送保活消息失败: {e}")
+
+
+class AsyncKeepAliveScheduler:
+    """
+    进程内共用的保活调度器（asyncio 模式）
+
+    到期时间的计算与线程模式一致，定时由事件循环自身的定时器堆完成，不需要额外的协程或线程。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def register(self, last_data_time, stop_event, queue, frame):
+        handle = KeepAliveHandle(last_data_time, stop_event, queue, frame)
+        loop = asyncio.get_running_loop()
+        delay = last_data_time[0] + self.interval - time.time()
+        handle.timer = loop.call_later(max(delay, 0), self._fire, loop, handle)
+        return handle
+
+    def unregister(self, handle):
+        handle.cancelled = True
+        if handle.timer is not None:
+            handle.timer.cancel()
+
+    def _fire(self, loop, handle):
+        if not handle.is_active():
+            return
+        now = time.time()
+        due = fire(handle, self.interval, now)
+        handle.timer = loop.call_later(due - now, self._fire, loop, handle)
+
+
+def fire(handle, interval, now):
+    """
+    到期处理：空闲达到 interval 时发送保活消息
+    :return 下一次到期时间
+    """
+    due = handle.last_data_time[0] + interval
+    if due <= now:
+        # 队列已满说明客户端还有数据未读取，不需要保活，也不能阻塞调度器
+        if not handle.queue.full():
+            try:
+                handle.queue.put_nowait(handle.frame)  # 发送保活消息
+            except Full:
+                pass
+        handle.last_data_time[0] = now
+        due = now + interval
+    return due
+
+
+keep_alive_scheduler = KeepAliveScheduler(config.KEEP_ALIVE_INTERVAL)
+async_keep_alive_scheduler = AsyncKeepAliveScheduler(config.KEEP_ALIVE_INTERVAL)
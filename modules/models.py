@@ -1,9 +1,9 @@
 import uuid
 
-import requests
 import config
 import init
 from auth import get_access_key_default, get_access_key
+from modules import http_client
 
 
 def get_accessible_model_list():
@@ -44,7 +44,7 @@ def fetch_gizmo_info(base_url, proxy_api_prefix, model_id, key_for_gpts_info):
         "Authorization": f"Bearer {ak}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = http_client.upstream.get(url, headers=headers)
     # init.logger.debug(f"fetch_gizmo_info_response: {response.text}")
     if response.status_code == 200:
         return response.json()
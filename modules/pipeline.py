@@ -0,0 +1,55 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from init import logger
+
+# 准备阶段使用的线程池，只执行不再提交其他阶段的任务，避免线程池内互相等待
+prepare_executor = ThreadPoolExecutor(max_workers=config.PREPARE_POOL_MAX_WORKERS, thread_name_prefix="prepare")
+
+
+class PrepareStages:
+    """
+    对话请求发出前的准备阶段
+
+    websocket 连接、附件下载上传、arkose token 等互不依赖的阶段并行执行，在发送对话请求前汇合，
+    首字耗时取决于最慢的阶段而不是各阶段之和。每个阶段的耗时在汇合时输出到日志。
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self._futures = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args):
+        """
+        在线程池中执行一个阶段
+        :return Future
+        """
+        future = prepare_executor.submit(self._run, name, fn, args)
+        self._futures[name] = future
+        return future
+
+    def run(self, name, fn, *args):
+        """
+        在当前线程中执行一个阶段，用于需要再提交其他阶段的任务
+        """
+        return self._run(name, fn, args)
+
+    def result(self, name):
+        return self._futures[name].result()
+
+    def _run(self, name, fn, args):
+        start_time = time.time()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._timings[name] = time.time() - start_time
+
+    def log_timings(self):
+        with self._lock:
+            timings = ", ".join(f"{name}: {seconds:.3f}s" for name, seconds in self._timings.items())
+        logger.info(f"请求准备耗时 {time.time() - self.start_time:.3f}s ({timings})")
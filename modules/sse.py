@@ -0,0 +1,131 @@
+import base64
+import re
+
+# 上游定时发送的时间戳保活数据，如 data: 2024-01-01 00:00:00.000000
+KEEP_ALIVE_DATA_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}\Z')
+
+
+class SSEDecoder:
+    """
+    上游 SSE 响应的增量解析
+
+    按字节累积上游数据，从上次扫描结束的位置继续查找事件分隔符 \\n\\n，每个字节只扫描一次；
+    UTF-8 多字节字符中不会出现 \\n，完整的事件总能单独解码，数据块在多字节字符中间截断也不影响。
+    上游使用 \\r\\n 或 \\r 换行时先统一替换为 \\n，事件分隔符 \\r\\n\\r\\n、\\r\\r 随之变为 \\n\\n；
+    SSE 的字段值中不会出现换行符，替换不会改变事件内容。
+    ping 事件与时间戳保活数据在解析事件时直接跳过
+    """
+
+    __slots__ = ("_buffer", "_scan_pos", "_has_cr", "_pending_cr")
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 下次查找分隔符的起始位置，之前的部分已确认不包含分隔符
+        self._scan_pos = 0
+        # 出现过 \r 之后才替换换行符，只使用 \n 换行时不增加开销
+        self._has_cr = False
+        # 上一段数据以 \r 结尾，下一段数据开头的 \n 与它组成 \r\n
+        self._pending_cr = False
+
+    def feed(self, chunk):
+        """
+        :param chunk: 上游返回的字节串
+        :return 其中完整事件的 data 字段组成的列表
+        """
+        if self._has_cr or b"\r" in chunk:
+            self._has_cr = True
+            chunk = self._normalize_newlines(chunk)
+        buffer = self._buffer
+        buffer += chunk
+        events = []
+        start = 0
+        pos = self._scan_pos
+        while True:
+            end = buffer.find(b"\n\n", pos)
+            if end < 0:
+                break
+            data = parse_event(buffer, start, end)
+            if data is not None:
+                events.append(data)
+            start = pos = end + 2
+        if start:
+            del buffer[:start]
+            pos -= start
+        # 末尾的 \n 可能与下一段数据的开头组成分隔符
+        self._scan_pos = max(len(buffer) - 1, pos)
+        return events
+
+    def _normalize_newlines(self, chunk):
+        if not chunk:
+            return chunk
+        if self._pending_cr and chunk.startswith(b"\n"):
+            # 上一段末尾的 \r 已经替换为 \n，与之组成 \r\n 的 \n 不再重复计入
+            chunk = chunk[1:]
+        # 末尾的 \r 立即替换，只使用 \r 换行时最后一个事件不必等待下一段数据
+        self._pending_cr = chunk.endswith(b"\r")
+        return chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    def remaining(self):
+        """
+        上游响应结束时调用
+        :return 尚未组成完整事件的数据，如上游直接返回的 JSON 错误信息
+        """
+        text = self._buffer.decode("utf-8", errors="replace")
+        self._buffer = bytearray()
+        self._scan_pos = 0
+        self._has_cr = False
+        self._pending_cr = False
+        return text
+
+
+def decode_frame_body(body):
+    """
+    websocket 消息的 body 为 base64 编码的 SSE 数据，上游可能在一条消息中合并发送多个事件
+    :return 其中所有事件的 data 字段组成的列表
+    """
+    payload = base64.b64decode(body)
+    if b"\r" in payload:
+        # 与 SSEDecoder 一致，\r\n 与 \r 换行统一替换为 \n
+        payload = payload.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    events = []
+    start = 0
+    length = len(payload)
+    while start < length:
+        end = payload.find(b"\n\n", start)
+        if end < 0:
+            # 最后一个事件可能没有结尾的分隔符
+            end = length
+        data = parse_event(payload, start, end)
+        if data is not None:
+            events.append(data)
+        start = end + 2
+    return events
+
+
+def parse_event(buffer, start, end):
+    """
+    解析 buffer[start:end] 中的单个事件，不含结尾的分隔符
+    :return 事件的 data 字段，ping 事件、保活数据与没有 data 字段的事件返回 None
+    """
+    if buffer.startswith(b"data: ", start) and buffer.find(b"\n", start, end) < 0:
+        # 绝大多数事件只有一行 data，直接从字节解码该字段
+        data = buffer[start + 6:end].decode("utf-8", errors="replace")
+        if data.endswith("\r"):
+            data = data[:-1]
+        return None if KEEP_ALIVE_DATA_PATTERN.match(data) else data
+    lines = buffer[start:end].decode("utf-8", errors="replace").split("\n")
+    data_lines = []
+    for line in lines:
+        if line.endswith("\r"):
+            line = line[:-1]
+        if line.startswith("data:"):
+            value = line[5:]
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+        elif line == "event: ping" or line == "event:ping":
+            return None
+    if not data_lines:
+        return None
+    data = "\n".join(data_lines)
+    if KEEP_ALIVE_DATA_PATTERN.match(data):
+        return None
+    return data
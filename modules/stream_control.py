@@ -0,0 +1,65 @@
+import threading
+from queue import Queue, Full
+
+from init import logger
+
+
+class StreamStopEvent(threading.Event):
+    """
+    单次请求的停止信号
+
+    与 threading.Event 用法一致，额外支持注册取消回调：set() 时依次执行，
+    用于在客户端断开后立即关闭上游的 websocket / SSE 连接，而不是等到下一条数据到达时才发现。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def add_callback(self, callback):
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+        # 已经停止的请求直接执行
+        self._run_callback(callback)
+
+    def set(self):
+        with self._callbacks_lock:
+            if self.is_set():
+                return
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    @staticmethod
+    def _run_callback(callback):
+        try:
+            callback()
+        except Exception as e:
+            logger.debug(f"执行取消回调失败: {e}")
+
+
+class StreamQueue(Queue):
+    """
+    单次请求的有界数据队列
+
+    队列达到上限时生产者阻塞，从而把背压传递到上游读取，避免读取慢的客户端让 worker 缓存整段响应；
+    请求停止后不再阻塞，直接丢弃数据，保证数据处理线程能够退出。
+    """
+
+    def __init__(self, maxsize, stop_event):
+        super().__init__(maxsize)
+        self.stop_event = stop_event
+
+    def put(self, item, block=True, timeout=None):
+        if not block:
+            return super().put(item, block=False)
+        while True:
+            try:
+                return super().put(item, timeout=0.5)
+            except Full:
+                if self.stop_event.is_set():
+                    return
@@ -0,0 +1,125 @@
+import logging
+from collections import deque
+import random
+import time
+
+import config
+from modules.chunk_encoder import ChunkEncoder
+from modules.sse import SSEDecoder
+from modules.text_rewriter import TextRewriter
+
+IMAGE_DISPLAYED_MARK = "<<ImageDisplayed>>"
+
+
+class StreamState:
+    """
+    单次会话的流处理状态，同步（线程）与异步（asyncio）执行模式、SSE 与 WSS 返回方式共用
+
+    process_data_json 直接修改其属性，每条上游消息不再构造与拆解状态元组。
+    stream 为 False 时只累积完整文本，不构造逐条的 chunk
+    """
+
+    __slots__ = (
+        "all_new_text", "first_output", "timestamp", "sse_decoder", "last_text_length", "last_code_length",
+        "last_code_result_length", "code_result_image_displayed", "last_content_type", "conversation_id",
+        "rewriter", "execution_output_image_future", "execution_output_image_id_buffer", "pending_images",
+        "image_wait_deadline", "is_sse", "upstream_response", "response_id", "messages", "api_key", "model",
+        "chat_message_id", "response_format", "stream", "encoder", "trace", "wss_frame_count", "wss_event_count",
+    )
+
+    def __init__(self, messages, api_key, model, chat_message_id, response_format, stream=True):
+        # 以列表累积输出文本，结束时再拼接
+        self.all_new_text = []
+        self.first_output = True
+        self.timestamp = int(time.time())
+        # 上游 SSE 响应的增量解析
+        self.sse_decoder = SSEDecoder()
+        # 上游每条消息都携带完整的内容，只记录已经输出的长度，据此取出新增的部分
+        self.last_text_length = 0
+        self.last_code_length = 0
+        self.last_code_result_length = 0
+        # 当前代码执行结果中是否出现过 <<ImageDisplayed>>
+        self.code_result_image_displayed = False
+        # 上一条消息的内容类型
+        self.last_content_type = None
+        self.conversation_id = ""
+        # 引用标记与沙箱文件链接的替换
+        self.rewriter = TextRewriter()
+        # 代码执行结果中图片的获取任务，执行结果结束时输出
+        self.execution_output_image_future = None
+        self.execution_output_image_id_buffer = ""
+        # 等待图片线程池完成、按顺序输出的图片
+        self.pending_images = deque()
+        # 会话结束时等待图片的截止时间，asyncio 模式下先在事件循环中等待，之后的处理共用同一截止时间
+        self.image_wait_deadline = None
+        self.is_sse = False
+        self.upstream_response = None
+        self.response_id = None
+        self.messages = messages
+        self.api_key = api_key
+        self.model = model
+        self.chat_message_id = chat_message_id
+        self.response_format = response_format
+        self.stream = stream
+        self.encoder = ChunkEncoder(chat_message_id, self.timestamp)
+        # 是否输出该会话逐条的流式数据日志，按比例抽样
+        self.trace = sample_stream_trace()
+        # 收到的 websocket 消息数与其中的事件数，上游可能在一条消息中合并发送多个事件
+        self.wss_frame_count = 0
+        self.wss_event_count = 0
+
+    def reset_message(self):
+        """
+        action 确认后上游开始新的回复，清空上一条回复的增量状态
+        """
+        self.last_text_length = 0
+        self.last_code_length = 0
+        self.last_code_result_length = 0
+        self.code_result_image_displayed = False
+        self.last_content_type = None
+        self.conversation_id = ""
+        self.rewriter = TextRewriter()
+        self.execution_output_image_future = None
+        self.execution_output_image_id_buffer = ""
+
+    def update_code_result(self, full_code_result):
+        """
+        记录代码执行结果的长度，只在新增的部分中查找 <<ImageDisplayed>>
+        """
+        # 标记可能跨越两次消息，从上次结尾之前开始查找
+        start = max(self.last_code_result_length - len(IMAGE_DISPLAYED_MARK) + 1, 0)
+        if IMAGE_DISPLAYED_MARK in full_code_result[start:]:
+            self.code_result_image_displayed = True
+        self.last_code_result_length = len(full_code_result)
+
+    def reset_code_result(self):
+        self.last_code_result_length = 0
+        self.code_result_image_displayed = False
+
+
+def sample_stream_trace():
+    """
+    :return 本次会话是否输出逐条的流式数据日志，日志等级高于 INFO 时不输出
+    """
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return False
+    return random.random() < config.LOG_STREAM_TRACE_SAMPLE_RATE
+
+
+def parts_delta(parts, previous_length):
+    """
+    取出 parts 拼接后相对前 previous_length 个字符新增的部分，不拼接完整文本
+    :return (新增文本, 拼接后的总长度)
+    """
+    if len(parts) == 1:
+        part = parts[0]
+        return part[previous_length:], len(part)
+    pieces = []
+    total = 0
+    for part in parts:
+        length = len(part)
+        if total + length > previous_length:
+            pieces.append(part[max(previous_length - total, 0):])
+        total += length
+    return ''.join(pieces), total
+
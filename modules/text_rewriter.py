@@ -0,0 +1,74 @@
+import re
+
+# 引用标记，如 【3†source】、【3†来源】
+CITATION_PATTERN = re.compile(r'\u3010(\d+)\u2020(?:source|\u6765\u6e90)\u3011')
+# 引用标记的开头部分，如 【、【3、【3†sou
+CITATION_PREFIX_PATTERN = re.compile(r'\u3010(?:\d+(?:\u2020(?:s(?:o(?:u(?:r(?:ce?)?)?)?)?|\u6765\u6e90?)?)?)?\Z')
+# 沙箱文件链接，如 (sandbox:/mnt/data/a.png)
+SANDBOX_PATTERN = re.compile(r'\(sandbox:([^)]+)\)')
+# 沙箱文件链接的开头部分，如 (、(sand、(sandbox:/mnt/da
+SANDBOX_PREFIX_PATTERN = re.compile(r'\((?:s(?:a(?:n(?:d(?:b(?:o(?:x(?::[^)]*)?)?)?)?)?)?)?)?\Z')
+# 可能开始一个标记的字符
+MARK_START_PATTERN = re.compile(r'[\u3010(]')
+
+# 暂存的文本超过该长度时不再视为标记，原样输出
+MAX_PENDING = 1024
+
+
+class TextRewriter:
+    """
+    流式替换回复中的引用标记与沙箱文件链接
+
+    每段新增文本只扫描一次：完整的标记立即替换，只暂存末尾可能是标记开头的部分（如 【3† 或 (sandbox:/mnt），
+    与下一段文本拼接后继续判断，其余文本直接输出。
+    """
+
+    __slots__ = ("pending",)
+
+    def __init__(self):
+        # 末尾尚不能确定是否为标记的文本
+        self.pending = ""
+
+    def feed(self, text, replace_citation, replace_sandbox):
+        """
+        :param replace_citation: 以引用编号调用，返回替换后的文本
+        :param replace_sandbox: 以沙箱路径调用，返回替换后的文本
+        :return 可以输出的文本
+        """
+        if self.pending:
+            text = self.pending + text
+            self.pending = ""
+        elif "\u3010" not in text and "(" not in text:
+            return text
+        pieces = []
+        start = 0
+        pos = 0
+        while True:
+            mark = MARK_START_PATTERN.search(text, pos)
+            if mark is None:
+                break
+            index = mark.start()
+            if text[index] == "\u3010":
+                pattern, prefix_pattern, replace = CITATION_PATTERN, CITATION_PREFIX_PATTERN, replace_citation
+            else:
+                pattern, prefix_pattern, replace = SANDBOX_PATTERN, SANDBOX_PREFIX_PATTERN, replace_sandbox
+            match = pattern.match(text, index)
+            if match:
+                pieces.append(text[start:index])
+                pieces.append(replace(match.group(1)))
+                start = pos = match.end()
+                continue
+            if len(text) - index <= MAX_PENDING and prefix_pattern.match(text, index):
+                self.pending = text[index:]
+                pieces.append(text[start:index])
+                return ''.join(pieces)
+            pos = index + 1
+        pieces.append(text[start:])
+        return ''.join(pieces)
+
+    def flush(self):
+        """
+        回复结束时调用，未完成的标记原样输出
+        """
+        text, self.pending = self.pending, ""
+        return text
@@ -0,0 +1,95 @@
+import threading
+import time
+import uuid
+
+from init import logger, redis_client
+
+# 刷新锁在 Redis 中的 key，多个 worker 之间同一账号同一时间只有一个在登录
+lock_cache_key = "gpt_access_key_lock:"
+
+# 值与自己的 token 一致时才删除锁，比较与删除在 Redis 中原子执行
+release_lock_script = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0")
+
+
+class TokenRefresher:
+    """
+    后台刷新账号的 access token
+
+    由守护线程每隔 check_interval 秒检查一次各账号 access token 的剩余有效期，
+    不足 margin 秒时重新登录。登录前先在 Redis 中加锁（SET NX PX），拿到锁的 worker 负责登录，
+    其他 worker 继续使用 Redis 中尚未过期的旧 token，对话请求不需要等待登录。
+    """
+
+    def __init__(self, login, get_cache_name, accounts, margin, check_interval, lock_timeout):
+        """
+        :param login: 登录并将 access token 写入 Redis 的函数，参数为账号，失败时返回 None
+        :param get_cache_name: 账号用户名 -> access token 在 Redis 中的 key
+        """
+        self.login = login
+        self.get_cache_name = get_cache_name
+        self.accounts = accounts
+        self.margin = margin
+        self.check_interval = check_interval
+        self.lock_timeout = lock_timeout
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            # 启动后立即执行一次，首个请求不必等待登录
+            self._thread = threading.Thread(target=self._run, name="token-refresher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            for account in self.accounts:
+                try:
+                    if self.needs_refresh(account):
+                        self.refresh(account)
+                except Exception as e:
+                    logger.error(f"账号 {account.username} accessToken刷新失败: {e}")
+            time.sleep(self.check_interval)
+
+    def needs_refresh(self, account):
+        # pttl: -2 表示 key 不存在，-1 表示没有设置过期时间
+        ttl = redis_client.pttl(self.get_cache_name(account.username))
+        return ttl == -2 or 0 <= ttl < self.margin * 1000
+
+    def refresh(self, account):
+        """
+        在单飞锁内登录
+        :return 拿到锁并完成登录返回 True，其他 worker 正在登录返回 False
+        """
+        lock_key = lock_cache_key + account.username
+        token = str(uuid.uuid4())
+        if not redis_client.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)):
+            return False
+        try:
+            logger.info(f"刷新账号 {account.username} 的 accessToken")
+            self.login(account)
+        finally:
+            # 只释放自己持有的锁，登录超过 lock_timeout 时锁可能已被其他 worker 取得
+            release_lock_script(keys=[lock_key], args=[token])
+        return True
+
+    def wait_for_token(self, account):
+        """
+        Redis 中没有可用的 token 时（首次启动或后台刷新失败）由请求调用：
+        拿到锁则直接登录，否则等待正在登录的 worker 写入 Redis，最多等待 lock_timeout 秒
+        :return access token，失败时返回 None
+        """
+        cache_name = self.get_cache_name(account.username)
+        deadline = time.time() + self.lock_timeout
+        while True:
+            if self.refresh(account):
+                access_key = redis_client.get(cache_name)
+                return access_key.decode() if access_key else None
+            time.sleep(0.2)
+            access_key = redis_client.get(cache_name)
+            if access_key:
+                return access_key.decode()
+            if time.time() >= deadline:
+                return None
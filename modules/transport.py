@@ -0,0 +1,46 @@
+import threading
+import time
+
+import config
+from init import logger
+
+TRANSPORT_SSE = 'sse'
+TRANSPORT_WSS = 'wss'
+
+
+class TransportNegotiator:
+    """
+    记录每个账号在每个上游下对话接口实际使用的返回方式（SSE 或 WSS）
+
+    已知为 SSE 时直接发送对话请求，省去 register-websocket 请求与 websocket 握手；
+    记录在 probe_interval 秒后过期，过期后按原流程（先建立 websocket）重新探测一次。
+    """
+
+    def __init__(self, probe_interval):
+        self.probe_interval = probe_interval
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def get(self, base_url, api_key):
+        """
+        :return TRANSPORT_SSE / TRANSPORT_WSS，未知或已过期时返回 None
+        """
+        with self._lock:
+            record = self._transports.get((base_url, api_key))
+            if record is None:
+                return None
+            transport, expires_at = record
+            if expires_at <= time.time():
+                del self._transports[(base_url, api_key)]
+                return None
+            return transport
+
+    def remember(self, base_url, api_key, transport):
+        with self._lock:
+            record = self._transports.get((base_url, api_key))
+            if record is None or record[0] != transport:
+                logger.info(f"上游对话返回方式: {transport}")
+                self._transports[(base_url, api_key)] = (transport, time.time() + self.probe_interval)
+
+
+transport_negotiator = TransportNegotiator(config.TRANSPORT_PROBE_INTERVAL)
@@ -0,0 +1,214 @@
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import config
+from init import logger
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+# 视为上游实例本身不可用的状态码，换一个实例重试
+FAILOVER_STATUS_CODES = (502, 503, 504)
+
+# 幂等的请求方法，请求发出后失败也可以换一个实例重试
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def is_connect_error(e):
+    """
+    :return 请求是否在发出之前失败（连接失败或连接超时），此时换一个实例重试不会重复提交
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args and isinstance(e.args[0], MaxRetryError):
+        return isinstance(e.args[0].reason, NewConnectionError)
+    return False
+
+
+class RequestRoute:
+    """
+    一路对话请求实际使用的上游实例，对冲请求据此优先选择其他实例
+    """
+
+    def __init__(self, avoid=None):
+        self.avoid = avoid
+        self.backend = None
+
+
+# 当前线程 / 协程所属的一路请求，没有时为 None
+request_route = contextvars.ContextVar('request_route', default=None)
+
+
+class UpstreamBackend:
+    """
+    一个上游实例（Ninja / Pandora）及其熔断状态
+
+    最近 window 次请求的结果用于计算错误率与 p95 延迟；连续失败 failure_threshold 次后熔断（open），
+    open_seconds 秒后进入半开（half_open），只放行一个探测请求，成功则恢复，失败则继续熔断。
+    """
+
+    def __init__(self, base_url, window):
+        self.base_url = base_url
+        # (是否成功, 耗时)
+        self.results = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.state = STATE_CLOSED
+        self.opened_at = 0
+        self.probe_started_at = 0
+
+    def error_rate(self):
+        if not self.results:
+            return 0
+        return sum(1 for ok, _ in self.results if not ok) / len(self.results)
+
+    def p95_latency(self):
+        latencies = sorted(latency for ok, latency in self.results if ok)
+        if not latencies:
+            return 0
+        return latencies[min(math.ceil(len(latencies) * 0.95), len(latencies)) - 1]
+
+    def score(self):
+        # 越小越好，错误率按比例放大延迟；没有数据的实例得分为 0，会被优先尝试
+        return self.p95_latency() * (1 + 4 * self.error_rate())
+
+
+class UpstreamPool:
+    """
+    多个上游实例之间的选择与故障转移
+
+    新的对话请求发往当前得分最好（p95 延迟低、错误率低）的实例，连接失败或返回 502/503/504 时换下一个实例重试，
+    熔断中的实例不再接收请求，不会让每个请求都先等待一个已经不可用的实例超时。
+    对话等非幂等请求只在连接失败（请求尚未发出）时换实例重试，避免重复创建对话或重复使用一次性的 Arkose token。
+    """
+
+    def __init__(self, base_urls, failure_threshold, open_seconds, window):
+        self.backends = [UpstreamBackend(base_url, window) for base_url in base_urls]
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """
+        :return 按得分排序的可用实例，全部熔断时按熔断时间先后返回全部实例
+        """
+        now = time.time()
+        with self._lock:
+            available = []
+            for backend in self.backends:
+                if backend.state == STATE_OPEN and now - backend.opened_at >= self.open_seconds:
+                    backend.state = STATE_HALF_OPEN
+                    logger.info(f"上游 {backend.base_url} 熔断结束，进入半开状态")
+                if backend.state == STATE_CLOSED:
+                    available.append(backend)
+                elif backend.state == STATE_HALF_OPEN and now - backend.probe_started_at >= self.open_seconds:
+                    available.append(backend)
+            if not available:
+                return sorted(self.backends, key=lambda backend: backend.opened_at)
+            ranked = sorted(available, key=lambda backend: backend.score())
+        route = request_route.get()
+        if route is not None and route.avoid in ranked and len(ranked) > 1:
+            # 对冲请求把主请求所在的实例放到最后
+            ranked.remove(route.avoid)
+            ranked.append(route.avoid)
+        return ranked
+
+    def acquire(self, backend):
+        """
+        在向实例发送请求前调用，半开状态的实例同一时间只放行一个探测请求
+        :return 是否可以发送
+        """
+        with self._lock:
+            if backend.state != STATE_HALF_OPEN:
+                return True
+            if time.time() - backend.probe_started_at < self.open_seconds:
+                return False
+            backend.probe_started_at = time.time()
+            return True
+
+    def has_alternative(self, backend):
+        """
+        :return 除 backend 之外是否还有未熔断的实例，对冲请求只在有其他实例可用时发起
+        """
+        return any(candidate is not backend and candidate.state != STATE_OPEN for candidate in self.candidates())
+
+    def base_url(self):
+        """
+        当前最优实例的地址，用于不需要重试的请求
+        """
+        return self.candidates()[0].base_url
+
+    def record(self, backend, ok, latency):
+        with self._lock:
+            backend.results.append((ok, latency))
+            if ok:
+                if backend.state != STATE_CLOSED:
+                    logger.info(f"上游 {backend.base_url} 已恢复")
+                backend.state = STATE_CLOSED
+                backend.consecutive_failures = 0
+                backend.probe_started_at = 0
+                return
+            backend.consecutive_failures += 1
+            if backend.state == STATE_HALF_OPEN or (backend.state == STATE_CLOSED and
+                                                    backend.consecutive_failures >= self.failure_threshold):
+                logger.warning(f"上游 {backend.base_url} 连续失败 {backend.consecutive_failures} 次，熔断 "
+                               f"{self.open_seconds} 秒")
+                backend.state = STATE_OPEN
+                backend.opened_at = time.time()
+                backend.probe_started_at = 0
+
+    def request(self, session, method, path, **kwargs):
+        """
+        依次向可用实例发送请求，直到某个实例正常响应
+        :param path: 不含实例地址的路径
+        """
+        candidates = self.candidates()
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        last_error = None
+        for index, backend in enumerate(candidates):
+            if not self.acquire(backend):
+                continue
+            route = request_route.get()
+            if route is not None:
+                route.backend = backend
+            start_time = time.time()
+            try:
+                response = session.request(method, backend.base_url + path, **kwargs)
+            except requests.RequestException as e:
+                self.record(backend, False, time.time() - start_time)
+                logger.error(f"上游 {backend.base_url} 请求失败: {e}")
+                if not idempotent and not is_connect_error(e):
+                    raise
+                last_error = e
+                continue
+            if response.status_code in FAILOVER_STATUS_CODES:
+                self.record(backend, False, time.time() - start_time)
+                if idempotent and index < len(candidates) - 1:
+                    logger.error(f"上游 {backend.base_url} 返回 {response.status_code}，切换到其他上游")
+                    response.close()
+                    continue
+                return response
+            self.record(backend, True, time.time() - start_time)
+            return response
+        if last_error is not None:
+            raise last_error
+        raise requests.ConnectionError("no available upstream")
+
+    def stats(self):
+        with self._lock:
+            return [{
+                "base_url": backend.base_url,
+                "state": backend.state,
+                "error_rate": round(backend.error_rate(), 4),
+                "p95_latency": round(backend.p95_latency(), 4),
+            } for backend in self.backends]
+
+
+upstream_pool = UpstreamPool(config.UPSTREAM_BASE_URLS, config.UPSTREAM_CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                             config.UPSTREAM_CIRCUIT_BREAKER_OPEN_SECONDS, config.UPSTREAM_CIRCUIT_BREAKER_WINDOW)
@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import websocket
+
+import config
+from init import logger
+
+# 尚未被认领的消息（对话请求还未返回 response_id）的最长保留时间（秒）
+PENDING_MESSAGE_TTL = 60
+# 每个对话最多缓存的未认领消息数
+PENDING_MESSAGES_PER_RESPONSE = 1000
+# 最多同时缓存未认领消息的对话数，超过后丢弃最久没有收到消息的对话
+PENDING_RESPONSES_MAX = 200
+# 最多记录的已结束、已丢弃消息的对话数，这些对话之后的消息直接丢弃
+DISCARDED_RESPONSES_MAX = 1000
+
+
+class WebSocketConnection:
+    """
+    单个账号共用的长连接 websocket
+
+    收到的消息按 response_id 分发给对应的请求，由单独的守护线程维持连接：
+    定时 ping，断开后重新 register-websocket 并重连（仍有请求在等待时），空闲超过 idle_timeout 后关闭。
+    """
+
+    def __init__(self, manager, api_key):
+        self.manager = manager
+        self.api_key = api_key
+        self._lock = threading.Lock()
+        # response_id -> sink，sink 为非阻塞的回调，参数为解析后的消息，连接失效时参数为 None
+        self._routes = {}
+        # 对话请求返回 response_id 之前就已经到达的消息，response_id -> (最近到达时间, [消息])，按最近到达时间排序
+        self._pending = OrderedDict()
+        # 已结束（已取消订阅）的对话，response_id -> None
+        self._finished = OrderedDict()
+        # 未认领的消息因超时或超过上限被丢弃的对话，订阅时按连接断开处理
+        self._dropped = OrderedDict()
+        # 已取得连接、尚未结束的请求数，不为 0 时连接不会因空闲而关闭
+        self._in_flight = 0
+        self._last_used = time.time()
+        self._connected = threading.Event()
+        self._opened = False
+        self._closed = False
+        # 每次重连后加一，用于判断请求取得连接之后是否发生过断开
+        self.generation = 0
+        self._ws = None
+        self._thread = threading.Thread(target=self._run, name="wss-connection", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def acquire(self):
+        with self._lock:
+            if self._closed:
+                return False
+            self._in_flight += 1
+            self._last_used = time.time()
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._last_used = time.time()
+
+    def wait_connected(self, timeout):
+        # 连接线程退出时同样会 set，以便等待方立即返回
+        return self._connected.wait(timeout) and not self._closed
+
+    def subscribe(self, response_id, sink, generation):
+        """
+        :param generation: 取得连接时的 generation，之后发生过断开时该对话的消息可能已经丢失，直接按连接断开处理
+        """
+        response_id = str(response_id).strip()
+        with self._lock:
+            # 在锁内先补发缓存的消息再注册，保证消息顺序
+            if response_id in self._dropped:
+                del self._dropped[response_id]
+                logger.error("websocket 中该对话未认领的消息已被丢弃: %s", response_id)
+                self._call_sink(sink, None)
+                return
+            _, messages = self._pending.pop(response_id, (None, []))
+            for result_json in messages:
+                self._call_sink(sink, result_json)
+            if self._closed or generation != self.generation:
+                self._call_sink(sink, None)
+                return
+            self._routes[response_id] = sink
+
+    def unsubscribe(self, response_id):
+        response_id = str(response_id).strip()
+        with self._lock:
+            self._routes.pop(response_id, None)
+            self._pending.pop(response_id, None)
+            self._remember(self._finished, response_id)
+
+    @staticmethod
+    def _call_sink(sink, result_json):
+        try:
+            sink(result_json)
+        except Exception as e:
+            logger.debug(f"websocket 消息分发失败: {e}")
+
+    def _on_open(self, ws):
+        logger.debug("wss connected")
+        with self._lock:
+            self._opened = True
+            self.generation += 1
+        self._connected.set()
+
+    def _on_message(self, ws, message):
+        # 完整的消息内容由各会话按 log_stream_trace_sample_rate 抽样输出
+        try:
+            result_json = json.loads(message)
+        except json.JSONDecodeError:
+            logger.debug("无法解析的 websocket 消息: %s", message)
+            return
+        response_id = str(result_json.get('response_id', '')).strip()
+        with self._lock:
+            sink = self._routes.get(response_id)
+            if sink is not None:
+                self._call_sink(sink, result_json)
+                return
+            if self._in_flight == 0 or response_id in self._finished or response_id in self._dropped:
+                return
+            now = time.time()
+            _, messages = self._pending.pop(response_id, (None, []))
+            messages.append(result_json)
+            if len(messages) > PENDING_MESSAGES_PER_RESPONSE:
+                self._remember(self._dropped, response_id)
+            else:
+                self._pending[response_id] = (now, messages)
+            # 最久没有收到消息的对话排在最前面，只需检查开头的几个
+            while self._pending:
+                oldest_time, _ = next(iter(self._pending.values()))
+                if len(self._pending) <= PENDING_RESPONSES_MAX and now - oldest_time <= PENDING_MESSAGE_TTL:
+                    break
+                self._remember(self._dropped, self._pending.popitem(last=False)[0])
+
+    @staticmethod
+    def _remember(responses, response_id):
+        responses[response_id] = None
+        if len(responses) > DISCARDED_RESPONSES_MAX:
+            responses.popitem(last=False)
+
+    def _on_error(self, ws, error):
+        logger.error(f"wss error: {error}")
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        logger.debug(f"wss closed: {close_status_code} {close_msg}")
+        self._connected.clear()
+
+    def _on_pong(self, ws, data):
+        # 借助 ping 周期检查是否空闲，不需要额外的定时线程
+        with self._lock:
+            if self._in_flight == 0 and time.time() - self._last_used > self.manager.idle_timeout:
+                logger.debug("wss 空闲，关闭连接")
+                self._closed = True
+        if self._closed:
+            ws.close()
+
+    def _run(self):
+        failures = 0
+        while not self._closed:
+            self._opened = False
+            try:
+                wss_url = self.manager.register(self.api_key)
+                self._ws = websocket.WebSocketApp(wss_url,
+                                                  on_open=self._on_open,
+                                                  on_message=self._on_message,
+                                                  on_error=self._on_error,
+                                                  on_close=self._on_close,
+                                                  on_pong=self._on_pong)
+                self._ws.run_forever(ping_interval=self.manager.ping_interval,
+                                     ping_timeout=self.manager.ping_timeout,
+                                     **self.manager.proxy_options)
+            except Exception as e:
+                logger.error(f"wss 连接失败: {e}")
+            self._connected.clear()
+
+            with self._lock:
+                # 断开期间上游推送的消息已经丢失，进行中的对话按连接断开结束，不再等待
+                self._notify_closed()
+                if self._closed:
+                    break
+                failures = 0 if self._opened else failures + 1
+                # 没有进行中的请求时不必重连，下次请求时再建立
+                if self._in_flight == 0 or failures > self.manager.reconnect_attempts:
+                    self._closed = True
+                    break
+            logger.warning("wss 连接已断开，重新连接")
+            time.sleep(min(failures, 5))
+
+        with self._lock:
+            self._closed = True
+            self._notify_closed()
+        self._connected.set()
+        self.manager.remove(self)
+
+    def _notify_closed(self):
+        routes, self._routes = self._routes, {}
+        self._pending.clear()
+        for sink in routes.values():
+            self._call_sink(sink, None)
+
+
+class WebSocketManager:
+    """
+    按 access token 管理长连接 websocket
+
+    多个对话共用同一条连接，省去每次请求的 register-websocket 与握手耗时。
+    """
+
+    def __init__(self, register, ping_interval, ping_timeout, idle_timeout, connect_timeout, reconnect_attempts):
+        self.register = register
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.proxy_options = {}
+        if config.PROXY_CONFIG_ENABLED:
+            self.proxy_options = {
+                "http_proxy_host": config.PROXY_CONFIG_HOST,
+                "http_proxy_port": config.PROXY_CONFIG_PORT,
+                "proxy_type": config.PROXY_CONFIG_PROTOCOL,
+                "http_proxy_auth": config.PROXY_CONFIG_AUTH
+            }
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, api_key):
+        """
+        取得该账号的连接并计入进行中的请求，用完后必须调用 connection.release()
+        """
+        with self._lock:
+            connection = self._connections.get(api_key)
+            if connection is None or not connection.acquire():
+                connection = WebSocketConnection(self, api_key)
+                connection.acquire()
+                self._connections[api_key] = connection
+                connection.start()
+        if not connection.wait_connected(self.connect_timeout):
+            connection.release()
+            raise Exception("Wss connect fail")
+        return connection
+
+    def remove(self, connection):
+        with self._lock:
+            if self._connections.get(connection.api_key) is connection:
+                del self._connections[connection.api_key]
@@ -24,11 +24,26 @@ if [ -z "$PROCESS_THREADS" ]; then
     fi
 fi
 
+if [ -z "$SERVER_MODE" ]; then
+    SERVER_MODE=$(jq -r '.server_mode // empty' /app/data/config.json)
+
+    if [ -z "$SERVER_MODE" ]; then
+        SERVER_MODE=wsgi
+    fi
+fi
+
 export PROCESS_WORKERS
 export PROCESS_THREADS
+export SERVER_MODE
 
 echo "PROCESS_WORKERS: ${PROCESS_WORKERS}"
 echo "PROCESS_THREADS: ${PROCESS_THREADS}"
+echo "SERVER_MODE: ${SERVER_MODE}"
+
+if [ "$SERVER_MODE" = "asgi" ]; then
+    # asyncio 模式：每个进程一个事件循环，PROCESS_THREADS 不再生效
+    exec uvicorn asgi:app --workers ${PROCESS_WORKERS} --host 0.0.0.0 --port 33333
+fi
 
 # 启动 Gunicorn 并使用 tee 命令同时输出日志到文件和控制台
 exec gunicorn -w ${PROCESS_WORKERS} --threads ${PROCESS_THREADS} --bind 0.0.0.0:33333 app:app --access-logfile - --error-logfile -
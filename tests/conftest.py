@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 测试从仓库根目录导入 modules，config 也从仓库根目录下的 data/config.json 读取配置
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
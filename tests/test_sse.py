@@ -0,0 +1,115 @@
+"""
+SSEDecoder 与 decode_frame_body 的拆分点模糊测试：同一段上游数据无论在哪些位置被拆分为数据块、
+使用哪种换行符，解析出的事件都应与整段一次解析的结果一致
+"""
+import base64
+import os
+import random
+
+import pytest
+
+from modules.sse import SSEDecoder, decode_frame_body
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "fixtures",
+                       "conversation.sse")
+NEWLINES = ("\n", "\r\n", "\r")
+
+# 单个事件的各种写法，期望的 data 为 None 时表示事件应被跳过
+EVENTS = [
+    ("data: hello", "hello"),
+    ("data:hello", "hello"),
+    ("data: 你好，世界 😀", "你好，世界 😀"),
+    ('data: {"message": {"content": {"parts": ["a\\nb"]}}}', '{"message": {"content": {"parts": ["a\\nb"]}}}'),
+    ("data: line1{nl}data: line2", "line1\nline2"),
+    ("event: message{nl}data: body", "body"),
+    ("id: 1{nl}data: body{nl}retry: 10", "body"),
+    ("event: ping{nl}data: 2024-01-01 00:00:00.000000", None),
+    ("data: 2024-01-01 00:00:00.000000", None),
+    ("event: ping", None),
+    (": comment", None),
+    ("data: [DONE]", "[DONE]"),
+]
+
+
+def build_stream(rng, newline, count):
+    events = [rng.choice(EVENTS) for _ in range(count)]
+    text = "".join(raw.replace("{nl}", newline) + newline * 2 for raw, _ in events)
+    return text.encode("utf-8"), [data for _, data in events if data is not None]
+
+
+def random_split(rng, payload):
+    cuts = sorted(rng.sample(range(1, len(payload)), min(len(payload) - 1, rng.randint(0, 20)))) if payload else []
+    chunks = []
+    prev = 0
+    for cut in cuts + [len(payload)]:
+        chunks.append(payload[prev:cut])
+        prev = cut
+    return chunks
+
+
+def feed_all(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    return events, decoder.remaining()
+
+
+@pytest.mark.parametrize("newline", NEWLINES, ids=("LF", "CRLF", "CR"))
+def test_split_points(newline):
+    rng = random.Random(newline)
+    for _ in range(2000):
+        payload, expected = build_stream(rng, newline, rng.randint(0, 8))
+        events, remaining = feed_all(random_split(rng, payload))
+        assert events == expected, (payload, events)
+        assert remaining == ""
+
+
+@pytest.mark.parametrize("newline", NEWLINES, ids=("LF", "CRLF", "CR"))
+def test_every_split_point(newline):
+    # 所有只拆分一次的位置，包括 \r\n 中间与 UTF-8 多字节字符中间
+    payload, expected = build_stream(random.Random(0), newline, 12)
+    for cut in range(len(payload) + 1):
+        events, remaining = feed_all([payload[:cut], payload[cut:]])
+        assert events == expected, cut
+        assert remaining == ""
+
+
+def test_byte_by_byte():
+    payload, expected = build_stream(random.Random(1), "\r\n", 30)
+    events, remaining = feed_all([payload[i:i + 1] for i in range(len(payload))])
+    assert events == expected
+    assert remaining == ""
+
+
+def test_incomplete_tail_is_remaining():
+    decoder = SSEDecoder()
+    assert decoder.feed(b'data: a\n\n{"detail": "error"') == ["a"]
+    assert decoder.remaining() == '{"detail": "error"'
+    # remaining 之后可以继续解析新的响应
+    assert decoder.feed(b"data: b\r\n\r\n") == ["b"]
+
+
+@pytest.mark.parametrize("newline", NEWLINES, ids=("LF", "CRLF", "CR"))
+def test_recorded_stream(newline):
+    with open(FIXTURE, "rb") as f:
+        recorded = f.read()
+    expected, _ = feed_all([recorded])
+    assert expected[-1] == "[DONE]"
+    payload = recorded.replace(b"\n", newline.encode())
+    rng = random.Random(2)
+    for _ in range(20):
+        chunk_size = rng.randint(1, 4096)
+        events, _ = feed_all([payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)])
+        assert events == expected, chunk_size
+
+
+@pytest.mark.parametrize("newline", NEWLINES, ids=("LF", "CRLF", "CR"))
+def test_decode_frame_body(newline):
+    rng = random.Random(newline)
+    for _ in range(2000):
+        payload, expected = build_stream(rng, newline, rng.randint(1, 8))
+        if rng.random() < 0.5:
+            # 最后一个事件可能没有结尾的分隔符
+            payload = payload[:-len(newline.encode()) * 2]
+        assert decode_frame_body(base64.b64encode(payload)) == expected, payload
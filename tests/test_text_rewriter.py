@@ -0,0 +1,85 @@
+"""
+TextRewriter 的分块边界模糊测试：回复文本无论被拆分为怎样的增量，输出都应与整段一次处理的结果一致，
+并且与对整段文本做一次正则替换的结果一致
+"""
+import random
+import re
+
+from modules.text_rewriter import MAX_PENDING, TextRewriter
+
+REFERENCE_PATTERN = re.compile(r'【(\d+)†(?:source|来源)】|\(sandbox:([^)]+)\)')
+
+# 随机拼接的文本片段，包含完整的标记、标记的各个前缀与容易误判的字符
+FRAGMENTS = ["【", "1", "23", "†", "source", "sou", "来源", "来", "】", "(", "sandbox:",
+             "sandbox", "/mnt/data/a.png", ")", "x", " ", "\n", "你好", "(sandbox:/f)", "【2†source】"]
+
+
+def replace_citation(number):
+    return f"[[{number}](https://example.com/{number})]"
+
+
+def replace_sandbox(path):
+    return f"(https://example.com/files{path})"
+
+
+def reference(text):
+    return REFERENCE_PATTERN.sub(lambda m: replace_citation(m.group(1)) if m.group(1) is not None
+                                 else replace_sandbox(m.group(2)), text)
+
+
+def rewrite(deltas):
+    rewriter = TextRewriter()
+    output = "".join(rewriter.feed(delta, replace_citation, replace_sandbox) for delta in deltas)
+    return output + rewriter.flush()
+
+
+def random_split(rng, text):
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 10))))
+    deltas = []
+    prev = 0
+    for cut in cuts + [len(text)]:
+        deltas.append(text[prev:cut])
+        prev = cut
+    return deltas
+
+
+def test_chunk_boundaries():
+    rng = random.Random(0)
+    for _ in range(20000):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 30)))
+        whole = TextRewriter()
+        output = whole.feed(text, replace_citation, replace_sandbox)
+        tail = whole.flush()
+        assert rewrite(random_split(rng, text)) == output + tail, text
+        if REFERENCE_PATTERN.search(tail) is None:
+            # 末尾暂存的未完成标记原样输出，其中不包含完整标记时与整段正则替换的结果一致
+            assert output + tail == reference(text), text
+
+
+def test_every_split_point():
+    text = "你好【3†source】 see (sandbox:/mnt/data/a.png) and (note) 【12†来源】."
+    expected = reference(text)
+    for i in range(len(text) + 1):
+        for j in range(i, len(text) + 1):
+            assert rewrite([text[:i], text[i:j], text[j:]]) == expected, (i, j)
+
+
+def test_char_by_char():
+    text = "a【1†source】b(sandbox:/x/y.csv)c(sand)d【e"
+    assert rewrite(list(text)) == reference(text)
+
+
+def test_unterminated_mark_is_flushed():
+    rewriter = TextRewriter()
+    assert rewriter.feed("see (sandbox:/mnt/da", replace_citation, replace_sandbox) == "see "
+    assert rewriter.pending == "(sandbox:/mnt/da"
+    assert rewriter.flush() == "(sandbox:/mnt/da"
+    assert rewriter.pending == ""
+
+
+def test_pending_is_bounded():
+    rewriter = TextRewriter()
+    deltas = ["(sandbox:/"] + ["x"] * (MAX_PENDING + 10) + [")"]
+    output = "".join(rewriter.feed(delta, replace_citation, replace_sandbox) for delta in deltas)
+    assert len(rewriter.pending) <= MAX_PENDING
+    assert output + rewriter.flush() == "".join(deltas)